@@ -0,0 +1,1458 @@
+# bench.py — локальные замеры без внешней сети
+# Запуск: python bench.py <сценарий> [--items N ...] [--out results.jsonl], см. --help
+#         python bench.py suite --out results.jsonl       — стандартный набор для сравнения коммитов
+#         python bench.py compare old.jsonl new.jsonl    — что стало хуже больше чем на --threshold
+# Каждая строка вывода — JSON с полем scenario; первая строка файла --out — _meta (коммит, версии, CPU).
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import hashlib
+import tempfile
+import platform
+import threading
+import statistics
+import subprocess
+
+_TMP = tempfile.mkdtemp(prefix="halyava-bench-")
+os.environ.setdefault("DB_PATH", os.path.join(_TMP, "bench.db"))
+os.environ.setdefault("ADMITAD_ACCESS_TOKEN", "bench-token")
+
+import aiohttp
+from aiohttp import web
+
+import main
+
+# ---------- СИНТЕТИЧЕСКИЕ ФИДЫ ----------
+STORES = ["Ozon", "Wildberries", "М.Видео", "Лента", "Самокат", "Some Shop", "Другой магазин"]
+
+def gen_admitad(n:int, seed:int=0) -> bytes:
+    results = []
+    for i in range(n):
+        store = STORES[(i + seed) % len(STORES)]
+        results.append({
+            "id": seed * 1_000_000 + i,
+            "campaign": {"id": (i + seed) % len(STORES), "name": store},
+            "promocode": f"CODE{seed}X{i}" if i % 3 else "",
+            "short_name": f"Скидка {i % 50}% в {store}",
+            "description": "Описание акции " * 4,
+            "date_start": "2026-01-01 00:00:00",
+            "date_end": "2099-12-31 23:59:59",
+            "tracked_link": f"https://ad.admitad.com/g/{seed}x{i}/?subid=bench",
+        })
+    return json.dumps({"results": results, "_meta": {"count": n}}).encode("utf-8")
+
+def gen_rss(n:int, seed:int=0) -> bytes:
+    items = []
+    for i in range(n):
+        store = STORES[(i + seed) % len(STORES)]
+        items.append(
+            f"<item><title>{store}: скидка {i % 40}%</title>"
+            f"<link>https://cityads.example/c/{seed}/{i}</link>"
+            f"<description>Промокод: RSS{seed}X{i:05d} на всё</description></item>"
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>bench</title>'
+        + "".join(items) + "</channel></rss>"
+    ).encode("utf-8")
+
+def gen_cityads_json(n:int, seed:int=0) -> bytes:
+    coupons = []
+    for i in range(n):
+        store = STORES[(i + seed) % len(STORES)]
+        coupons.append({
+            "campaign": {"name": store},
+            "code": f"CA{seed}X{i:05d}" if i % 4 else "",
+            "title": f"{store}: скидка {i % 40}%",
+            "description": "Условия акции " * 3,
+            "url": f"https://cityads.example/c/{seed}/{i}?utm_source=bench",
+            "start_date": "2026-01-01 00:00:00",
+            "end_date": "2099-12-31 23:59:59",
+        })
+    return json.dumps({"coupons": coupons}, ensure_ascii=False).encode("utf-8")
+
+def gen_promo_html(n_codes:int, seed:int=0) -> bytes:
+    blocks = "".join(
+        f"<div class='promo'><h3>Акция {i}</h3><p>Промокод: PAGE{seed}X{i:04d}</p>"
+        f"<p>{'Текст страницы ' * 20}</p></div>"
+        for i in range(n_codes)
+    )
+    return f"<html><head><title>promo</title></head><body>{blocks}</body></html>".encode("utf-8")
+
+# ---------- STUB-СЕРВЕР ----------
+STUB_HITS: dict = {}  # маршрут -> сколько раз его запросили
+
+STUB_BYTES: dict = {}  # маршрут -> сколько байт отдали
+STUB_ADMITAD: dict = {}  # текущая выдача Admitad: {"items": [...]} — сценарии могут её менять
+STUB_PROMO: dict = {"version": {}, "active": 0, "peak": 0}  # номер страницы -> версия тела; параллельность
+
+async def start_feed_stub(delay:float, items:int, pages:int, cityads:str="rss"):
+    # cityads: "rss" или "json" — какой из двух форматов фида CityAds отдавать
+    STUB_ADMITAD["items"] = json.loads(gen_admitad(items))["results"]
+    rss = gen_rss(items)
+    cityads_json = gen_cityads_json(items)
+    promo = gen_promo_html(50)
+    STUB_HITS.clear()
+    STUB_BYTES.clear()
+
+    def hit(name, body=b""):
+        STUB_HITS[name] = STUB_HITS.get(name, 0) + 1
+        STUB_BYTES[name] = STUB_BYTES.get(name, 0) + len(body)
+
+    async def h_admitad(request):
+        # limit/offset + ETag/If-None-Match, как у настоящего API
+        await asyncio.sleep(delay)
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 20))
+        results = STUB_ADMITAD["items"][offset:offset + limit]
+        body = json.dumps({"results": results, "_meta": {"count": len(STUB_ADMITAD["items"]),
+                                                         "offset": offset, "limit": limit}}).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if request.headers.get("If-None-Match") == etag:
+            hit("admitad")
+            return web.Response(status=304, headers={"ETag": etag})
+        hit("admitad", body)
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def h_rss(request):
+        hit("cityads")
+        await asyncio.sleep(delay)
+        return web.Response(body=rss, content_type="application/rss+xml")
+
+    async def h_cityads_json(request):
+        hit("cityads")
+        await asyncio.sleep(delay)
+        return web.Response(body=cityads_json, content_type="application/json")
+
+    async def h_promo(request):
+        # чётные страницы отдают ETag, нечётные — нет (тогда краулер сверяет хэш тела)
+        n = int(request.match_info["n"])
+        version = STUB_PROMO["version"].get(n, 0)
+        STUB_PROMO["active"] += 1
+        STUB_PROMO["peak"] = max(STUB_PROMO["peak"], STUB_PROMO["active"])
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            STUB_PROMO["active"] -= 1
+        body = promo if not version else gen_promo_html(50, seed=version)
+        headers = {}
+        if n % 2 == 0:
+            headers["ETag"] = f'"p{n}v{version}"'
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                hit("promo")
+                return web.Response(status=304, headers=headers)
+        hit("promo", body)
+        return web.Response(body=body, content_type="text/html", headers=headers)
+
+    app = web.Application()
+    app.router.add_get("/coupons/website/{wid}/", h_admitad)
+    app.router.add_get("/cityads.rss", h_rss)
+    app.router.add_get("/cityads.json", h_cityads_json)
+    app.router.add_get("/promo/{n}", h_promo)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+
+    main.ADMITAD_API_URL = base
+    main.ADMITAD_WEBSITE_ID = "1"
+    main.CITYADS_COUPONS_URL = f"{base}/cityads.{cityads}"
+    main.OFFICIAL_PROMO_PAGES = [f"{base}/promo/{i}" for i in range(pages)]
+    main.PROMO_HOST_DELAY = 0  # stub локальный, вежливость к нему не меряем
+    return runner
+
+# ---------- FAKE BOT API ----------
+class FakeBotAPI:
+    """Минимальный Bot API: sendMessage/editMessageText + флуд-контроль как у Telegram
+    (chat_burst сообщений в чат и global_rate сообщений всего за скользящую секунду)."""
+    def __init__(self, chat_burst:int=3, global_rate:int=30, latency:float=0.0):
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.latency = latency
+        self.calls = 0
+        self.flood = 0
+        self.bad_html = 0
+        self.delivered = 0
+        self._global = []
+        self._per_chat = {}
+        self._msg_id = 0
+        self.last_text = {}  # chat_id -> текст последнего принятого сообщения
+
+    def _limited(self, chat_id) -> bool:
+        now = time.monotonic()
+        self._global = [t for t in self._global if now - t < 1.0]
+        chat = [t for t in self._per_chat.get(chat_id, ()) if now - t < 1.0]
+        if len(self._global) >= self.global_rate or len(chat) >= self.chat_burst:
+            self._per_chat[chat_id] = chat
+            return True
+        self._global.append(now)
+        chat.append(now)
+        self._per_chat[chat_id] = chat
+        return False
+
+    async def handle(self, request):
+        self.calls += 1
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        if not data:
+            try:
+                data = await request.json()
+            except Exception:
+                data = {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}})
+        if method in ("setWebhook", "deleteWebhook"):
+            return web.json_response({"ok": True, "result": True})
+        chat_id = int(data.get("chat_id", 0))
+        if self._limited(chat_id):
+            self.flood += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        text = data.get("text", "")
+        if data.get("parse_mode") == "HTML" and not main.tg_html_ok(text):
+            self.bad_html += 1
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: can't parse entities"}, status=400)
+        self.delivered += 1
+        self.last_text[chat_id] = text
+        self._msg_id += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": int(data.get("message_id") or self._msg_id), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": text}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    def bot(self):
+        from aiogram import Bot
+        from aiogram.client.default import DefaultBotProperties
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        from aiogram.enums import ParseMode
+        session = AiohttpSession(api=TelegramAPIServer.from_base(self.base))
+        return Bot("123456:" + "A" * 35, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+# ---------- ИЗМЕРЕНИЯ ----------
+class LoopLag:
+    """Фоновая задача: насколько позже положенного просыпается event loop."""
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - t0 - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> dict:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        s = sorted(self.samples) or [0.0]
+        return {
+            "lag_p50_ms": round(statistics.median(s) * 1000, 2),
+            "lag_p99_ms": round(s[int(len(s) * 0.99) - 1 if len(s) > 1 else 0] * 1000, 2),
+            "lag_max_ms": round(s[-1] * 1000, 2),
+        }
+
+OUT = None  # файл --out: те же строки JSON, что и в stdout
+
+def emit(scenario:str, **fields):
+    line = json.dumps({"scenario": scenario, **fields}, ensure_ascii=False)
+    print(line, flush=True)
+    if OUT is not None:
+        OUT.write(line + "\n")
+        OUT.flush()
+
+def run_meta(args) -> dict:
+    # чтобы результаты разных коммитов и машин можно было честно сравнивать
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                    text=True, cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip())
+    except Exception:
+        commit, dirty = "", False
+    import sqlite3
+    return dict(commit=commit, dirty=dirty, started=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                sqlite=sqlite3.sqlite_version, cpus=os.cpu_count(), machine=platform.machine(),
+                args={k: v for k, v in vars(args).items() if k not in ("out", "old", "new")})
+
+def _pct(sorted_vals:list, q:float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * q))] if sorted_vals else 0.0
+
+# ---------- СЦЕНАРИИ ----------
+async def bench_ingest(args):
+    # run_all_sources целиком: три источника со stub-сервера, разбор, запись
+    _fresh_db("ingest.db")
+    runner = await start_feed_stub(args.delay, args.items, args.pages, args.cityads)
+    try:
+        lag = LoopLag()
+        lag.start()
+        t0 = time.perf_counter()
+        added = await main.run_all_sources()
+        elapsed = time.perf_counter() - t0
+        stats = await lag.stop()
+        # последовательный сбор занял бы не меньше суммы задержек всех источников
+        emit("ingest", cityads=args.cityads, items=args.items, pages=args.pages, added=added,
+             elapsed_s=round(elapsed, 3), serial_floor_s=round(args.delay * (2 + args.pages), 3), **stats)
+    finally:
+        await main.close_http()
+        await runner.cleanup()
+
+def _match_loop(aliases, text):
+    # прежний способ: подстрока по каждому алиасу
+    t = text.lower()
+    for k, v in aliases.items():
+        if k in t:
+            return v
+    return None
+
+async def bench_match(args):
+    aliases = dict(main.STORE_ALIASES)
+    for i in range(args.aliases - len(aliases)):
+        aliases[f"магазин{i:04d}"] = f"shop_{i}"
+    matcher = main.StoreMatcher(aliases)
+    names = list(aliases)
+    texts = [
+        f"Скидка {i % 50}% на заказ в {names[(i * 7919) % len(names)]} по промокоду" if i % 4
+        else f"Распродажа без магазина в названии номер {i}"
+        for i in range(args.items)
+    ]
+    t0 = time.perf_counter()
+    old = [_match_loop(aliases, t) for t in texts]
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    new = [matcher.match(t) for t in texts]
+    t_matcher = time.perf_counter() - t0
+    emit("match", aliases=len(aliases), items=len(texts),
+         loop_items_per_s=round(len(texts) / t_loop), matcher_items_per_s=round(len(texts) / t_matcher),
+         speedup=round(t_loop / t_matcher, 1),
+         same_result=round(sum(a == b for a, b in zip(old, new)) / len(texts), 4))
+
+def gen_deals(n:int, seed:int=0, end_at:str="2099-12-31 23:59:59") -> list:
+    return [main.Deal(
+        store_slug=main.POPULAR_STORES[i % len(main.POPULAR_STORES)],
+        title=f"Скидка {i % 50}% #{i}", description="Описание акции " * 4,
+        url=f"https://shop.example/p/{seed}/{i}", coupon_code=f"C{seed}X{i}" if i % 3 else "",
+        start_at="2026-01-01 00:00:00", end_at=end_at, source="bench", score=1.0 + (i % 7) / 10,
+    ) for i in range(n)]
+
+def _fresh_db(name:str):
+    # каждый сценарий со своей БД
+    main.close_storage()
+    main.DB_PATH = os.path.join(_TMP, name)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(main.DB_PATH + suffix)
+        except FileNotFoundError:
+            pass
+    main.init_db()
+    # кэши процесса помнят сделки прошлой БД: отпечаток из неё отсёк бы новую вставку
+    main.DEAL_FILTER.clear()
+    main.RENDER_CACHE.clear()
+    main.SEARCH_CACHE = main.SearchCache(main.SEARCH_CACHE_SIZE, main.SEARCH_CACHE_TTL, main.SEARCH_CACHE_TOP_N)
+    main.TEXT_STATS = main.TextStats(main.TEXT_STATS_TTL)
+
+def _legacy_put(deals) -> int:
+    # прежний put_deals_bulk: INSERT на строку + IntegrityError на дубль
+    import sqlite3
+    keys = main._DEAL_KEYS
+    rows = []
+    for d in deals:
+        raw = (d.url or "") + "|" + (d.title or "") + "|" + (d.coupon_code or "")
+        rows.append(d._replace(hash=hashlib.sha256(raw.encode("utf-8")).hexdigest())[:len(keys)])
+    def tx(conn):
+        inserted = 0
+        for row in rows:
+            try:
+                conn.execute(f"INSERT INTO deals({','.join(keys)}) VALUES({','.join('?' * len(keys))})", row)
+                inserted += 1
+            except sqlite3.IntegrityError:
+                pass
+        conn.commit()
+        return inserted
+    return main.storage().write(tx)
+
+def _timed(fn, *a):
+    t0 = time.perf_counter()
+    res = fn(*a)
+    return res, time.perf_counter() - t0
+
+async def bench_upsert(args):
+    n = args.items
+    fresh, changed = gen_deals(n), gen_deals(n, end_at="2100-06-30 00:00:00")
+    # повторный сбор: у каждой 10-й сделки продлили end_at, остальные без изменений
+    rescrape = [changed[i] if i % 10 == 0 else fresh[i] for i in range(n)]
+
+    _fresh_db("upsert-legacy.db")
+    ins, t_ins = _timed(_legacy_put, fresh)
+    _, t_dup = _timed(_legacy_put, rescrape)
+    emit("upsert", impl="legacy", rows=n, insert_rows_per_s=round(n / t_ins), rescrape_rows_per_s=round(n / t_dup),
+         inserted=ins, updated=0)
+
+    _fresh_db("upsert-bulk.db")
+    (ins, _), t_ins = _timed(main.upsert_deals_bulk, fresh)
+    (ins2, upd), t_dup = _timed(main.upsert_deals_bulk, rescrape)
+    emit("upsert", impl="bulk", rows=n, insert_rows_per_s=round(n / t_ins), rescrape_rows_per_s=round(n / t_dup),
+         inserted=ins + ins2, updated=upd)
+
+def gen_cross_source(n:int) -> list:
+    # один и тот же купон из трёх источников: разные ссылки с трекингом и запись кода
+    out = []
+    for i in range(n):
+        slug = main.POPULAR_STORES[i % len(main.POPULAR_STORES)]
+        code = f"DEAL{i:06d}" if i % 4 else ""
+        base = main.Deal(store_slug=slug, title="", description="", url="", coupon_code="",
+                         start_at=None, end_at="2099-12-31 23:59:59", source="", score=0)
+        out.append(base._replace(title=f"Скидка #{i}", url=f"https://www.shop.example/p/{i}/?subid=adm{i}&utm_source=admitad",
+                                 coupon_code=code, source="admitad", score=1.0 + (0.4 if code else 0)))
+        out.append(base._replace(title=f"{slug}: скидка #{i}", url=f"https://shop.example/p/{i}?utm_source=cityads&erid=x{i}",
+                                 coupon_code=code.lower(), source="cityads", score=0.9 + (0.4 if code else 0),
+                                 end_at="2100-01-31 23:59:59"))
+        out.append(base._replace(title=f"RSS #{i}", url=f"https://shop.example/p/{i}/?gclid={i}",
+                                 coupon_code=f" {code}\u200b" if code else "", source="cityads_rss", score=0.7))
+    return out
+
+async def bench_dedup(args):
+    # строк в БД и скорость повторного сбора: прежний ключ url|title|code vs канонический + фильтр в памяти
+    deals = gen_cross_source(args.items)
+    _fresh_db("dedup-legacy.db")
+    _legacy_put(deals)
+    legacy_rows = main.storage().read(lambda conn: conn.execute("SELECT COUNT(*) FROM deals").fetchone()[0])
+    _fresh_db("dedup.db")
+    main.DEAL_FILTER.clear()
+    (ins, _), t_first = _timed(main.upsert_deals_bulk, deals)
+    rows = main.storage().read(lambda conn: conn.execute("SELECT COUNT(*) FROM deals").fetchone()[0])
+    _, t_filtered = _timed(main.upsert_deals_bulk, deals)
+    main.DEAL_FILTER.clear()
+    _, t_unfiltered = _timed(main.upsert_deals_bulk, deals)
+    emit("dedup", records=len(deals), legacy_rows=legacy_rows, rows=rows, inserted=ins,
+         first_rows_per_s=round(len(deals) / t_first),
+         rescrape_rows_per_s_filter=round(len(deals) / t_filtered),
+         rescrape_rows_per_s_no_filter=round(len(deals) / t_unfiltered))
+
+async def bench_page(args):
+    # листание одного магазина: seek по курсору vs OFFSET на той же глубине
+    _fresh_db("page.db")
+    deals = [d._replace(store_slug="ozon") for d in gen_deals(args.items)]
+    main.put_deals_bulk(deals)
+    size = main.PAGE_SIZE
+    offset_sql = main._SEARCH_SQL.replace("LIMIT ?", "LIMIT ? OFFSET ?")
+    rows = main.search_deals("ozon", limit=size + 1)
+    page, marks = 1, {1, 10, 100, 1000, 5000}
+    while rows and page <= max(marks):
+        if page in marks:
+            after_id = rows[size - 1].id
+            _, t_seek = _timed(lambda: [main.search_deals_after(after_id, size + 1) for _ in range(20)])
+            _, t_off = _timed(lambda: [main.storage().read(
+                lambda conn: conn.execute(offset_sql, ("ozon", 0, size + 1, page * size)).fetchall()
+            ) for _ in range(20)])
+            emit("page", rows=args.items, page=page + 1, seek_ms=round(t_seek / 20 * 1000, 3),
+                 offset_ms=round(t_off / 20 * 1000, 3))
+        if len(rows) <= size:
+            break
+        rows = main.search_deals_after(rows[size - 1].id, size + 1)
+        page += 1
+
+async def bench_fanout(args):
+    # args.users подписчиков ozon (каждый десятый ещё и wildberries), после сбора появились
+    # новые сделки обоих магазинов. Посреди рассылки процесс «падает» и стартует заново.
+    _fresh_db("fanout.db")
+    until = "2099-01-01T00:00:00"
+    def seed(conn):
+        with conn:
+            conn.executemany("INSERT INTO subscriptions(user_id, status, until) VALUES(?, 'active', ?)",
+                             ((1000 + i, until) for i in range(args.users)))
+            conn.executemany("INSERT INTO watches(store_slug, user_id, created_ts) VALUES(?,?,0)",
+                             (("ozon", 1000 + i) for i in range(args.users)))
+            conn.executemany("INSERT INTO watches(store_slug, user_id, created_ts) VALUES(?,?,0)",
+                             (("wildberries", 1000 + i) for i in range(0, args.users, 10)))
+    main.storage().write(seed)
+    main.enqueue_new_deals()  # отметка: старое не рассылаем
+    fresh = [d._replace(store_slug="ozon" if i % 2 else "wildberries") for i, d in enumerate(gen_deals(14, seed=5))]
+    main.put_deals_bulk(fresh)
+    (deals, queued), t_enq = _timed(main.enqueue_new_deals)
+    rendered = main.storage().read(lambda conn: conn.execute("SELECT COUNT(*) FROM push_messages").fetchone()[0])
+    emit("fanout", step="enqueue", users=args.users, new_deals=deals, rendered_messages=rendered,
+         queued=queued, elapsed_s=round(t_enq, 3))
+
+    api = await FakeBotAPI(global_rate=10**6).start()
+    bot = api.bot()
+    main.SEND_QUEUE = main.SendQueue(rate=5000, burst=200, chat_interval=main.SEND_CHAT_INTERVAL)
+    main.PUSH_INFLIGHT = 200
+    left = lambda: main.storage().read(lambda conn: conn.execute("SELECT COUNT(*) FROM push_queue").fetchone()[0])
+    lag = LoopLag()
+    lag.start()
+    t0 = time.perf_counter()
+    push = main.PushDispatcher()
+    push.start(bot)
+    while api.delivered < queued // 2:
+        await asyncio.sleep(0.05)
+    push._task.cancel()  # «падение» посреди рассылки: текущая пачка не отмечена
+    with contextlib.suppress(asyncio.CancelledError):
+        await push._task
+    remaining = left()
+    push = main.PushDispatcher()
+    push.start(bot)
+    while left():
+        await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - t0
+    await push.stop()
+    stats = await lag.stop()
+    emit("fanout", step="send", queued=queued, delivered=api.delivered, duplicates=api.delivered - queued,
+         left_at_restart=remaining, flood_429=api.flood, elapsed_s=round(elapsed, 2),
+         msgs_per_s=round(api.delivered / elapsed), at_send_rate_s=round(queued / main.SEND_RATE), **stats)
+    await bot.session.close()
+    await api.stop()
+
+PRODUCTS = ["айфон", "кроссовки", "холодильник", "наушники", "пылесос", "куртка", "ноутбук", "телевизор",
+            "кофеварка", "самокат", "рюкзак", "смартфон", "монитор", "кресло", "палатка", "часы"]
+
+async def bench_fts(args):
+    # ранжированный текстовый поиск по таблице на args.items сделок + нечёткое распознавание магазина
+    _fresh_db("fts.db")
+    deals = [d._replace(title=f"{PRODUCTS[i % len(PRODUCTS)]} {PRODUCTS[(i * 7) % len(PRODUCTS)]} -{i % 50}% #{i}",
+                        description=f"Скидка на {PRODUCTS[(i * 3) % len(PRODUCTS)]} по промокоду")
+             for i, d in enumerate(gen_deals(args.items))]
+    t0 = time.perf_counter()
+    main.put_deals_bulk(deals)
+    emit("fts", step="load", rows=args.items, insert_rows_per_s=round(args.items / (time.perf_counter() - t0)))
+    cases = [("common", "скидка", None), ("product", "кроссовки", None), ("two_words", "айфон наушники", None),
+             ("store+word", "айфон", "ozon"), ("rare", f"#{args.items - 1}", None), ("miss", "холодос", None)]
+    for name, text, slug in cases:
+        n = max(20, args.queries // 20)
+        lat = []
+        for _ in range(n):
+            t = time.perf_counter()
+            rows = main.search_text(text, slug)
+            lat.append(time.perf_counter() - t)
+        cold = lat[0]  # первый запрос считает df термов, дальше они из кэша
+        lat.sort()
+        emit("fts", step="query", case=name, found=len(rows), cold_ms=round(cold * 1000, 2), p50_ms=round(statistics.median(lat) * 1000, 2),
+             p99_ms=round(lat[int(len(lat) * 0.99) - 1] * 1000, 2))
+    queries = ["wildberies", "озн", "яндекс маркт", "алиэкспрес", "ozon", "совсем не магазин"] * (args.queries // 6)
+    t = time.perf_counter()
+    resolved = sum(1 for q in queries if main.STORE_RESOLVER.resolve(q))
+    elapsed = time.perf_counter() - t
+    emit("fts", step="resolve", queries=len(queries), resolved=resolved,
+         us_per_query=round(elapsed / len(queries) * 1e6, 1))
+
+async def bench_search(args):
+    _fresh_db("search.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    slugs = main.POPULAR_STORES
+    # трафик сосредоточен на нескольких магазинах: ~Zipf по индексу
+    queries = [slugs[min(int(len(slugs) * (i * 0.618 % 1) ** 3), len(slugs) - 1)] for i in range(args.queries)]
+    for label, top_n in (("no_cache", 0), ("cache", main.SEARCH_CACHE_TOP_N)):
+        main.SEARCH_CACHE = main.SearchCache(main.SEARCH_CACHE_SIZE, main.SEARCH_CACHE_TTL, top_n)
+        t0 = time.perf_counter()
+        for q in queries:
+            main.search_deals(q, limit=8)
+        elapsed = time.perf_counter() - t0
+        emit("search", mode=label, deals=args.items, queries=len(queries),
+             qps=round(len(queries) / elapsed), **main.SEARCH_CACHE.stats())
+
+class _LockedStorage(main.Storage):
+    # прежняя схема для сравнения: одна блокировка на все чтения и записи
+    def __init__(self, path, readers):
+        super().__init__(path, readers)
+        self._global = threading.RLock()
+
+    def read(self, fn, *args):
+        with self._global:
+            return super().read(fn, *args)
+
+    def _write_loop(self):
+        while True:
+            job = self._writes.get()
+            if job is None:
+                return
+            fn, args, fut, _ = job
+            with self._global:
+                try:
+                    fut.set_result(fn(self._wconn, *args))
+                except BaseException as e:
+                    fut.set_exception(e)
+
+async def bench_storage(args):
+    # чтения (мимо кэша) в N потоков, пока писатель непрерывно обновляет пачки
+    _fresh_db("storage.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    slugs = main.POPULAR_STORES
+    for layout, cls in (("global_lock", _LockedStorage), ("rw_split", main.Storage)):
+        for readers in (1, 2, 4):
+            main.close_storage()
+            main._STORAGE = cls(main.DB_PATH, readers)
+            stop = threading.Event()
+            writes = [0]
+
+            def writer():
+                k = 0
+                while not stop.is_set():
+                    # тот же объём строк, другой end_at => реальные UPDATE, размер таблицы постоянный
+                    main.upsert_deals_bulk(gen_deals(args.items, end_at=f"2099-01-{k % 28 + 1:02d} 00:00:00"))
+                    writes[0] += args.items
+                    k += 1
+
+            def reader(lat, k):
+                now_iso = main._now_iso_naive_utc()
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    main.storage().read(main._search_query, slugs[k % len(slugs)], now_iso, 8)
+                    lat.append(time.perf_counter() - t0)
+                    k += 1
+
+            lats = [[] for _ in range(readers)]
+            threads = [threading.Thread(target=writer)] + [
+                threading.Thread(target=reader, args=(lat, i)) for i, lat in enumerate(lats)
+            ]
+            for t in threads:
+                t.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            all_lat = sorted(x for lat in lats for x in lat) or [0.0]
+            emit("storage", layout=layout, readers=readers, cpus=os.cpu_count(),
+                 reads_per_s=round(len(all_lat) / args.seconds),
+                 read_p99_ms=round(all_lat[int(len(all_lat) * 0.99) - 1 if len(all_lat) > 1 else 0] * 1000, 2),
+                 read_max_ms=round(all_lat[-1] * 1000, 2),
+                 rows_written_per_s=round(writes[0] / args.seconds))
+    main.close_storage()
+
+async def bench_plan(args):
+    # горячий запрос /search должен идти по idx_deals_hot без сортировки во временном B-дереве
+    _fresh_db("plan.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    plan = main.storage().read(main.search_plan)
+    ok = any("idx_deals_hot" in p for p in plan) and not any("TEMP B-TREE" in p for p in plan)
+    now_ts = int(time.time())
+    t0 = time.perf_counter()
+    for i in range(args.queries):
+        main.storage().read(main._search_query, main.POPULAR_STORES[i % len(main.POPULAR_STORES)], now_ts, 8)
+    emit("plan", deals=args.items, plan=plan, index_serves_sort=ok,
+         uncached_query_us=round((time.perf_counter() - t0) / args.queries * 1e6, 1))
+    if not ok:
+        sys.exit(1)
+
+def _legacy_cleanup(threshold:int) -> float:
+    # прежний cleanup_old: один DELETE с OR на весь объём, без VACUUM
+    def tx(conn):
+        t0 = time.perf_counter()
+        with conn:
+            conn.execute("DELETE FROM deals WHERE end_ts < ? OR created_ts < ?", (threshold, threshold))
+        return time.perf_counter() - t0
+    return main.storage().write(tx)
+
+async def bench_cleanup(args):
+    # половина сделок просрочена; параллельно пишет «пользователь» — меряем его задержку
+    for impl in ("legacy", "chunked"):
+        _fresh_db(f"cleanup-{impl}.db")
+        main.upsert_deals_bulk(gen_deals(args.items // 2) + gen_deals(args.items // 2, seed=1, end_at="2001-01-01 00:00:00"))
+        main.storage().write(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+        stop = threading.Event()
+        lat = []
+
+        def user_writes():
+            uid = 0
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                main.upsert_user(uid, "bench")
+                lat.append(time.perf_counter() - t0)
+                uid += 1
+                time.sleep(0.002)
+
+        t = threading.Thread(target=user_writes)
+        t.start()
+        size_before = os.path.getsize(main.DB_PATH)
+        t0 = time.perf_counter()
+        if impl == "legacy":
+            held = _legacy_cleanup(int(time.time()) - 60 * 86400)
+            stats = {"lock_held_s": round(held, 3)}
+        else:
+            stats = main.cleanup_old(60)
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        t.join()
+        lat.sort()
+        emit("cleanup", impl=impl, deals=args.items, elapsed_s=round(elapsed, 3),
+             file_bytes_before=size_before, file_bytes_after=os.path.getsize(main.DB_PATH),
+             user_write_max_ms=round(lat[-1] * 1000, 1) if lat else None, **stats)
+
+async def bench_coalesce(args):
+    # N пользователей одновременно ищут пустой магазин: сколько запросов ушло к источникам
+    _fresh_db("coalesce.db")
+    runner = await start_feed_stub(args.delay, args.items, args.pages)
+    try:
+        await main.run_all_sources()  # прогрев: узнаём кампании Admitad по магазинам
+        STUB_HITS.clear()
+        main.REFRESH = main.SingleFlight()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            main.REFRESH.do(("store", "ozon"), main.refresh_store, "ozon", cooldown=main.REFRESH_COOLDOWN)
+            for _ in range(args.users)
+        ))
+        emit("coalesce", users=args.users, elapsed_s=round(time.perf_counter() - t0, 3),
+             upstream_requests=dict(STUB_HITS),
+             admitad_campaigns=sorted(main.ADMITAD_CAMPAIGNS.get("ozon", ())))
+    finally:
+        await main.close_http()
+        await runner.cleanup()
+
+async def bench_sched(args):
+    # Плановый сбор в сжатом времени (база 1 с вместо 30 мин), args.seconds с реального
+    # AsyncIOScheduler: источник, где новое есть всегда; мёртвый; падающий первые 4 запуска;
+    # медленный (сбор 3 с при интервале 1 с). Сравнение — с прежним общим интервалом.
+    import logging, random
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    logging.getLogger("apscheduler").setLevel(logging.ERROR)
+    _fresh_db("sched.db")
+    rnd = random.Random(1)
+    active = {"slow": 0}
+    peak = {"slow": 0}
+    calls = {"hot": 0, "dead": 0, "flaky": 0, "slow": 0}
+    async def hot():
+        calls["hot"] += 1
+        return rnd.randint(1, 50)
+    async def dead():
+        calls["dead"] += 1
+        return 0
+    async def flaky():
+        calls["flaky"] += 1
+        if calls["flaky"] <= 4:
+            raise RuntimeError("upstream 502")
+        return rnd.randint(0, 3)
+    async def slow():
+        calls["slow"] += 1
+        active["slow"] += 1
+        peak["slow"] = max(peak["slow"], active["slow"])
+        await asyncio.sleep(3)
+        active["slow"] -= 1
+        return 1
+    base = 1.0
+    _fresh_db("sched.db")  # run_source сохраняет срок следующего запуска в source_state
+    main.SCRAPE_START_DELAY = 0
+    main.SOURCES = {name: main.SourceJob(name, fn, base, base / 4, 8 * base)
+                    for name, fn in (("hot", hot), ("dead", dead), ("flaky", flaky), ("slow", slow))}
+    main.REFRESH = main.SingleFlight()
+    main.scheduler = AsyncIOScheduler()
+    main.schedule_sources(main.scheduler)
+    main.scheduler.start()
+    await asyncio.sleep(args.seconds)
+    main.scheduler.shutdown(wait=False)
+    while main.REFRESH._inflight:  # дать начатым сборам завершиться
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(0.05)
+    for name, src in main.SOURCES.items():
+        emit("sched", source=name, seconds=args.seconds, pulls=calls[name],
+             fixed_interval_pulls=int(args.seconds / base), runs_recorded=src.runs, added=src.added,
+             interval_s=round(src.interval, 2), next_delay_s=round(src.delay, 2), failures=src.failures,
+             max_overlap=peak.get(name, 1))
+
+def _scrape_means(text:str, names) -> dict:
+    # из выгрузки /metrics: {ряд: [count, mean_ms]} для гистограмм с заданными именами
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        for name in names:
+            for suffix, into in (("_sum", sums), ("_count", counts)):
+                if series.startswith(name + suffix):
+                    into[name + series[len(name + suffix):]] = float(value)
+    return {k: [int(counts[k]), round(sums[k] / counts[k] * 1000, 3)] for k in counts if counts[k]}
+
+async def bench_metrics(args):
+    # Стоимость инструментирования на горячем пути (storage().read) и пример выгрузки
+    # /metrics после сбора источников с stub-сервера и параллельных /search.
+    import socket
+    _fresh_db("metrics.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    noop = lambda *a, **k: None
+    ping = lambda conn: conn.execute("SELECT 1").fetchone()
+    n = 20000
+    for label in ("off", "on"):
+        saved = main.DB_WAIT_SECONDS.observe, main.DB_HOLD_SECONDS.observe
+        if label == "off":
+            main.DB_WAIT_SECONDS.observe = main.DB_HOLD_SECONDS.observe = noop
+        t0 = time.perf_counter()
+        for _ in range(n):
+            main.storage().read(ping)
+        elapsed = time.perf_counter() - t0
+        main.DB_WAIT_SECONDS.observe, main.DB_HOLD_SECONDS.observe = saved
+        emit("metrics", step="overhead", instrumentation=label, reads=n, us_per_read=round(elapsed / n * 1e6, 2))
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        main.METRICS_PORT = sock.getsockname()[1]
+    runner = await main.start_metrics_server()
+    stub = await start_feed_stub(args.delay, args.items, args.pages)
+    lag = main.LoopLagMonitor(0.05)
+    lag.start()
+    try:
+        stop = time.perf_counter() + args.seconds
+        async def searcher(i):
+            while time.perf_counter() < stop:
+                await main.asearch_deals(main.POPULAR_STORES[i % len(main.POPULAR_STORES)], limit=8)
+        await asyncio.gather(main.run_all_sources(), *(searcher(i) for i in range(8)))
+        t0 = time.perf_counter()
+        async with aiohttp.ClientSession() as s:
+            async with s.get(f"http://127.0.0.1:{main.METRICS_PORT}/metrics") as resp:
+                text = await resp.text()
+        scrape_ms = round((time.perf_counter() - t0) * 1000, 2)
+    finally:
+        await lag.stop()
+        await main.close_http()
+        await stub.cleanup()
+        await runner.cleanup()
+    emit("metrics", step="scrape", bytes=len(text), series=sum(1 for l in text.splitlines() if not l.startswith("#")),
+         scrape_ms=scrape_ms, count_mean_ms=_scrape_means(text, ("halyava_db_wait_seconds", "halyava_db_hold_seconds",
+                                                               "halyava_source_seconds", "halyava_loop_lag_seconds")),
+         cache=[l for l in text.splitlines() if l.startswith("halyava_cache_requests_total")])
+
+async def bench_send(args):
+    # args.users пользователей одновременно получают выдачу /search из 8 сделок
+    # описание экранируется в fmt_deal
+    deals = [d._replace(description="Скидка <b>до 50%</b> & бесплатная доставка") for d in gen_deals(8)]
+    # queued_serial — очередь с одним запросом в полёте (как было), queued — SEND_INFLIGHT;
+    # Bot API отвечает за 50 мс, как настоящий из РФ
+    for impl in ("legacy", "queued_serial", "queued"):
+        api = await FakeBotAPI(latency=0.05).start()
+        bot = api.bot()
+        failed = 0
+        t0 = time.perf_counter()
+        if impl == "legacy":
+            async def one(chat_id):
+                nonlocal failed
+                for d in deals:
+                    try:
+                        await bot.send_message(chat_id, main.fmt_deal(d), disable_web_page_preview=True)
+                    except Exception:
+                        try:
+                            await bot.send_message(chat_id, main._strip_tags(main.fmt_deal(d)), disable_web_page_preview=True)
+                        except Exception:
+                            failed += 1
+        else:
+            main.SEND_QUEUE = main.SendQueue(main.SEND_RATE, main.SEND_BURST, main.SEND_CHAT_INTERVAL,
+                                             1 if impl == "queued_serial" else main.SEND_INFLIGHT)
+
+            async def one(chat_id):
+                nonlocal failed
+                for text in main.pack_messages([main.fmt_deal(d) for d in deals]):
+                    try:
+                        await main.SEND_QUEUE.send_text(bot, chat_id, text, disable_web_page_preview=True)
+                    except Exception:
+                        failed += 1
+        await asyncio.gather(*(one(1000 + i) for i in range(args.users)))
+        emit("send", impl=impl, users=args.users, elapsed_s=round(time.perf_counter() - t0, 3),
+             api_calls=api.calls, delivered=api.delivered, flood_429=api.flood, failed=failed)
+        await bot.session.close()
+        await api.stop()
+
+async def bench_admitad(args):
+    # 1) первый сбор; 2) повтор без изменений; 3) в начало выдачи добавились новые купоны
+    _fresh_db("admitad.db")
+    runner = await start_feed_stub(0, args.items, 0)
+    main.CITYADS_COUPONS_URL = ""
+    try:
+        for step in ("initial", "unchanged", "new_on_top"):
+            if step == "new_on_top":
+                fresh = json.loads(gen_admitad(args.items // 20, seed=7))["results"]
+                STUB_ADMITAD["items"] = fresh + STUB_ADMITAD["items"]
+            STUB_HITS.clear()
+            STUB_BYTES.clear()
+            t0 = time.perf_counter()
+            added = await main.pull_admitad()
+            emit("admitad", step=step, feed_items=len(STUB_ADMITAD["items"]), added=added,
+                 requests=STUB_HITS.get("admitad", 0), bytes=STUB_BYTES.get("admitad", 0),
+                 elapsed_s=round(time.perf_counter() - t0, 3))
+    finally:
+        await main.close_http()
+        await runner.cleanup()
+
+async def bench_crawl(args):
+    # 1) первый обход; 2) плановый сразу следом — срок ни у кого не подошёл;
+    # 3) срок подошёл у всех, изменилось 5% страниц; 4) прошёл ещё один период (PROMO_MIN_INTERVAL):
+    # неизменные страницы уже на удвоенном интервале. Прежний код каждый раз качал и разбирал всё.
+    _fresh_db("crawl.db")
+    runner = await start_feed_stub(args.delay, 0, args.pages)
+    parsed = []
+    real_parse = main.parse_promo_page
+    def counting_parse(*a):
+        parsed.append(1)
+        return real_parse(*a)
+    main.parse_promo_page = counting_parse
+    main.PARSE_WORKERS = 0  # счётчик разборов виден только в этом процессе
+    try:
+        def shift(sql):
+            main.storage().write(lambda conn: conn.execute(sql).connection.commit())
+        for step in ("initial", "not_due", "due_5pct_changed", "next_period"):
+            if step == "due_5pct_changed":
+                shift("UPDATE source_state SET next_ts=0")
+                for n in range(0, args.pages, 20):
+                    STUB_PROMO["version"][n] = 1
+            if step == "next_period":
+                shift(f"UPDATE source_state SET next_ts=next_ts-{main.PROMO_MIN_INTERVAL}")
+            STUB_HITS.clear()
+            STUB_BYTES.clear()
+            STUB_PROMO["peak"] = 0
+            parsed.clear()
+            t0 = time.perf_counter()
+            added = await main.pull_official_pages()
+            emit("crawl", step=step, pages=args.pages, requests=STUB_HITS.get("promo", 0),
+                 bytes=STUB_BYTES.get("promo", 0), parsed=len(parsed), added=added,
+                 peak_per_host=STUB_PROMO["peak"], elapsed_s=round(time.perf_counter() - t0, 3))
+    finally:
+        main.parse_promo_page = real_parse
+        await main.close_http()
+        await runner.cleanup()
+
+# Пик памяти самого разбора — tracemalloc вокруг вызова: ru_maxrss процесса почти целиком
+# занят импортом main (aiogram, ~570 МБ) и разницу между режимами не видит. Тело фида
+# читается до старта трассировки: в пик входит только то, что строит парсер.
+_PARSE_PEAK_CODE = """
+import sys, time, tracemalloc, main
+path, mode = sys.argv[1], sys.argv[2]
+is_json = path.endswith(".json")
+body = None
+if mode != "stream":
+    with open(path, "rb") as f:
+        body = f.read()
+tracemalloc.start()
+t0 = time.perf_counter()
+if mode == "stream":
+    n = len(main.parse_cityads_file(path, is_json))
+else:
+    n = len(main.parse_cityads(body, is_json))
+elapsed = time.perf_counter() - t0
+print(n, tracemalloc.get_traced_memory()[1], elapsed)
+"""
+
+async def bench_parse(args):
+    # 1) пик памяти разбора: тело целиком (feedparser / json.loads) vs потоковый разбор файла
+    #    (iterparse / _JsonStream), каждый в своём процессе
+    # 2) задержки event loop, пока идёт разбор: в пуле процессов vs в потоке
+    json_path = os.path.join(_TMP, "feed.json")
+    with open(json_path, "wb") as f:
+        f.write(gen_cityads_json(args.items))
+    path = os.path.join(_TMP, "feed.rss")
+    with open(path, "wb") as f:
+        f.write(gen_rss(args.items))
+    for feed, fpath, modes in (("rss", path, ("feedparser", "stream")),
+                               ("json", json_path, ("json_loads", "stream"))):
+        size = os.path.getsize(fpath)
+        for mode in modes:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", _PARSE_PEAK_CODE, fpath, mode,
+                stdout=asyncio.subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            out, _ = await proc.communicate()
+            n, peak, elapsed = out.split()
+            emit("parse", step="peak_mem", feed=feed, mode=mode, feed_bytes=size, records=int(n),
+                 parse_peak_mb=round(int(peak) / 2**20, 1), elapsed_s=round(float(elapsed), 3))
+    with open(path, "rb") as f:
+        body = f.read()
+    for workers in (0, 2):
+        main.PARSE_WORKERS = workers
+        if workers:
+            await main.run_parser(len, b"")  # поднять пул заранее, не считать старт процессов
+        lag = LoopLag()
+        lag.start()
+        t0 = time.perf_counter()
+        records = await main.run_parser(main.parse_cityads, body, False)
+        elapsed = time.perf_counter() - t0
+        stats = await lag.stop()
+        emit("parse", step="loop_lag", workers=workers, records=len(records),
+             elapsed_s=round(elapsed, 3), **stats)
+    main.shutdown_parse_pool()
+
+async def bench_bulk(args):
+    # put_deals_bulk на пустую БД и повторный сбор того же объёма (у каждой 10-й сделки
+    # продлён срок) для каждого размера из --sizes; подаём кусками по 100k, как большой фид
+    import resource
+    chunk = 100_000
+    for n in args.sizes:
+        _fresh_db(f"bulk-{n}.db")
+        t_ins = t_re = 0.0
+        inserted = updated = 0
+        for seed, lo in enumerate(range(0, n, chunk)):
+            part = gen_deals(min(chunk, n - lo), seed=seed)
+            (ins, _), dt = _timed(main.upsert_deals_bulk, part)
+            t_ins += dt
+            inserted += ins
+        for seed, lo in enumerate(range(0, n, chunk)):
+            size = min(chunk, n - lo)
+            fresh, longer = gen_deals(size, seed=seed), gen_deals(size, seed=seed, end_at="2100-06-30 00:00:00")
+            part = [longer[i] if i % 10 == 0 else fresh[i] for i in range(size)]
+            (_, upd), dt = _timed(main.upsert_deals_bulk, part)
+            t_re += dt
+            updated += upd
+        main.storage().write(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+        emit("bulk", rows=n, inserted=inserted, updated=updated,
+             insert_rows_per_s=round(n / t_ins), rescrape_rows_per_s=round(n / t_re),
+             db_mb=round(os.path.getsize(main.DB_PATH) / 2**20, 1),
+             peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+async def bench_load(args):
+    # args.users одновременных /search (трафик ~Zipf по магазинам) в течение args.seconds
+    # через asearch_deals — как из хендлера; без кэша выдачи и с ним
+    _fresh_db("load.db")
+    for lo in range(0, args.items, 100_000):
+        main.upsert_deals_bulk(gen_deals(min(100_000, args.items - lo), seed=lo))
+    slugs = main.POPULAR_STORES
+    queries = [slugs[min(int(len(slugs) * (i * 0.618 % 1) ** 3), len(slugs) - 1)] for i in range(1000)]
+    for label, top_n in (("no_cache", 0), ("cache", main.SEARCH_CACHE_TOP_N)):
+        main.SEARCH_CACHE = main.SearchCache(main.SEARCH_CACHE_SIZE, main.SEARCH_CACHE_TTL, top_n)
+        lat = []
+        stop = time.perf_counter() + args.seconds
+        async def user(i):
+            k = i
+            while time.perf_counter() < stop:
+                t0 = time.perf_counter()
+                await main.asearch_deals(queries[k % len(queries)], limit=8)
+                lat.append(time.perf_counter() - t0)
+                k += args.users
+                await asyncio.sleep(0)  # ответ из кэша не уступает loop сам — а следующий апдейт пришёл бы отдельно
+        lag = LoopLag()
+        lag.start()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - t0
+        stats = await lag.stop()
+        lat.sort()
+        emit("load", mode=label, deals=args.items, users=args.users, requests=len(lat),
+             qps=round(len(lat) / elapsed), p50_ms=round(_pct(lat, 0.5) * 1000, 3),
+             p95_ms=round(_pct(lat, 0.95) * 1000, 3), p99_ms=round(_pct(lat, 0.99) * 1000, 3), **stats)
+
+async def bench_fmt(args):
+    # fmt_deal и render_page на строках, как их отдаёт поиск (с HTML-символами для экранирования);
+    # страницы — без готового HTML (каждый блок рисуется и проверяется) и из RENDER_CACHE
+    deals = [d._replace(id=i + 1, hash=f"h{i}", end_ts=main.TS_NEVER, title=d.title + " <b>&</b>",
+                        price_new=990.0 if i % 4 == 0 else None, price_old=1490.0 if i % 8 == 0 else None,
+                        cashback=5.0 if i % 5 == 0 else None)
+             for i, d in enumerate(gen_deals(args.items))]
+    t0 = time.perf_counter()
+    total = sum(len(main.fmt_deal(d)) for d in deals)
+    t_fmt = time.perf_counter() - t0
+    pages = [deals[i:i + main.PAGE_SIZE + 1] for i in range(0, len(deals), main.PAGE_SIZE)]
+    main.RENDER_CACHE = main.RenderCache(max(main.RENDER_CACHE_SIZE, len(deals)))
+    t0 = time.perf_counter()
+    for rows in pages:
+        main.render_page(rows, True)
+    t_cold = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for rows in pages:
+        main.render_page(rows, True)
+    t_page = time.perf_counter() - t0
+    emit("fmt", deals=len(deals), deals_per_s=round(len(deals) / t_fmt), mb_per_s=round(total / t_fmt / 2**20, 1),
+         pages=len(pages), pages_per_s_uncached=round(len(pages) / t_cold), pages_per_s=round(len(pages) / t_page),
+         render_hits=main.RENDER_CACHE.hits, render_misses=main.RENDER_CACHE.misses)
+
+async def bench_deals(args):
+    # память на args.items сделок (tracemalloc, без строк, которые разделяются с исходными
+    # записями) на двух горячих путях: записи парсеров -> сделки и выдача из БД -> сделки;
+    # плюс время выборки args.items строк одного магазина
+    import tracemalloc
+    records = [("ozon", f"Скидка {i % 50}% #{i}", "Описание акции " * 4, f"https://shop.example/p/{i}",
+                f"C{i}", None, "2099-12-31 23:59:59", "bench", 1.0) for i in range(args.items)]
+    tracemalloc.start()
+    deals = main.deals_from_records(records)
+    from_records = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del deals
+    _fresh_db("deals.db")
+    main.put_deals_bulk(main.deals_from_records(records))
+    tracemalloc.start()
+    rows = main.storage().read(main._search_query, "ozon", 0, args.items)
+    from_db = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    _, t_fetch = _timed(lambda: [main.storage().read(main._search_query, "ozon", 0, args.items) for _ in range(3)])
+    emit("deals", items=args.items, records_mb=round(from_records / 2**20, 1), db_rows_mb=round(from_db / 2**20, 1),
+         fetch_ms=round(t_fetch / 3 * 1000), render_cached=len(main.RENDER_CACHE))
+
+async def bench_ratelimit(args):
+    # 1) цена допуска: take() по args.users разным пользователям, затем compact();
+    # 2) args.seconds виртуального времени: один пользователь шлёт 20 апдейтов/с,
+    #    до 1000 остальных — по одному раз в 10 с; сколько пропущено у тех и у других;
+    # 3) args.users одновременных «пустых магазинов»: сколько опросов источников стартовало
+    #    при SCRAPE_CONCURRENCY и per-user лимите (каждый опрос — 0.2 с)
+    lim = main.RateLimiter([main.CommandClass("read", main.RATE_USER_PER_MIN / 60, main.RATE_USER_BURST,
+                                              10**9, 10**9, 10**6, 0)])
+    users = [100_000 + i for i in range(args.users)]
+    t0 = time.perf_counter()
+    for u in users:
+        lim.take("read", u)
+    take_us = (time.perf_counter() - t0) / len(users) * 1e6
+    tracked = lim.tracked()
+    t0 = time.perf_counter()
+    for u in users:
+        lim.take("read", u)
+    hit_us = (time.perf_counter() - t0) / len(users) * 1e6
+    t0 = time.perf_counter()
+    dropped = lim.compact(time.monotonic() + main.RATE_USER_BURST / (main.RATE_USER_PER_MIN / 60) + 1)
+    compact_ms = (time.perf_counter() - t0) * 1000
+    emit("ratelimit", case="take", users=len(users), us_per_take_new=round(take_us, 3),
+         us_per_take_tracked=round(hit_us, 3), tracked=tracked, compact_ms=round(compact_ms, 2),
+         compacted=dropped, tracked_after=lim.tracked())
+
+    lim = main.RateLimiter([main.CommandClass("read", main.RATE_USER_PER_MIN / 60, main.RATE_USER_BURST,
+                                              main.RATE_GLOBAL_PER_S, main.RATE_GLOBAL_PER_S * 2, 10**6, 0)])
+    spam_sent = spam_ok = norm_sent = norm_ok = 0
+    base = time.monotonic()
+    events = [(k / 20, users[0]) for k in range(int(args.seconds * 20))]
+    events += [(j * 10 + i / 100, u) for i, u in enumerate(users[1:1001]) for j in range(int(args.seconds // 10))]
+    events.sort()
+    for ts, u in events:
+        ok, _ = lim.take("read", u, now=base + ts)
+        if u == users[0]:
+            spam_sent += 1
+            spam_ok += ok
+        else:
+            norm_sent += 1
+            norm_ok += ok
+    emit("ratelimit", case="fairness", users=min(len(users), 1001), seconds=args.seconds, spam_sent=spam_sent,
+         spam_admitted=spam_ok, normal_sent=norm_sent, normal_admitted=norm_ok,
+         rejected_global=lim.rejected.get(("read", "global"), 0))
+
+    lim = main.RateLimiter([main.CommandClass("scrape", 1 / main.SCRAPE_USER_COOLDOWN, 1, 10**9, 10**9,
+                                              main.SCRAPE_CONCURRENCY, 0)])
+    started = peak = 0
+    async def empty_store(u):
+        nonlocal started, peak
+        ok, _ = await lim.acquire("scrape", u)
+        if not ok:
+            return
+        started += 1
+        peak = max(peak, lim.classes["scrape"].active)
+        try:
+            await asyncio.sleep(0.2)
+        finally:
+            lim.release("scrape")
+    await asyncio.gather(*(empty_store(u) for u in users[:1000]))
+    await asyncio.gather(*(empty_store(users[0]) for _ in range(10)))
+    emit("ratelimit", case="scrape", users=min(len(users), 1000), concurrency=main.SCRAPE_CONCURRENCY,
+         started=started, peak_active=peak, rejected_busy=lim.rejected.get(("scrape", "busy"), 0),
+         rejected_user=lim.rejected.get(("scrape", "user"), 0))
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _bot_env(api:"FakeBotAPI", port:int, workers:int, secret:str, **extra) -> dict:
+    # окружение для `python main.py` в webhook-режиме против FakeBotAPI, без источников
+    return dict(os.environ, BOT_TOKEN="123456:" + "A" * 35, BOT_API_URL=api.base, DB_PATH=main.DB_PATH,
+                WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(port),
+                WEBHOOK_SECRET=secret, WEB_WORKERS=str(workers), SEND_RATE="1000000", SEND_BURST="1000000",
+                SEND_CHAT_INTERVAL="0", METRICS_PORT="0", LOG_LEVEL="WARNING", ADMITAD_WEBSITE_ID="",
+                CITYADS_COUPONS_URL="", OFFICIAL_PROMO_PAGES="", SUB_CACHE_WARM="1",
+                RATE_USER_PER_MIN="1000000", RATE_USER_BURST="1000000", RATE_GLOBAL_PER_S="1000000") | extra
+
+def _update(update_id:int, user_id:int, text:str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": user, "text": text}}
+
+async def bench_webhook(args):
+    # webhook-режим как в проде: `python main.py` с WEBHOOK_URL и WEB_WORKERS процессами,
+    # генератор шлёт синтетические апдейты /search по 32 соединениям (как Telegram при
+    # max_connections=40) в течение args.seconds; ответы принимает FakeBotAPI.
+    # Затем: подписка, выданная «другим процессом», должна дойти до воркеров через cache_events.
+    import signal
+    _fresh_db("webhook.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    users = [100_000 + i for i in range(args.users)]
+    def seed(conn):
+        with conn:
+            conn.executemany("INSERT INTO subscriptions(user_id, status, until) VALUES(?, 'active', '2099-01-01T00:00:00')",
+                             ((u,) for u in users))
+    main.storage().write(seed)
+    main.close_storage()
+    api = await FakeBotAPI(chat_burst=10**6, global_rate=10**9).start()
+    secret = "bench-secret"
+    for workers in args.workers:
+        port = _free_port()
+        env = _bot_env(api, port, workers, secret)
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(main.__file__), env=env)
+        url = f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32)) as http:
+            t_start = time.perf_counter()
+            while True:  # воркеры стартуют: ждём, пока порт начнёт отвечать
+                with contextlib.suppress(aiohttp.ClientError):
+                    async with http.post(url, json=_update(0, users[0], "/help"), headers=headers) as r:
+                        if r.status == 200:
+                            break
+                await asyncio.sleep(0.2)
+            await asyncio.sleep(1.0)
+            startup_s = time.perf_counter() - t_start
+            api.delivered = 0
+            posted = 0
+            stop = time.perf_counter() + args.seconds
+            async def client(i):
+                nonlocal posted
+                k = i
+                while time.perf_counter() < stop:
+                    async with http.post(url, json=_update(k + 1, users[k % len(users)], "/search ozon"),
+                                         headers=headers) as r:
+                        await r.read()
+                    posted += 1
+                    k += 32
+            t0 = time.perf_counter()
+            await asyncio.gather(*(client(i) for i in range(32)))
+            drain_until = time.perf_counter() + 60
+            while api.delivered < posted and time.perf_counter() < drain_until:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - t0
+            answered = api.delivered
+
+            # подписку выдаёт «другой процесс» (этот): воркеры узнают о ней из cache_events
+            newbie = 999_999
+            async def ask():
+                async with http.post(url, json=_update(10**8, newbie, "/search ozon"), headers=headers) as r:
+                    await r.read()
+                await asyncio.sleep(0.05)
+                return api.last_text.get(newbie, "")
+            denied = "подписка" in await ask()
+            main.CACHE_EVENTS.enabled, main.CACHE_EVENTS.origin = True, "bench"
+            main.grant_month(newbie)
+            t_sub = time.perf_counter()
+            while "подписка" in await ask() and time.perf_counter() - t_sub < 10:
+                pass
+            propagation_s = time.perf_counter() - t_sub
+            main.CACHE_EVENTS.enabled = False
+            leader = main.storage().read(lambda conn: conn.execute("SELECT owner FROM leases").fetchall())
+            main.storage().write(lambda conn: conn.execute("DELETE FROM subscriptions WHERE user_id=?", (newbie,)) and conn.commit())
+            main.close_storage()
+            main._SUB_CACHE.clear()
+        proc.send_signal(signal.SIGTERM)
+        await proc.wait()
+        emit("webhook", workers=workers, cpus=os.cpu_count(), deals=args.items, startup_s=round(startup_s, 2),
+             posted=posted, answered=answered, updates_per_s=round(answered / elapsed),
+             sub_denied_before=denied, sub_propagation_s=round(propagation_s, 2), scheduler_leases=len(leader))
+    await api.stop()
+
+async def bench_startup(args):
+    # Холодный старт `python main.py` (webhook, один процесс): от запуска до первого ответа
+    # на /help, фазы — из строки [START] в логе процесса. Случаи: пустая БД; БД на args.items
+    # сделок с актуальной схемой (обычный рестарт); она же с версией схемы 2 (первый старт
+    # после обновления кода). Плюс импорт main без запуска — нижняя граница для всех.
+    import sqlite3
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=os.path.dirname(os.path.abspath(main.__file__)),
+                   env=dict(os.environ, LOG_LEVEL="WARNING"), check=True)
+    emit("startup", case="import_only", wall_s=round(time.perf_counter() - t0, 3))
+    _fresh_db("startup.db")
+    main.upsert_deals_bulk(gen_deals(args.items))
+    main.close_storage()
+    api = await FakeBotAPI(chat_burst=10**6, global_rate=10**9).start()
+    secret = "bench-secret"
+    for case in ("empty_db", "current_schema", "schema_upgrade"):
+        db_path = main.DB_PATH
+        if case == "empty_db":
+            db_path = os.path.join(_TMP, "startup-empty.db")
+            for suffix in ("", "-wal", "-shm"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(db_path + suffix)
+        elif case == "schema_upgrade":
+            with contextlib.closing(sqlite3.connect(db_path)) as conn:
+                conn.execute("PRAGMA user_version = 2")
+        port = _free_port()
+        env = _bot_env(api, port, 1, secret, LOG_LEVEL="INFO", DB_PATH=db_path)
+        user = 4242
+        api.last_text.pop(user, None)
+        t_start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(main.__file__), env=env,
+                                                    stderr=asyncio.subprocess.PIPE)
+        lines: list = []
+        async def drain():
+            async for raw in proc.stderr:
+                lines.append(raw.decode("utf-8", "replace"))
+        reader = asyncio.create_task(drain())
+        url = f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+        accepted_s = None
+        async with aiohttp.ClientSession() as http:
+            while accepted_s is None:
+                with contextlib.suppress(aiohttp.ClientError):
+                    async with http.post(url, json=_update(1, user, "/help"),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as r:
+                        if r.status == 200:
+                            accepted_s = time.perf_counter() - t_start
+                            break
+                await asyncio.sleep(0.01)
+        while user not in api.last_text:
+            await asyncio.sleep(0.005)
+        answered_s = time.perf_counter() - t_start
+        await asyncio.sleep(0.2)  # строка [START] с first_update пишется после ответа
+        proc.terminate()
+        await proc.wait()
+        await reader
+        phases = {}
+        for line in lines:
+            if "[START]" in line:
+                phases = {f"{k}_ms": int(v[:-2]) for k, v in (kv.split("=") for kv in line.split("[START]")[1].split())}
+        emit("startup", case=case, deals=0 if case == "empty_db" else args.items,
+             accepted_s=round(accepted_s, 3), answered_s=round(answered_s, 3), **phases)
+    await api.stop()
+
+# Стандартный набор: размеры подобраны так, чтобы весь прогон занимал минуты, а не часы.
+# 1M строк — отдельно: python bench.py bulk --sizes 1000000
+SUITE = [
+    ("ingest", dict(delay=0.05, items=2000, pages=8)),
+    ("bulk", dict(sizes=[1000, 10_000, 100_000])),
+    ("load", dict(items=100_000, users=50, seconds=3.0)),
+    ("cleanup", dict(items=200_000)),
+    ("fmt", dict(items=20_000)),
+    ("deals", dict(items=100_000)),
+    ("fts", dict(items=100_000, queries=300)),
+    ("page", dict(items=100_000)),
+]
+
+async def bench_suite(args):
+    for name, overrides in SUITE:
+        t0 = time.perf_counter()
+        await SCENARIOS[name](argparse.Namespace(**{**vars(args), **overrides}))
+        print(f"# {name}: {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+
+# Поля-идентификаторы строки (что меряли) и направление метрик (что считать ухудшением)
+_ID_FIELDS = {"rows", "deals", "users", "readers", "workers", "pages", "page", "queries", "items", "cpus"}
+
+def _metric_direction(name:str) -> int:
+    # +1 — больше лучше, -1 — меньше лучше, 0 — не сравниваем
+    if name == "qps" or name.endswith("_per_s"):
+        return 1
+    if name.endswith(("_ms", "_s", "_us")) or name.startswith("us_per"):
+        return -1
+    return 0
+
+def _load_results(path:str) -> dict:
+    out = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("{"):
+                continue
+            rec = json.loads(line)
+            if rec.get("scenario") in ("_meta", "compare"):
+                continue
+            ident = tuple(sorted((k, v) for k, v in rec.items()
+                                 if isinstance(v, (str, bool)) or (k in _ID_FIELDS and isinstance(v, int))))
+            out[ident] = rec
+    return out
+
+def compare(old_path:str, new_path:str, threshold:float) -> int:
+    old, new = _load_results(old_path), _load_results(new_path)
+    worse = 0
+    for ident, rec in new.items():
+        base = old.get(ident)
+        if base is None:
+            continue
+        key = ",".join(f"{k}={v}" for k, v in ident)
+        for name, value in rec.items():
+            direction = _metric_direction(name)
+            prev = base.get(name)
+            if not direction or not isinstance(value, (int, float)) or not isinstance(prev, (int, float)) or not prev:
+                continue
+            change = (value - prev) / abs(prev)
+            verdict = "same"
+            if abs(change) > threshold:
+                verdict = "better" if change * direction > 0 else "worse"
+            worse += verdict == "worse"
+            if verdict != "same":
+                emit("compare", key=key, metric=name, old=prev, new=value,
+                     change_pct=round(change * 100, 1), verdict=verdict)
+    emit("compare", matched=len(set(old) & set(new)), only_old=len(set(old) - set(new)),
+         only_new=len(set(new) - set(old)), worse=worse, threshold=threshold)
+    return 1 if worse else 0
+
+SCENARIOS = {
+    "ingest": bench_ingest,
+    "match": bench_match,
+    "upsert": bench_upsert,
+    "search": bench_search,
+    "storage": bench_storage,
+    "plan": bench_plan,
+    "cleanup": bench_cleanup,
+    "coalesce": bench_coalesce,
+    "send": bench_send,
+    "admitad": bench_admitad,
+    "parse": bench_parse,
+    "crawl": bench_crawl,
+    "dedup": bench_dedup,
+    "fts": bench_fts,
+    "page": bench_page,
+    "fanout": bench_fanout,
+    "sched": bench_sched,
+    "metrics": bench_metrics,
+    "bulk": bench_bulk,
+    "load": bench_load,
+    "fmt": bench_fmt,
+    "deals": bench_deals,
+    "suite": bench_suite,
+    "webhook": bench_webhook,
+    "startup": bench_startup,
+    "ratelimit": bench_ratelimit,
+}
+
+def main_cli():
+    global OUT
+    if sys.argv[1:2] == ["compare"]:
+        p = argparse.ArgumentParser(prog="bench.py compare", description="Сравнить два прогона (JSONL)")
+        p.add_argument("old")
+        p.add_argument("new")
+        p.add_argument("--threshold", type=float, default=0.10, help="доля изменения, ниже которой — шум")
+        args = p.parse_args(sys.argv[2:])
+        sys.exit(compare(args.old, args.new, args.threshold))
+    p = argparse.ArgumentParser(description="HalyavaBot local benchmarks")
+    p.add_argument("scenario", choices=sorted(SCENARIOS))
+    p.add_argument("--delay", type=float, default=2.0, help="задержка ответа stub-сервера, с")
+    p.add_argument("--items", type=int, default=2000, help="элементов в каждом фиде")
+    p.add_argument("--pages", type=int, default=8, help="промо-страниц")
+    p.add_argument("--queries", type=int, default=3000, help="запросов /search (search)")
+    p.add_argument("--users", type=int, default=50, help="одновременных пользователей (coalesce, load)")
+    p.add_argument("--seconds", type=float, default=5.0, help="длительность нагрузочных сценариев, с")
+    p.add_argument("--aliases", type=int, default=500, help="алиасов магазинов (match)")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 10_000, 100_000],
+                   help="размеры для bulk через запятую, до 1000000")
+    p.add_argument("--workers", type=lambda v: [int(x) for x in v.split(",")], default=[1, 2],
+                   help="числа процессов для webhook через запятую")
+    p.add_argument("--cityads", choices=("rss", "json"), default="rss", help="формат фида CityAds в stub-сервере")
+    p.add_argument("--out", help="дописать результаты (JSONL) в файл")
+    args = p.parse_args()
+    if args.out:
+        OUT = open(args.out, "a", encoding="utf-8")
+        emit("_meta", **run_meta(args))
+    try:
+        asyncio.run(SCENARIOS[args.scenario](args))
+    finally:
+        if OUT is not None:
+            OUT.close()
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,28 +3,51 @@
 import os
 import re
 import json
+import math
 import html
 import time
 import asyncio
+import bisect
 import logging
+import contextlib
+import queue
+import signal
 import sqlite3
 import threading
+import concurrent.futures
 import datetime
-from typing import Optional, List, Dict, Any
+import hashlib
+import itertools
+import tempfile
+import multiprocessing
+import urllib.parse
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from typing import Optional, List, Dict, Any, Tuple, Callable, AsyncIterator, Iterable, Mapping, NamedTuple
 
-import requests
-import feedparser
-from bs4 import BeautifulSoup
+# отсчёт для отчёта о старте (STARTUP): стандартная библиотека уже загружена, дальше — сторонние
+# модули. feedparser и bs4 импортируются там, где разбирают фиды: боту для ответа они не нужны.
+_T_START = time.perf_counter()
 
-from aiogram import Bot, Dispatcher, Router, F
+import aiohttp
+from aiohttp import web
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+_T_IMPORTED = time.perf_counter()
+
 # ---------- ЛОГИ ----------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger(__name__)
 
 # ---------- КОНФИГ ----------
@@ -49,8 +72,28 @@ BOT_TOKEN = _sanitize_token(os.environ.get("BOT_TOKEN", ""))
 
 TIMEZONE = os.environ.get("TIMEZONE", "Europe/Moscow")
 DB_PATH = os.environ.get("DB_PATH", "/data/halyava.db")
+DB_READERS = int(os.environ.get("DB_READERS", "4"))  # read-only соединений в пуле
 TRIAL_DAYS = int(os.environ.get("TRIAL_DAYS", "3"))
 MONTHLY_PRICE_RUB = int(os.environ.get("MONTHLY_PRICE_RUB", "249"))
+DEALS_BATCH = int(os.environ.get("DEALS_BATCH", "5000"))  # строк на одну транзакцию вставки
+
+# Кэш выдачи /search: сколько магазинов держать, сколько секунд и сколько сделок на магазин
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_TOP_N = int(os.environ.get("SEARCH_CACHE_TOP_N", "32"))
+# Готовый HTML сделок для выдачи: сколько сделок держать (заполняется при записи в БД)
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "50000"))
+
+# Очистка старых сделок: строк на пачку, пауза между пачками (с), страниц на шаг incremental_vacuum
+CLEANUP_BATCH = int(os.environ.get("CLEANUP_BATCH", "2000"))
+CLEANUP_PAUSE = float(os.environ.get("CLEANUP_PAUSE", "0.05"))
+CLEANUP_VACUUM_PAGES = int(os.environ.get("CLEANUP_VACUUM_PAGES", "1000"))
+# last_seen_ts сделки, которая снова пришла в фиде, обновляется не чаще раза за этот срок (с):
+# очистка считает возраст от него, а не от первой встречи
+DEAL_SEEN_REFRESH = int(os.environ.get("DEAL_SEEN_REFRESH", "86400"))
+
+DEAL_FILTER_MAX = int(os.environ.get("DEAL_FILTER_MAX", "500000"))  # отпечатков уже записанных сделок в памяти
+SUB_CACHE_WARM = os.environ.get("SUB_CACHE_WARM", "1") == "1"  # загрузить все подписки в память при старте
 
 # Admitad
 ADMITAD_ACCESS_TOKEN = os.environ.get("ADMITAD_ACCESS_TOKEN", "") or ""
@@ -58,6 +101,13 @@ ADMITAD_CLIENT_ID = os.environ.get("ADMITAD_CLIENT_ID", "") or ""
 ADMITAD_CLIENT_SECRET = os.environ.get("ADMITAD_CLIENT_SECRET", "") or ""
 ADMITAD_WEBSITE_ID = os.environ.get("ADMITAD_WEBSITE_ID", "") or ""
 
+ADMITAD_API_URL = (os.environ.get("ADMITAD_API_URL", "") or "https://api.admitad.com").rstrip("/")
+ADMITAD_PAGE_SIZE = int(os.environ.get("ADMITAD_PAGE_SIZE", "500"))
+# после стольких неизменившихся страниц подряд дальше не листаем...
+ADMITAD_STOP_AFTER_UNCHANGED = int(os.environ.get("ADMITAD_STOP_AFTER_UNCHANGED", "2"))
+# ...но раз в столько часов проходим выдачу целиком
+ADMITAD_FULL_SWEEP_HOURS = float(os.environ.get("ADMITAD_FULL_SWEEP_HOURS", "6"))
+
 # CityAds
 CITYADS_COUPONS_URL = os.environ.get("CITYADS_COUPONS_URL", "") or ""
 
@@ -66,6 +116,88 @@ OFFICIAL_PROMO_PAGES = [
     u.strip() for u in (os.environ.get("OFFICIAL_PROMO_PAGES", "") or "").split(",") if u.strip()
 ]
 
+# HTTP: общий пул соединений и лимит одновременных запросов на один хост
+HTTP_CONCURRENCY = int(os.environ.get("HTTP_CONCURRENCY", "32"))
+HTTP_PER_HOST = int(os.environ.get("HTTP_PER_HOST", "4"))
+# не чаще раза в N секунд дёргать источник по запросу пользователя (/update, пустой /search)
+REFRESH_COOLDOWN = float(os.environ.get("REFRESH_COOLDOWN", "300"))
+# webhook с несколькими процессами: сколько ждать сбор, переданный процессу-планировщику (с)
+REFRESH_WAIT = float(os.environ.get("REFRESH_WAIT", "120"))
+
+# Обход промо-страниц: интервал между проверками одной страницы растёт вдвое, пока она
+# не меняется (от MIN до MAX, с); на один хост — PROMO_PER_HOST запросов одновременно
+# и пауза PROMO_HOST_DELAY с между ними
+PROMO_MIN_INTERVAL = int(os.environ.get("PROMO_MIN_INTERVAL", "1800"))
+PROMO_MAX_INTERVAL = int(os.environ.get("PROMO_MAX_INTERVAL", "86400"))
+PROMO_PER_HOST = int(os.environ.get("PROMO_PER_HOST", "2"))
+PROMO_HOST_DELAY = float(os.environ.get("PROMO_HOST_DELAY", "1.0"))
+
+# Разбор фидов: процессов в пуле (0 — разбирать в потоке) и порог, после которого
+# фид пишется на диск и разбирается потоково
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(min(2, os.cpu_count() or 1))))
+PARSE_STREAM_THRESHOLD = int(os.environ.get("PARSE_STREAM_THRESHOLD", str(8 * 1024 * 1024)))
+
+# Исходящие сообщения: общий лимит (сообщений/с и всплеск) и интервал между сообщениями в один чат
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))
+SEND_BURST = int(os.environ.get("SEND_BURST", "30"))
+SEND_CHAT_INTERVAL = float(os.environ.get("SEND_CHAT_INTERVAL", "1.0"))
+SEND_INFLIGHT = int(os.environ.get("SEND_INFLIGHT", "8"))  # запросов к Bot API одновременно (в разные чаты)
+
+# /watch: магазинов на пользователя; рассылка: сделок в уведомлении о магазине,
+# строк очереди за проход и одновременных отправок (остальной поток — ответам на команды)
+WATCH_LIMIT = int(os.environ.get("WATCH_LIMIT", "20"))
+PUSH_MAX_DEALS = int(os.environ.get("PUSH_MAX_DEALS", "5"))
+PUSH_BATCH = int(os.environ.get("PUSH_BATCH", "200"))
+PUSH_INFLIGHT = int(os.environ.get("PUSH_INFLIGHT", "10"))
+
+# Плановый сбор: у каждого источника своя задача и базовый интервал (с); интервал
+# подстраивается под отдачу источника в пределах [база/4, SOURCE_MAX_INTERVAL],
+# к каждому запуску добавляется случайная задержка до SOURCE_JITTER от интервала
+ADMITAD_INTERVAL = int(os.environ.get("ADMITAD_INTERVAL", "1800"))
+CITYADS_INTERVAL = int(os.environ.get("CITYADS_INTERVAL", "1800"))
+PROMO_PAGES_INTERVAL = int(os.environ.get("PROMO_PAGES_INTERVAL", "600"))
+SOURCE_MAX_INTERVAL = int(os.environ.get("SOURCE_MAX_INTERVAL", str(6 * 3600)))
+SOURCE_JITTER = float(os.environ.get("SOURCE_JITTER", "0.1"))
+# Срок следующего запуска источника хранится в БД: после рестарта сбор продолжается по нему,
+# а просроченный (или первый) запуск идёт через SCRAPE_START_DELAY с после старта
+SCRAPE_START_DELAY = float(os.environ.get("SCRAPE_START_DELAY", "2"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (порт 0 — выключено);
+# задержка event loop меряется раз в METRICS_LAG_INTERVAL с
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+METRICS_LAG_INTERVAL = float(os.environ.get("METRICS_LAG_INTERVAL", "0.5"))
+
+# Webhook: задан WEBHOOK_URL (публичный https-адрес без пути) — вместо polling поднимается
+# WEB_WORKERS процессов на WEBHOOK_HOST:WEBHOOK_PORT (SO_REUSEPORT). Планировщик и рассылку
+# держит один из них — владелец аренды в БД (продлевается каждые LEASE_TTL/3 с); кэши
+# процессов сбрасываются по событиям из БД, которые каждый дочитывает раз в CACHE_EVENTS_POLL с.
+# BOT_API_URL — свой Bot API сервер (telegram-bot-api --local) или тестовый.
+WEBHOOK_URL = (os.environ.get("WEBHOOK_URL", "") or "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/tg")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or ""
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", str(os.cpu_count() or 1)))
+LEASE_TTL = int(os.environ.get("LEASE_TTL", "30"))
+CACHE_EVENTS_POLL = float(os.environ.get("CACHE_EVENTS_POLL", "1.0"))
+BOT_API_URL = (os.environ.get("BOT_API_URL", "") or "").rstrip("/")
+
+# Допуск к командам: /update — только ADMIN_IDS (user_id через запятую). Лёгкие команды —
+# RATE_USER_PER_MIN на пользователя (всплеск RATE_USER_BURST), RATE_GLOBAL_PER_S на всех,
+# не больше READ_CONCURRENCY одновременно (остальные ждут до RATE_QUEUE_WAIT с). Опрос
+# источников (/update, пустой магазин в /search) — раз в SCRAPE_USER_COOLDOWN с на
+# пользователя, SCRAPE_CONCURRENCY одновременно, лишние сразу отклоняются. В webhook с
+# WEB_WORKERS > 1 скорости и всплески делятся между процессами, одновременность — нет.
+ADMIN_IDS = {int(x) for x in (os.environ.get("ADMIN_IDS", "") or "").replace(" ", "").split(",") if x}
+RATE_USER_PER_MIN = float(os.environ.get("RATE_USER_PER_MIN", "30"))
+RATE_USER_BURST = int(os.environ.get("RATE_USER_BURST", "10"))
+RATE_GLOBAL_PER_S = float(os.environ.get("RATE_GLOBAL_PER_S", "200"))
+READ_CONCURRENCY = int(os.environ.get("READ_CONCURRENCY", "64"))
+RATE_QUEUE_WAIT = float(os.environ.get("RATE_QUEUE_WAIT", "5"))
+SCRAPE_USER_COOLDOWN = float(os.environ.get("SCRAPE_USER_COOLDOWN", "300"))
+SCRAPE_CONCURRENCY = int(os.environ.get("SCRAPE_CONCURRENCY", "2"))
+
 # Популярные магазины РФ + маркеты + еда (алиасы → slug)
 STORE_ALIASES: Dict[str, str] = {
     # marketplaces
@@ -94,23 +226,336 @@ STORE_ALIASES: Dict[str, str] = {
 }
 POPULAR_STORES = sorted(set(STORE_ALIASES.values()))
 
+# ---------- МЕТРИКИ ----------
+# Небольшой реестр в текстовом формате Prometheus (без prometheus_client): счётчики,
+# гистограммы и значения, которые снимаются функцией в момент выгрузки (размеры очередей,
+# счётчики кэшей). Пишут в него и event loop, и потоки БД, поэтому всё — под одним lock.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _fmt_labels(names:Tuple[str, ...], values:tuple, extra:str="") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    def __init__(self, name:str, help:str, kind:str, labels:Tuple[str, ...], lock:threading.Lock,
+                 buckets:Tuple[float, ...]=LATENCY_BUCKETS, fn:Optional[Callable[[], Any]]=None):
+        self.name = name
+        self.help = help
+        self.kind = kind  # counter | gauge | histogram
+        self.labels = labels
+        self.buckets = buckets
+        self.fn = fn  # fn() -> число или {значения меток: число}
+        self._lock = lock
+        self._values: Dict[tuple, Any] = {}
+
+    def inc(self, *labels, value:float=1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def set(self, value:float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def observe(self, value:float, *labels):
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                h = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.fn is not None:
+            got = self.fn()
+            values = got if isinstance(got, dict) else {(): got}
+        else:
+            with self._lock:
+                values = {k: ([list(v[0]), v[1], v[2]] if self.kind == "histogram" else v)
+                          for k, v in self._values.items()}
+        for key, v in sorted(values.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            if self.kind != "histogram":
+                out.append(f"{self.name}{_fmt_labels(self.labels, key)} {v}")
+                continue
+            counts, total, n = v
+            acc = 0
+            for le, c in zip(self.buckets + (None,), counts + [n - sum(counts)]):
+                acc += c
+                bound = 'le="%s"' % ("+Inf" if le is None else "%g" % le)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, bound)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {total:.6f}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {n}")
+        return out
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: "OrderedDict[str, Metric]" = OrderedDict()
+
+    def _add(self, name:str, help:str, kind:str, labels:Tuple[str, ...], **kw) -> Metric:
+        m = self._metrics[name] = Metric(name, help, kind, tuple(labels), self._lock, **kw)
+        return m
+
+    def counter(self, name:str, help:str, labels:Tuple[str, ...]=(), fn:Optional[Callable]=None) -> Metric:
+        return self._add(name, help, "counter", labels, fn=fn)
+
+    def gauge(self, name:str, help:str, labels:Tuple[str, ...]=(), fn:Optional[Callable]=None) -> Metric:
+        return self._add(name, help, "gauge", labels, fn=fn)
+
+    def histogram(self, name:str, help:str, labels:Tuple[str, ...]=(),
+                  buckets:Tuple[float, ...]=LATENCY_BUCKETS) -> Metric:
+        return self._add(name, help, "histogram", labels, buckets=buckets)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in list(self._metrics.values()):
+            try:
+                lines.extend(m.render())
+            except Exception as e:  # сломанная функция-источник не должна ронять всю выгрузку
+                log.warning("[METRICS] %s: %s", m.name, e)
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+HANDLER_SECONDS = METRICS.histogram("halyava_handler_seconds", "Время обработки апдейта по командам", ("command",))
+HANDLER_ERRORS = METRICS.counter("halyava_handler_errors_total", "Необработанные исключения в хендлерах", ("command",))
+DB_WAIT_SECONDS = METRICS.histogram("halyava_db_wait_seconds",
+                                    "Ожидание соединения: очередь писателя / свободный читатель", ("kind",))
+DB_HOLD_SECONDS = METRICS.histogram("halyava_db_hold_seconds", "Время работы с соединением", ("kind",))
+SOURCE_SECONDS = METRICS.histogram("halyava_source_seconds", "Этапы сбора источника", ("source", "stage"))
+SOURCE_ITEMS = METRICS.counter("halyava_source_items_total", "Разобрано и добавлено сделок", ("source", "kind"))
+SOURCE_RUNS = METRICS.counter("halyava_source_runs_total", "Плановые запуски источников", ("source", "result"))
+TELEGRAM_SECONDS = METRICS.histogram("halyava_telegram_seconds", "Длительность запроса к Bot API из очереди отправки")
+LOOP_LAG_SECONDS = METRICS.histogram("halyava_loop_lag_seconds", "Опоздание таймера event loop")
+
+def _cache_requests() -> Dict[tuple, int]:
+    # счётчики живут в самих кэшах; доля попаданий — hit / (hit + miss)
+    out = {("subs", r): n for r, n in _SUB_CACHE_STATS.items()}
+    for name, cache in (("search", SEARCH_CACHE), ("text_df", TEXT_STATS), ("deal_filter", DEAL_FILTER),
+                        ("render", RENDER_CACHE)):
+        out[(name, "hit")] = cache.hits
+        out[(name, "miss")] = cache.misses
+    return out
+
+METRICS.counter("halyava_cache_requests_total", "Обращения к кэшам в памяти", ("cache", "result"), fn=_cache_requests)
+METRICS.gauge("halyava_cache_entries", "Записей в кэшах", ("cache",), fn=lambda: {
+    ("subs",): len(_SUB_CACHE), ("search",): len(SEARCH_CACHE._data),
+    ("text_df",): len(TEXT_STATS._df), ("deal_filter",): len(DEAL_FILTER._seen), ("render",): len(RENDER_CACHE)})
+METRICS.gauge("halyava_db_write_queue", "Задач в очереди писателя БД",
+              fn=lambda: _STORAGE.write_backlog() if _STORAGE is not None else 0)
+METRICS.counter("halyava_telegram_sent_total", "Сообщения из очереди отправки", ("result",),
+                fn=lambda: {("sent",): SEND_QUEUE.sent, ("retry_after",): SEND_QUEUE.retries})
+METRICS.gauge("halyava_source_interval_seconds", "Текущий интервал плановой задачи источника", ("source",),
+              fn=lambda: {(name,): src.delay for name, src in SOURCES.items() if src.enabled})
+
+class LoopLagMonitor:
+    # Раз в interval засыпает и меряет, насколько позже проснулся: всё, что дольше
+    # пары миллисекунд, — кто-то держит event loop (синхронный разбор, запрос к БД в loop).
+    def __init__(self, interval:float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - t0 - self.interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+class StartupReport:
+    # Фазы старта процесса, секунды от _T_START: import (сторонние модули), module (весь main.py),
+    # db (БД открыта, схема проверена), set_webhook (родитель в webhook-режиме), warm (кэш
+    # подписок), ready (бот принимает апдейты), first_update (обработан первый апдейт).
+    # Каждая фаза фиксируется один раз.
+    def __init__(self, t0:float, imported:float):
+        self.t0 = t0
+        self.phases: Dict[str, float] = {"import": imported - t0}
+        self.done = False
+
+    def mark(self, phase:str):
+        if phase in self.phases:
+            return
+        self.phases[phase] = time.perf_counter() - self.t0
+        if phase in ("ready", "first_update"):
+            log.info("[START] %s", " ".join(f"{k}={v * 1000:.0f}ms" for k, v in self.phases.items()))
+        if phase == "first_update":
+            self.done = True
+
+STARTUP = StartupReport(_T_START, _T_IMPORTED)
+METRICS.gauge("halyava_startup_seconds", "Фазы старта процесса от начала импорта", ("phase",),
+              fn=lambda: {(k,): v for k, v in STARTUP.phases.items()})
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    if not METRICS_PORT:
+        return None
+    async def handle(request:web.Request) -> web.Response:
+        text = await asyncio.to_thread(METRICS.render)
+        return web.Response(text=text, content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # порт занят (второй экземпляр, перекрывающийся перезапуск) — бот работает без метрик
+        log.warning("[METRICS] can't listen on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        await runner.cleanup()
+        return None
+    log.info("[METRICS] http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
 # ---------- БД ----------
-_DB_CONN: Optional[sqlite3.Connection] = None
-_DB_LOCK = threading.RLock()
-
-def db() -> sqlite3.Connection:
-    global _DB_CONN
-    if _DB_CONN is None:
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-        _DB_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10.0)
-        _DB_CONN.row_factory = sqlite3.Row
-        with _DB_CONN:
-            _DB_CONN.execute("PRAGMA journal_mode=WAL;")
-            _DB_CONN.execute("PRAGMA busy_timeout=5000;")
-            _DB_CONN.execute("PRAGMA synchronous=NORMAL;")
-    return _DB_CONN
+# Один поток-писатель с очередью задач + пул read-only соединений. В WAL-режиме
+# чтения не ждут записи: долгий cleanup_old или вставка фида не тормозят /search.
+class Storage:
+    def __init__(self, path:str, readers:int=4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writes: "queue.Queue" = queue.Queue()
+        self._pool: "queue.LifoQueue" = queue.LifoQueue()
+        self._opened = 0
+        self._pool_lock = threading.Lock()
+        self._all: List[sqlite3.Connection] = []
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._wconn = self._connect(readonly=False)
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self, readonly:bool) -> sqlite3.Connection:
+        if readonly:
+            uri = "file:" + urllib.parse.quote(os.path.abspath(self.path)) + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=10.0)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10.0)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=5000;")
+        if not readonly:
+            # auto_vacuum ставится до WAL и до первой таблицы; старые БД переводит cleanup_old
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+        self._all.append(conn)
+        return conn
+
+    def _write_loop(self):
+        while True:
+            job = self._writes.get()
+            if job is None:
+                return
+            fn, args, fut, queued = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            DB_WAIT_SECONDS.observe(start - queued, "write")
+            try:
+                fut.set_result(fn(self._wconn, *args))
+            except BaseException as e:
+                if self._wconn.in_transaction:
+                    self._wconn.rollback()
+                fut.set_exception(e)
+            DB_HOLD_SECONDS.observe(time.perf_counter() - start, "write")
+
+    def submit_write(self, fn:Callable, *args) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        self._writes.put((fn, args, fut, time.perf_counter()))
+        return fut
+
+    def write(self, fn:Callable, *args) -> Any:
+        # fn(conn, *args) выполняется в потоке-писателе; из него самого — сразу
+        if threading.current_thread() is self._writer:
+            return fn(self._wconn, *args)
+        return self.submit_write(fn, *args).result()
+
+    def read(self, fn:Callable, *args) -> Any:
+        t0 = time.perf_counter()
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                grow = self._opened < self.readers
+                if grow:
+                    self._opened += 1
+            conn = self._connect(readonly=True) if grow else self._pool.get()
+        start = time.perf_counter()
+        DB_WAIT_SECONDS.observe(start - t0, "read")
+        try:
+            return fn(conn, *args)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+            DB_HOLD_SECONDS.observe(time.perf_counter() - start, "read")
+
+    async def aread(self, fn:Callable, *args) -> Any:
+        return await asyncio.to_thread(self.read, fn, *args)
+
+    async def awrite(self, fn:Callable, *args) -> Any:
+        return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    def write_backlog(self) -> int:
+        return self._writes.qsize()
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join(timeout=10)
+        for conn in self._all:
+            conn.close()
+        self._all.clear()
+
+_STORAGE: Optional[Storage] = None
+
+def storage() -> Storage:
+    global _STORAGE
+    if _STORAGE is None:
+        _STORAGE = Storage(DB_PATH, DB_READERS)
+    return _STORAGE
+
+def close_storage():
+    global _STORAGE
+    if _STORAGE is not None:
+        _STORAGE.close()
+    _STORAGE = None
+
+# Версия схемы в PRAGMA user_version: 1 — канонические ключи сделок, 2 — заполнен FTS,
+# 3 — таблицы, колонки и индексы ниже, 4 — deals.last_seen_ts, 5 — ключи сделок пересчитаны
+# (ref/referrer в ссылке больше не считаются трекингом). Если версия уже такая, init_db ничего не делает
+# (одно чтение pragma вместо executescript и проверок миграций на каждом старте), поэтому
+# любое изменение schema/indexes поднимает SCHEMA_VERSION.
+SCHEMA_VERSION = 5
 
 def init_db():
+    st = storage()
+    if st.write(lambda conn: conn.execute("PRAGMA user_version").fetchone()[0]) >= SCHEMA_VERSION:
+        STARTUP.mark("db")
+        return
     schema = """
     CREATE TABLE IF NOT EXISTS users(
       user_id INTEGER PRIMARY KEY,
@@ -139,53 +584,279 @@ def init_db():
       created_at TEXT DEFAULT CURRENT_TIMESTAMP,
       source TEXT,
       score REAL DEFAULT 0,
-      hash TEXT UNIQUE
+      hash TEXT UNIQUE,
+      start_ts INTEGER,  -- unix-время; end_ts без срока = TS_NEVER
+      end_ts INTEGER,
+      created_ts INTEGER,
+      last_seen_ts INTEGER  -- когда сделка последний раз была в источнике (с точностью DEAL_SEEN_REFRESH)
+    );
+    -- /watch: ключ начинается со slug — рассылка выбирает подписчиков магазина диапазоном
+    CREATE TABLE IF NOT EXISTS watches(
+      store_slug TEXT,
+      user_id INTEGER,
+      created_ts INTEGER,
+      PRIMARY KEY(store_slug, user_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_watches_user ON watches(user_id);
+    -- рассылка новых сделок: текст рендерится один раз на магазин, очередь — пары
+    -- (сообщение, получатель); строка удаляется после отправки, так что после рестарта
+    -- рассылка продолжается с того же места
+    CREATE TABLE IF NOT EXISTS push_messages(
+      id INTEGER PRIMARY KEY,
+      store_slug TEXT,
+      text TEXT,
+      created_ts INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS push_queue(
+      msg_id INTEGER,
+      user_id INTEGER,
+      attempts INTEGER DEFAULT 0,
+      PRIMARY KEY(msg_id, user_id)
+    ) WITHOUT ROWID;
+    -- несколько процессов (webhook): кто сейчас держит планировщик и что сбросить в кэшах
+    CREATE TABLE IF NOT EXISTS leases(
+      name TEXT PRIMARY KEY,
+      owner TEXT,
+      expires_ts INTEGER
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS cache_events(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      origin TEXT,
+      kind TEXT,   -- sub|deals|reset|push|refresh|refreshed
+      key TEXT,
+      ts INTEGER
+    );
+    -- состояние инкрементального сбора: страница API или URL -> чем она была в прошлый раз
+    CREATE TABLE IF NOT EXISTS source_state(
+      key TEXT PRIMARY KEY,
+      etag TEXT,
+      last_modified TEXT,
+      body_hash TEXT,
+      items INTEGER,
+      checked_ts INTEGER,
+      changed_ts INTEGER,
+      interval_s INTEGER,  -- промо-страницы: текущий интервал обхода
+      next_ts INTEGER      -- и когда страницу пора проверить снова
     );
-    CREATE INDEX IF NOT EXISTS idx_deals_store ON deals(store_slug);
-    CREATE INDEX IF NOT EXISTS idx_deals_end ON deals(end_at);
     """
-    with _DB_LOCK:
-        conn = db()
+    # индекс под горячий запрос /search: фильтр по магазину и сортировка берутся прямо из него
+    indexes = """
+    DROP INDEX IF EXISTS idx_deals_store;
+    DROP INDEX IF EXISTS idx_deals_end;
+    CREATE INDEX IF NOT EXISTS idx_deals_hot ON deals(store_slug, score DESC, end_ts, created_ts DESC);
+    CREATE INDEX IF NOT EXISTS idx_deals_end_ts ON deals(end_ts);
+    DROP INDEX IF EXISTS idx_deals_created_ts;
+    CREATE INDEX IF NOT EXISTS idx_deals_last_seen_ts ON deals(last_seen_ts);
+
+    -- полнотекстовый индекс поверх deals (external content): строки не дублируются,
+    -- синхронизацию держат триггеры
+    CREATE VIRTUAL TABLE IF NOT EXISTS deals_fts USING fts5(
+      title, description, store_slug,
+      content='deals', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+      prefix='4 5 6'  -- под короткие основы из fts_query: префиксный поиск без слияния термов
+    );
+    CREATE TRIGGER IF NOT EXISTS deals_fts_ai AFTER INSERT ON deals BEGIN
+      INSERT INTO deals_fts(rowid, title, description, store_slug)
+      VALUES (new.id, new.title, new.description, new.store_slug);
+    END;
+    CREATE TRIGGER IF NOT EXISTS deals_fts_ad AFTER DELETE ON deals BEGIN
+      INSERT INTO deals_fts(deals_fts, rowid, title, description, store_slug)
+      VALUES ('delete', old.id, old.title, old.description, old.store_slug);
+    END;
+    CREATE TRIGGER IF NOT EXISTS deals_fts_au AFTER UPDATE OF title, description, store_slug ON deals BEGIN
+      INSERT INTO deals_fts(deals_fts, rowid, title, description, store_slug)
+      VALUES ('delete', old.id, old.title, old.description, old.store_slug);
+      INSERT INTO deals_fts(rowid, title, description, store_slug)
+      VALUES (new.id, new.title, new.description, new.store_slug);
+    END;
+    """
+    def tx(conn):
         conn.executescript(schema)
-        conn.commit()
+        _migrate_deals_ts(conn)
+        _migrate_deals_seen(conn)
+        _migrate_source_state(conn)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 5:
+            _migrate_deal_keys(conn)
+        conn.executescript(indexes)
+        if version < 2:
+            _build_deals_fts(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    st.write(tx)
+    log.info("[DB] schema upgraded to version %s", SCHEMA_VERSION)
+    STARTUP.mark("db")
+
+def _migrate_deals_ts(conn:sqlite3.Connection):
+    # старые БД: добавить epoch-колонки и заполнить их из текстовых дат
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(deals)")}
+    for col in ("start_ts", "end_ts", "created_ts"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE deals ADD COLUMN {col} INTEGER")
+    conn.commit()
+    if conn.execute("SELECT 1 FROM deals WHERE end_ts IS NULL LIMIT 1").fetchone() is None:
+        return
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, start_at, end_at, created_at, end_ts FROM deals WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, DEALS_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        todo = [r for r in rows if r["end_ts"] is None]
+        if todo:
+            with conn:
+                conn.executemany(
+                    "UPDATE deals SET start_ts=?, end_ts=?, created_ts=? WHERE id=?",
+                    [(parse_ts(r["start_at"]), parse_ts(r["end_at"]) or TS_NEVER, parse_ts(r["created_at"]) or 0, r["id"])
+                     for r in todo]
+                )
+            log.info("[DB] migrated deal timestamps: %s", len(todo))
+
+def _migrate_deals_seen(conn:sqlite3.Connection):
+    # до версии 4 очистка считала возраст от created_ts. Всем старым сделкам даём отсчёт
+    # от миграции: те, что ещё есть в фидах, обновят отметку при ближайшем сборе.
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(deals)")}
+    if "last_seen_ts" not in cols:
+        conn.execute("ALTER TABLE deals ADD COLUMN last_seen_ts INTEGER")
+    with conn:
+        conn.execute("UPDATE deals SET last_seen_ts=? WHERE last_seen_ts IS NULL", (int(time.time()),))
+
+def _migrate_source_state(conn:sqlite3.Connection):
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(source_state)")}
+    for col in ("interval_s", "next_ts"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE source_state ADD COLUMN {col} INTEGER")
+    conn.commit()
+
+def _migrate_deal_keys(conn:sqlite3.Connection):
+    # Пересчёт hash по текущему _hash_deal, дубли сливаются: 0 -> 1 — со старого
+    # hash(url|title|code), 4 -> 5 — после смены списка трекинг-параметров.
+    # Одной транзакцией и повторяемо: прерванный пересчёт просто пройдёт заново.
+    conn.create_function("deal_key", 4, _hash_deal, deterministic=True)
+    with conn:
+        conn.execute("""
+            CREATE TEMP TABLE deal_keys AS
+            SELECT id, deal_key(store_slug, url, title, coupon_code) AS key FROM deals
+        """)
+        conn.execute("CREATE INDEX temp.deal_keys_key ON deal_keys(key)")
+        conn.execute("""
+            CREATE TEMP TABLE deal_merge AS
+            SELECT k.key, MAX(d.score) AS score, MAX(d.end_ts) AS end_ts,
+                   (SELECT d2.id FROM deals d2 JOIN deal_keys k2 ON k2.id = d2.id
+                    WHERE k2.key = k.key ORDER BY d2.score DESC, d2.id LIMIT 1) AS id,
+                   (SELECT d2.end_at FROM deals d2 JOIN deal_keys k2 ON k2.id = d2.id
+                    WHERE k2.key = k.key ORDER BY d2.end_ts DESC LIMIT 1) AS end_at
+            FROM deals d JOIN deal_keys k ON k.id = d.id
+            GROUP BY k.key
+        """)
+        merged = conn.execute("DELETE FROM deals WHERE id NOT IN (SELECT id FROM deal_merge)").rowcount
+        conn.execute("""
+            UPDATE deals SET hash=m.key, score=m.score, end_ts=m.end_ts, end_at=m.end_at
+            FROM deal_merge m WHERE deals.id = m.id
+        """)
+        conn.execute("DROP TABLE temp.deal_merge")
+        conn.execute("DROP TABLE temp.deal_keys")
+    if merged:
+        log.info("[DB] merged duplicate deals: %s", merged)
+
+def _build_deals_fts(conn:sqlite3.Connection):
+    # user_version 1 -> 2: заполнить FTS по уже лежащим сделкам
+    with conn:
+        conn.execute("INSERT INTO deals_fts(deals_fts) VALUES('rebuild')")
+        conn.execute("PRAGMA user_version = 2")
+
+# Даты в фидах приходят как попало: ISO с зоной и без, "YYYY-MM-DD HH:MM:SS",
+# "DD.MM.YYYY", unix-время. Время без зоны считаем UTC — как и раньше при сравнении строк.
+TS_NEVER = 253402300799  # 9999-12-31T23:59:59Z: «бессрочно», сортируется после любых реальных дат
+_TS_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y")
+
+def parse_ts(value:Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.strip().isdigit()):
+        ts = int(value)
+        return ts // 1000 if ts > 10**11 else ts  # миллисекунды
+    s = str(value).strip()
+    try:
+        dt = datetime.datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        dt = None
+        for fmt in _TS_FORMATS:
+            try:
+                dt = datetime.datetime.strptime(s, fmt)
+                break
+            except ValueError:
+                continue
+        if dt is None:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
 
 def _now_iso_naive_utc() -> str:
     return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0).isoformat()
 
 def upsert_user(user_id:int, username:str=""):
-    with _DB_LOCK:
-        conn = db()
-        conn.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)", (user_id, username or ""))
-        conn.commit()
+    def tx(conn):
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)", (user_id, username or ""))
+    storage().write(tx)
 
 def get_sub(user_id:int) -> Optional[dict]:
-    with _DB_LOCK:
-        conn = db()
+    def q(conn):
         r = conn.execute("SELECT status, until FROM subscriptions WHERE user_id=?", (user_id,)).fetchone()
         return dict(r) if r else None
+    return storage().read(q)
 
 def set_sub(user_id:int, status:str, until_iso:str, plan:str="monthly"):
-    with _DB_LOCK:
-        conn = db()
-        conn.execute("""
-            INSERT INTO subscriptions(user_id,status,until,plan,updated_at)
-            VALUES(?,?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              status=excluded.status,
-              until=excluded.until,
-              plan=excluded.plan,
-              updated_at=excluded.updated_at
-        """, (user_id, status, until_iso, plan, _now_iso_naive_utc()))
-        conn.commit()
+    def tx(conn):
+        with conn:
+            conn.execute("""
+                INSERT INTO subscriptions(user_id,status,until,plan,updated_at)
+                VALUES(?,?,?,?,?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                  status=excluded.status,
+                  until=excluded.until,
+                  plan=excluded.plan,
+                  updated_at=excluded.updated_at
+            """, (user_id, status, until_iso, plan, _now_iso_naive_utc()))
+            CACHE_EVENTS.publish(conn, "sub", (user_id,))
+    storage().write(tx)
+    _SUB_CACHE[user_id] = (status, _until_epoch(until_iso))
 
-def sub_active(user_id:int) -> bool:
-    sub = get_sub(user_id)
-    if not sub:
-        return False
+# Кэш подписок в памяти: user_id -> (status, until_epoch) или None, если подписки нет.
+# set_sub пишет в него сразу после БД, поэтому проверка доступа — поиск в dict и сравнение int.
+_SUB_CACHE: Dict[int, Optional[Tuple[str, int]]] = {}
+_SUB_CACHE_STATS = {"hit": 0, "miss": 0}
+
+def _until_epoch(until_iso:str) -> int:
     try:
-        return datetime.datetime.fromisoformat(sub["until"]) >= datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return int(datetime.datetime.fromisoformat(until_iso).replace(tzinfo=datetime.timezone.utc).timestamp())
     except Exception:
-        return False
+        return 0  # нечитаемая дата = подписка неактивна
+
+def cached_sub(user_id:int) -> Optional[Tuple[str, int]]:
+    try:
+        return _SUB_CACHE[user_id]
+    except KeyError:
+        sub = get_sub(user_id)
+        val = (sub["status"], _until_epoch(sub["until"])) if sub else None
+        _SUB_CACHE[user_id] = val
+        return val
+
+def warm_sub_cache() -> int:
+    rows = storage().read(lambda conn: conn.execute("SELECT user_id, status, until FROM subscriptions").fetchall())
+    for r in rows:
+        _SUB_CACHE[r["user_id"]] = (r["status"], _until_epoch(r["until"]))
+    return len(rows)
+
+def _sub_ok(sub:Optional[Tuple[str, int]]) -> bool:
+    return sub is not None and sub[1] >= time.time()
+
+def sub_active(user_id:int) -> bool:
+    return _sub_ok(cached_sub(user_id))
 
 def grant_trial(user_id:int, days:int=TRIAL_DAYS) -> str:
     until = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(days=days)).replace(microsecond=0).isoformat()
@@ -197,75 +868,849 @@ def grant_month(user_id:int, months:int=1) -> str:
     set_sub(user_id, "active", until)
     return until
 
-def _hash_deal(url:str, title:str, code:str) -> str:
-    import hashlib
-    return hashlib.sha256((url + "|" + title + "|" + (code or "")).encode("utf-8")).hexdigest()
+def add_watch(user_id:int, store_slug:str) -> bool:
+    # -> False, если уже WATCH_LIMIT магазинов
+    def tx(conn):
+        with conn:
+            n = conn.execute("SELECT COUNT(*) FROM watches WHERE user_id=?", (user_id,)).fetchone()[0]
+            if n >= WATCH_LIMIT:
+                return False
+            conn.execute("INSERT OR IGNORE INTO watches(store_slug, user_id, created_ts) VALUES(?,?,?)",
+                         (store_slug, user_id, int(time.time())))
+            return True
+    return storage().write(tx)
+
+def remove_watch(user_id:int, store_slug:Optional[str]=None) -> int:
+    # store_slug=None — снять все
+    def tx(conn):
+        with conn:
+            if store_slug is None:
+                return conn.execute("DELETE FROM watches WHERE user_id=?", (user_id,)).rowcount
+            return conn.execute("DELETE FROM watches WHERE user_id=? AND store_slug=?", (user_id, store_slug)).rowcount
+    return storage().write(tx)
+
+def user_watches(user_id:int) -> List[str]:
+    return storage().read(lambda conn: [
+        r[0] for r in conn.execute("SELECT store_slug FROM watches WHERE user_id=? ORDER BY store_slug", (user_id,))
+    ])
+
+# ---------- СДЕЛКА ----------
+# Одна и та же запись от парсера до форматирования: кортеж с именованными полями,
+# без словаря на каждую сделку (184 байта против 464 у dict с теми же ключами).
+# Порядок полей: сначала то, что отдают парсеры (компактные кортежи из пула процессов
+# раскладываются как есть, см. deals_from_records), потом цены, потом то, что считается
+# при записи. Всё до id — колонки INSERT (_DEAL_KEYS); id и text_rank приходят из БД.
+class Deal(NamedTuple):
+    store_slug: str
+    title: str
+    description: str
+    url: str
+    coupon_code: str
+    start_at: Optional[str]
+    end_at: Optional[str]
+    source: str
+    score: float
+    price_old: Optional[float] = None
+    price_new: Optional[float] = None
+    cashback: Optional[float] = None
+    hash: Optional[str] = None
+    start_ts: Optional[int] = None
+    end_ts: Optional[int] = None
+    created_ts: Optional[int] = None
+    last_seen_ts: Optional[int] = None
+    id: Optional[int] = None
+    text_rank: Optional[float] = None
+
+_DEAL_KEYS = Deal._fields[:Deal._fields.index("id")]
+_DEAL_SELECT = f"SELECT {','.join(_DEAL_KEYS)}, id FROM deals"
+
+def _deal_row(cursor:sqlite3.Cursor, row:tuple) -> Deal:
+    return Deal(*row)
+
+def fetch_deals(conn:sqlite3.Connection, sql:str, args:tuple=()) -> List[Deal]:
+    # sql начинается с _DEAL_SELECT; строки сразу становятся Deal, минуя sqlite3.Row
+    cur = conn.cursor()
+    cur.row_factory = _deal_row
+    return cur.execute(sql, args).fetchall()
+
+# ---------- КЭШ ПОИСКА ----------
+# LRU с TTL: top-N сделок на store_slug. Запись сбрасывается точечно, когда
+# вставка/очистка трогает этот магазин, и сама устаревает, как только истекает
+# самая ранняя end_at среди закэшированных сделок.
+class SearchCache:
+    def __init__(self, max_entries:int, ttl:float, top_n:int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.top_n = top_n
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data: "OrderedDict[str, Tuple[List[Deal], float, int]]" = OrderedDict()
+        self._gen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, slug:str, now_ts:int) -> Optional[List[Deal]]:
+        with self._lock:
+            entry = self._data.get(slug)
+            if entry is not None:
+                rows, expires, min_end = entry
+                if expires > time.monotonic() and min_end >= now_ts:
+                    self._data.move_to_end(slug)
+                    self.hits += 1
+                    return rows
+                del self._data[slug]
+            self.misses += 1
+            return None
 
-def put_deals_bulk(deals:List[Dict[str,Any]]) -> int:
+    def generation(self, slug:str) -> int:
+        with self._lock:
+            return self._gen.get(slug, 0)
+
+    def put(self, slug:str, rows:List[Deal], gen:int):
+        min_end = min((r.end_ts for r in rows), default=TS_NEVER)
+        with self._lock:
+            # пока шёл запрос, магазин успели обновить — такой результат не кэшируем
+            if self._gen.get(slug, 0) != gen:
+                return
+            self._data[slug] = (rows, time.monotonic() + self.ttl, min_end)
+            self._data.move_to_end(slug)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, slugs):
+        with self._lock:
+            for slug in slugs:
+                self._gen[slug] = self._gen.get(slug, 0) + 1
+                if self._data.pop(slug, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for slug in self._data:
+                self._gen[slug] = self._gen.get(slug, 0) + 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations, "size": len(self._data)}
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_TOP_N)
+
+# ---------- КАНОНИЧЕСКИЙ КЛЮЧ СДЕЛКИ ----------
+# Один и тот же купон приходит из Admitad, CityAds и RSS с разными ссылками.
+# Ключ сделки — (магазин, код купона), а без кода — (магазин, ссылка без трекинга).
+# Совпавшие записи сливаются: остаётся лучший score и самый поздний end_at,
+# текст, ссылка и код — от записи с лучшим score. В БД хранятся исходные ссылка и код:
+# партнёрские параметры нужны для атрибуции, а код — ровно в том виде, в каком его примет
+# магазин; нормализуются они только в ключе.
+# только заведомо трекинговые параметры: ref и похожие у многих магазинов задают товар или лендинг
+_TRACKING_PARAM_RE = re.compile(
+    r"^(?:utm_\w+|sub_?id\d*|aff_sub\d*|click_?id|gclid|fbclid|yclid|ymclid|_openstat|"
+    r"admitad_uid|tagtag_uid|erid)$", re.IGNORECASE
+)
+_CODE_JUNK_RE = re.compile(r"[\s\u200b-\u200d\u2060\ufeff]+")
+_CODE_DASH_RE = re.compile(r"[\u2010-\u2015\u2212]")
+
+def canonical_url(url:Optional[str]) -> str:
+    if not url:
+        return ""
+    parts = urllib.parse.urlsplit(url.strip())
+    query = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not _TRACKING_PARAM_RE.match(k)
+    )
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/") or "/"
+    return urllib.parse.urlunsplit((parts.scheme.lower() or "https", host, path, urllib.parse.urlencode(query), ""))
+
+def normalize_code(code:Optional[str]) -> str:
+    return _CODE_DASH_RE.sub("-", _CODE_JUNK_RE.sub("", code or "")).upper()
+
+def _hash_deal(store_slug:Optional[str], url:Optional[str], title:Optional[str], code:Optional[str]) -> str:
+    # код нормализуется только для ключа: пользователю показываем его как прислал источник,
+    # бывают коды, чувствительные к регистру. Без кода и ссылки остаётся только заголовок.
+    code = normalize_code(code)
+    if code:
+        key = f"{store_slug}|code:{code}"
+    elif url:
+        key = f"{store_slug}|url:{canonical_url(url)}"
+    else:
+        key = f"{store_slug}|title:{(title or '').strip().lower()}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class DealFilter:
+    """Отпечатки (ключ, score, end_ts) уже применённых записей: повтор той же записи
+    отсекается до SQLite. Слияние монотонное (max), так что повтор — всегда no-op.
+    Точный set 64-битных отпечатков, а не Bloom: ложное срабатывание здесь
+    означало бы потерянную сделку. При переполнении просто сбрасывается."""
+    def __init__(self, max_items:int):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._seen: set = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, fp:int) -> bool:
+        return fp in self._seen
+
+    def add_many(self, fps:List[int]):
+        with self._lock:
+            if len(self._seen) + len(fps) > self.max_items:
+                self._seen.clear()
+            self._seen.update(fps)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+DEAL_FILTER = DealFilter(DEAL_FILTER_MAX)
+
+_I_SCORE, _I_END_AT, _I_END_TS = _DEAL_KEYS.index("score"), _DEAL_KEYS.index("end_at"), _DEAL_KEYS.index("end_ts")
+_I_SEEN, _I_CODE = _DEAL_KEYS.index("last_seen_ts"), _DEAL_KEYS.index("coupon_code")
+_UPSERT_DEAL_SQL = f"""
+    INSERT INTO deals({','.join(_DEAL_KEYS)}) VALUES({','.join(['?']*len(_DEAL_KEYS))})
+    ON CONFLICT(hash) DO UPDATE SET
+      title=iif(excluded.score > deals.score, excluded.title, deals.title),
+      description=iif(excluded.score > deals.score, excluded.description, deals.description),
+      url=iif(excluded.score > deals.score, excluded.url, deals.url),
+      coupon_code=iif(excluded.score > deals.score, excluded.coupon_code, deals.coupon_code),
+      source=iif(excluded.score > deals.score, excluded.source, deals.source),
+      end_at=iif(excluded.end_ts > deals.end_ts, excluded.end_at, deals.end_at),
+      end_ts=max(excluded.end_ts, deals.end_ts),
+      score=max(excluded.score, deals.score),
+      last_seen_ts=excluded.last_seen_ts
+    WHERE excluded.end_ts > deals.end_ts OR excluded.score > deals.score
+"""
+
+def _merge_rows(a:tuple, b:tuple) -> tuple:
+    # та же логика, что и в ON CONFLICT выше, для дублей внутри одной пачки
+    best = list(b if b[_I_SCORE] > a[_I_SCORE] else a)
+    latest = b if b[_I_END_TS] > a[_I_END_TS] else a
+    best[_I_END_AT], best[_I_END_TS] = latest[_I_END_AT], latest[_I_END_TS]
+    return tuple(best)
+
+def _upsert_batch(conn:sqlite3.Connection, batch:List[Tuple[str, tuple]]) -> Tuple[int, int, List[tuple]]:
+    # -> (вставлено, обновлено, вставленные строки — их текст в БД известен без чтения)
+    i_slug = _DEAL_KEYS.index("store_slug")
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        known = {
+            r[0]: (r[1], r[2], r[3] or 0) for r in conn.execute(
+                "SELECT hash, end_ts, score, last_seen_ts FROM deals WHERE hash IN (SELECT value FROM json_each(?))",
+                (json.dumps([h for h, _ in batch]),)
+            )
+        }
+        # строки, которые ничего не улучшат, до SQLite не доходят вовсе; у тех, что просто
+        # снова пришли в фиде, раз в DEAL_SEEN_REFRESH двигается только last_seen_ts
+        todo, seen = [], []
+        for h, row in batch:
+            if h not in known or row[_I_END_TS] > known[h][0] or row[_I_SCORE] > known[h][1]:
+                todo.append(row)
+            elif row[_I_SEEN] >= known[h][2] + DEAL_SEEN_REFRESH:
+                seen.append((row[_I_SEEN], row[_I_CODE], h))
+        conn.executemany(_UPSERT_DEAL_SQL, todo)
+        # код заодно: до исходного вида возвращаются коды, которые раньше писались нормализованными
+        conn.executemany("UPDATE deals SET last_seen_ts=?, coupon_code=? WHERE hash=?", seen)
+        slugs = {row[i_slug] for row in todo}
+        CACHE_EVENTS.publish(conn, "deals", slugs)
+    if todo:
+        SEARCH_CACHE.invalidate(slugs)
+    # в todo только новые и те, что улучшат запись (та же проверка, что в WHERE апдейта);
+    # total_changes тут не годится — в него попадают и строки, которые пишут триггеры FTS
+    inserted = [row for h, row in batch if h not in known]
+    return len(inserted), len(todo) - len(inserted), inserted
+
+def upsert_deals_bulk(deals:List[Deal]) -> Tuple[int, int]:
+    # -> (вставлено, обновлено). Пачками по DEALS_BATCH, каждая — отдельная транзакция
+    # в потоке-писателе: между пачками успевают пройти другие записи.
+    # Входные сделки не меняются: строка INSERT собирается рядом, в порядке _DEAL_KEYS.
     if not deals:
-        return 0
-    keys = ["store_slug","title","description","url","coupon_code","price_old","price_new",
-            "cashback","start_at","end_at","source","score","hash"]
-    qmarks = ",".join(["?"]*len(keys))
-    rows = []
+        return 0, 0
+    rows: Dict[str, tuple] = {}
+    now_ts = int(time.time())
     for d in deals:
-        d["hash"] = _hash_deal(d.get("url",""), d.get("title",""), d.get("coupon_code",""))
-        rows.append([d.get(k) for k in keys])
-    inserted = 0
-    with _DB_LOCK:
-        conn = db()
-        for row in rows:
-            try:
-                conn.execute(f"INSERT INTO deals({','.join(keys)}) VALUES({qmarks})", row)
-                inserted += 1
-            except sqlite3.IntegrityError:
-                pass
-        conn.commit()
+        code = (d.coupon_code or "").strip()
+        h = _hash_deal(d.store_slug, d.url, d.title, code)
+        row = (d.store_slug, d.title, d.description, d.url, code, d.start_at, d.end_at, d.source, d.score or 0,
+               d.price_old, d.price_new, d.cashback, h, parse_ts(d.start_at), parse_ts(d.end_at) or TS_NEVER,
+               now_ts, now_ts)
+        prev = rows.get(h)
+        rows[h] = row if prev is None else _merge_rows(prev, row)
+    items = []
+    for h, row in rows.items():
+        # период в отпечатке: раз в DEAL_SEEN_REFRESH сделка доходит до БД и обновляет last_seen_ts
+        fp = hash((h, row[_I_SCORE], row[_I_END_TS], now_ts // DEAL_SEEN_REFRESH))
+        if fp in DEAL_FILTER:
+            DEAL_FILTER.hits += 1
+        else:
+            items.append((fp, (h, row)))
+    DEAL_FILTER.misses += len(items)
+    inserted = updated = 0
+    for i in range(0, len(items), DEALS_BATCH):
+        chunk = items[i:i + DEALS_BATCH]
+        new, changed, rows_new = storage().write(_upsert_batch, [item for _, item in chunk])
+        DEAL_FILTER.add_many([fp for fp, _ in chunk])
+        RENDER_CACHE.fill(Deal(*row) for row in rows_new)
+        inserted += new
+        updated += changed
+    return inserted, updated
+
+def put_deals_bulk(deals:List[Deal]) -> int:
+    inserted, updated = upsert_deals_bulk(deals)
+    if updated:
+        log.info("[DB] deals refreshed: %s", updated)
     return inserted
 
-def search_deals(store_slug:str, limit:int=8) -> List[dict]:
-    with _DB_LOCK:
-        conn = db()
-        cur = conn.execute(
-            """
-            SELECT * FROM deals
-            WHERE store_slug=?
-              AND (end_at IS NULL OR end_at >= ?)
-            ORDER BY
-                score DESC,
-                CASE WHEN end_at IS NULL THEN 1 ELSE 0 END,
-                end_at ASC,
-                created_at DESC
-            LIMIT ?
-            """,
-            (store_slug, _now_iso_naive_utc(), limit)
-        )
-        return [dict(r) for r in cur.fetchall()
+# id в конце сортировки — для однозначного курсора; порядок совпадает с idx_deals_hot
+# (в записи индекса rowid идёт последним, по возрастанию), так что сортировки нет
+_SEARCH_SQL = _DEAL_SELECT + """
+    WHERE store_slug=? AND end_ts>=?
+    ORDER BY score DESC, end_ts ASC, created_ts DESC, id ASC
+    LIMIT ?
+"""
+
+# Следующая страница — seek по ключу сортировки последней показанной сделки, а не OFFSET.
+# Ключ с разными направлениями одним диапазоном индекса не выразить, поэтому «всё после
+# курсора» разбито на четыре хвоста в порядке выдачи; каждый — поиск по idx_deals_hot,
+# и страница 1000 стоит столько же, сколько вторая.
+_PAGE_SQL = [
+    _DEAL_SELECT + f""" WHERE store_slug=? AND end_ts>=? AND {cond}
+        ORDER BY score DESC, end_ts ASC, created_ts DESC, id ASC LIMIT ?"""
+    for cond in (
+        "score=? AND end_ts=? AND created_ts=? AND id>?",
+        "score=? AND end_ts=? AND created_ts<?",
+        "score=? AND end_ts>?",
+        "score<?",
+    )
+]
+
+def _search_query(conn:sqlite3.Connection, store_slug:str, now_ts:int, limit:int) -> List[Deal]:
+    return fetch_deals(conn, _SEARCH_SQL, (store_slug, now_ts, limit))
+
+def _deal_store(conn:sqlite3.Connection, deal_id:int) -> Optional[str]:
+    row = conn.execute("SELECT store_slug FROM deals WHERE id=?", (deal_id,)).fetchone()
+    return row[0] if row else None
+
+def _page_query(conn:sqlite3.Connection, after_id:int, now_ts:int, limit:int) -> Optional[List[Deal]]:
+    # курсор — id последней показанной сделки, ключ сортировки берём по PK;
+    # None — сделки уже нет (очистка), листать дальше не от чего
+    key = conn.execute("SELECT store_slug, score, end_ts, created_ts FROM deals WHERE id=?", (after_id,)).fetchone()
+    if key is None:
+        return None
+    slug, score, end_ts, created_ts = key
+    tails = ((score, end_ts, created_ts, after_id), (score, end_ts, created_ts), (score, end_ts), (score,))
+    rows: List[Deal] = []
+    for sql, args in zip(_PAGE_SQL, tails):
+        rows += fetch_deals(conn, sql, (slug, now_ts) + args + (limit - len(rows),))
+        if len(rows) >= limit:
+            break
+    return rows
+
+def search_plan(conn:sqlite3.Connection) -> List[str]:
+    # EXPLAIN QUERY PLAN горячего запроса и страницы: ожидаем idx_deals_hot и никакого TEMP B-TREE
+    plan = [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + _SEARCH_SQL, ("ozon", 0, 8))]
+    for sql in _PAGE_SQL:
+        args = ("ozon", 0) + (1,) * (sql.count("?") - 3) + (8,)
+        plan += [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, args)]
+    return plan
+
+def search_deals(store_slug:str, limit:int=8) -> List[Deal]:
+    now_ts = int(time.time())
+    if limit > SEARCH_CACHE.top_n:
+        return storage().read(_search_query, store_slug, now_ts, limit)
+    cached = SEARCH_CACHE.get(store_slug, now_ts)
+    if cached is not None:
+        return cached[:limit]
+    gen = SEARCH_CACHE.generation(store_slug)
+    rows = storage().read(_search_query, store_slug, now_ts, SEARCH_CACHE.top_n)
+    SEARCH_CACHE.put(store_slug, rows, gen)
+    return rows[:limit]
+
+async def asearch_deals(store_slug:str, limit:int=8) -> List[Deal]:
+    # попадание в кэш отвечаем прямо в loop, в БД идём только при промахе
+    now_ts = int(time.time())
+    if limit > SEARCH_CACHE.top_n:
+        return await storage().aread(_search_query, store_slug, now_ts, limit)
+    cached = SEARCH_CACHE.get(store_slug, now_ts)
+    if cached is not None:
+        return cached[:limit]
+    gen = SEARCH_CACHE.generation(store_slug)
+    rows = await storage().aread(_search_query, store_slug, now_ts, SEARCH_CACHE.top_n)
+    SEARCH_CACHE.put(store_slug, rows, gen)
+    return rows[:limit]
+
+def search_deals_after(after_id:int, limit:int=8) -> Optional[List[Deal]]:
+    return storage().read(_page_query, after_id, int(time.time()), limit)
+
+async def asearch_deals_after(after_id:int, limit:int=8) -> Optional[List[Deal]]:
+    return await storage().aread(_page_query, after_id, int(time.time()), limit)
+
+# ---------- ПОИСК ПО ТЕКСТУ ----------
+# FTS5 отдаёт TEXT_SEARCH_POOL самых свежих живых совпадений: обход по rowid с конца
+# останавливается на лимите, и частое слово не заставляет читать весь индекс.
+# Встроенный bm25() так не умеет — он каждый раз пересчитывает, в скольких документах
+# есть терм (O(числа совпадений), на 1M сделок это десятки мс). Поэтому кандидатов
+# ранжируем здесь тем же BM25, а document frequency термов берём из кэша TextStats.
+# Итог (text_rank в выдаче): bm25 + TEXT_SCORE_WEIGHT * score сделки.
+# Русские окончания срезаем и ищем по префиксу: «кроссовки» найдёт «кроссовок».
+# Основа обрезается до 4–6 символов — ровно под prefix-индексы deals_fts.
+TEXT_SEARCH_POOL = int(os.environ.get("TEXT_SEARCH_POOL", "500"))
+TEXT_SCORE_WEIGHT = 5.0
+TEXT_STATS_TTL = 600
+_TEXT_COLUMNS = (("title", 10.0), ("description", 2.0), ("store_slug", 5.0))
+_BM25_K1, _BM25_B = 1.2, 0.75
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def _text_words(text:str) -> List[str]:
+    # как токенайзер unicode61 remove_diacritics: регистр и «ё» не различаем
+    return _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+
+def text_terms(text:str) -> List[Tuple[str, bool]]:
+    # -> [(терм, префиксный ли)]; короткие слова ищем точно
+    terms = []
+    for w in _text_words(text)[:8]:
+        if len(w) < 4:
+            terms.append((w, False))
+            continue
+        if w.isalpha() and len(w) >= 6:
+            w = w[:-2]
+        elif w.isalpha() and len(w) == 5:
+            w = w[:-1]
+        terms.append((w[:6], True))
+    return terms
+
+def _fts_term(term:str, prefix:bool) -> str:
+    return f'"{term}"*' if prefix else f'"{term}"'
+
+def fts_query(terms:List[Tuple[str, bool]], store_slug:Optional[str]=None) -> Optional[str]:
+    if not terms:
+        return None
+    q = " ".join(_fts_term(t, p) for t, p in terms)
+    if store_slug:
+        q = f'store_slug : "{store_slug}" AND ({q})'
+    return q
+
+class TextStats:
+    """Число документов и document frequency термов для BM25. Меняются медленно,
+    поэтому живут TEXT_STATS_TTL секунд; первый запрос с новым термом платит за подсчёт."""
+    def __init__(self, ttl:float, max_terms:int=10000):
+        self.ttl = ttl
+        self.max_terms = max_terms
+        self._df: Dict[Tuple[str, bool], Tuple[float, int]] = {}
+        self._docs: Tuple[float, int] = (0.0, 0)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def doc_count(self, conn:sqlite3.Connection) -> int:
+        at, n = self._docs
+        if time.monotonic() - at > self.ttl:
+            n = conn.execute("SELECT COUNT(*) FROM deals").fetchone()[0]
+            self._docs = (time.monotonic(), n)
+        return n
+
+    def df(self, conn:sqlite3.Connection, term:Tuple[str, bool]) -> int:
+        hit = self._df.get(term)
+        if hit and time.monotonic() - hit[0] <= self.ttl:
+            self.hits += 1
+            return hit[1]
+        self.misses += 1
+        n = conn.execute("SELECT COUNT(*) FROM deals_fts WHERE deals_fts MATCH ?", (_fts_term(*term),)).fetchone()[0]
+        with self._lock:
+            if len(self._df) >= self.max_terms:
+                self._df.clear()
+            self._df[term] = (time.monotonic(), n)
+        return n
+
+TEXT_STATS = TextStats(TEXT_STATS_TTL)
+
+# живость проверяется до LIMIT: просроченные совпадения не занимают место в пуле кандидатов
+_TEXT_SQL = """
+    SELECT d.id, d.title, d.description, d.store_slug, d.score, d.end_ts
+    FROM deals_fts JOIN deals d ON d.id = deals_fts.rowid
+    WHERE deals_fts MATCH ? AND d.end_ts >= ?
+    ORDER BY deals_fts.rowid DESC LIMIT ?
+"""
+
+def _term_re(term:str, prefix:bool) -> "re.Pattern":
+    return re.compile(r"(?<!\w)" + re.escape(term) + ("" if prefix else r"(?!\w)"))
 
-        ]
+def _rank_text(rows:List[sqlite3.Row], terms:List[Tuple[str, bool]], idf:List[float]) -> List[Tuple[float, int, int]]:
+    # -> [(итоговый ранг, end_ts, id)]; длина колонки в словах — по пробелам, этого хватает для нормировки
+    matchers = [(_term_re(t, p), w_idf) for (t, p), w_idf in zip(terms, idf)]
+    cols = [[(r[col] or "").lower().replace("ё", "е") for col, _ in _TEXT_COLUMNS] for r in rows]
+    # средняя длина колонки — по самим кандидатам, без прохода по таблице
+    avg = [max(1.0, sum(c[i].count(" ") + 1 for c in cols) / len(cols)) for i in range(len(_TEXT_COLUMNS))]
+    ranked = []
+    for r, texts in zip(rows, cols):
+        bm25 = 0.0
+        for rx, w_idf in matchers:
+            for i, (_, weight) in enumerate(_TEXT_COLUMNS):
+                tf = len(rx.findall(texts[i]))
+                if tf:
+                    norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * (texts[i].count(" ") + 1) / avg[i])
+                    bm25 += w_idf * weight * tf * (_BM25_K1 + 1) / (tf + norm)
+        ranked.append((bm25 + TEXT_SCORE_WEIGHT * (r["score"] or 0), r["end_ts"], r["id"]))
+    return ranked
 
-def cleanup_old(days:int=60):
-    threshold = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=days)).isoformat()
-    with _DB_LOCK:
-        conn = db()
-        conn.execute("DELETE FROM deals WHERE (end_at IS NOT NULL AND end_at < ?) OR created_at < ?", (threshold, threshold))
-        conn.commit()
+def _text_query(conn:sqlite3.Connection, terms:List[Tuple[str, bool]], store_slug:Optional[str],
+                now_ts:int, limit:int) -> List[Deal]:
+    rows = conn.execute(_TEXT_SQL, (fts_query(terms, store_slug), now_ts, TEXT_SEARCH_POOL)).fetchall()
+    if not rows:
+        return []
+    n = TEXT_STATS.doc_count(conn)
+    idf = [math.log(1 + max(0.0, n - df + 0.5) / (df + 0.5)) for df in (TEXT_STATS.df(conn, t) for t in terms)]
+    ranked = sorted(_rank_text(rows, terms, idf), key=lambda x: (-x[0], x[1]))[:limit]
+    full = {d.id: d for d in fetch_deals(
+        conn, _DEAL_SELECT + " WHERE id IN (SELECT value FROM json_each(?))", (json.dumps([i for _, _, i in ranked]),)
+    )}
+    return [full[i]._replace(text_rank=round(rank, 3)) for rank, _, i in ranked if i in full]
+
+def search_text(text:str, store_slug:Optional[str]=None, limit:int=8) -> List[Deal]:
+    terms = text_terms(text)
+    return storage().read(_text_query, terms, store_slug, int(time.time()), limit) if terms else []
+
+async def asearch_text(text:str, store_slug:Optional[str]=None, limit:int=8) -> List[Deal]:
+    terms = text_terms(text)
+    return await storage().aread(_text_query, terms, store_slug, int(time.time()), limit) if terms else []
+
+# Очистка: маленькими пачками по rowid, каждая — отдельная задача писателя,
+# между пачками пауза, чтобы вставки и подписки не стояли в очереди за чисткой.
+def _expire_batch(conn:sqlite3.Connection, column:str, threshold:int, limit:int) -> Tuple[int, float]:
+    t0 = time.perf_counter()
+    with conn:
+        slugs = [r[0] for r in conn.execute(
+            f"DELETE FROM deals WHERE id IN (SELECT id FROM deals WHERE {column} < ? LIMIT ?) RETURNING store_slug",
+            (threshold, limit)
+        )]
+    held = time.perf_counter() - t0
+    if slugs:
+        SEARCH_CACHE.invalidate(set(slugs))
+    return len(slugs), held
+
+def _vacuum_step(conn:sqlite3.Connection, pages:int) -> Tuple[int, float]:
+    # -> (сколько свободных страниц осталось, сколько держали блокировку)
+    t0 = time.perf_counter()
+    # execute() делает один шаг = одна страница; executescript прогоняет pragma до конца
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0], time.perf_counter() - t0
+
+def _db_size(conn:sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+def cleanup_old(days:int=60) -> Dict[str, Any]:
+    threshold = int(time.time()) - days * 86400
+    st = storage()
+    stats: Dict[str, Any] = {"removed": 0, "batches": 0, "lock_held_s": 0.0}
+    size_before = st.read(_db_size)
+    # по last_seen_ts, а не created_ts: сделка, которая всё ещё в фиде, не удаляется
+    # и не приходит потом заново с новым id как «новая» в рассылку /watch
+    for column in ("end_ts", "last_seen_ts"):
+        while True:
+            removed, held = st.write(_expire_batch, column, threshold, CLEANUP_BATCH)
+            stats["removed"] += removed
+            stats["batches"] += 1
+            stats["lock_held_s"] += held
+            if removed < CLEANUP_BATCH:
+                break
+            time.sleep(CLEANUP_PAUSE)
+    if stats["removed"]:
+        DEAL_FILTER.clear()  # удалённая сделка может прийти снова, её нельзя отсекать
+        RENDER_CACHE.clear()  # и с тем же hash, score и end_ts, но другим текстом
+        CACHE_EVENTS.notify("reset")
+
+    if st.write(lambda conn: conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+        # БД создана до перехода на incremental: один полный VACUUM применяет режим
+        t0 = time.perf_counter()
+        st.write(lambda conn: conn.execute("VACUUM"))
+        stats["lock_held_s"] += time.perf_counter() - t0
+        log.info("[CLEANUP] converted DB to incremental auto_vacuum")
+    while True:
+        left, held = st.write(_vacuum_step, CLEANUP_VACUUM_PAGES)
+        stats["lock_held_s"] += held
+        if not left:
+            break
+        time.sleep(CLEANUP_PAUSE)
+    st.write(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+
+    stats["reclaimed_bytes"] = size_before - st.read(_db_size)
+    stats["lock_held_s"] = round(stats["lock_held_s"], 3)
+    return stats
+
+def get_source_state(key:str) -> Optional[dict]:
+    def q(conn):
+        r = conn.execute("SELECT * FROM source_state WHERE key=?", (key,)).fetchone()
+        return dict(r) if r else None
+    return storage().read(q)
+
+def get_source_states(keys:List[str]) -> Dict[str,dict]:
+    def q(conn):
+        rows = conn.execute(
+            "SELECT * FROM source_state WHERE key IN (SELECT value FROM json_each(?))", (json.dumps(keys),)
+        ).fetchall()
+        return {r["key"]: dict(r) for r in rows}
+    return storage().read(q) if keys else {}
+
+def _set_source_state(conn:sqlite3.Connection, key:str, fields:dict):
+    cols = ["key"] + list(fields)
+    conn.execute(
+        f"INSERT INTO source_state({','.join(cols)}) VALUES({','.join('?' * len(cols))}) "
+        f"ON CONFLICT(key) DO UPDATE SET " + ",".join(f"{c}=excluded.{c}" for c in fields),
+        [key] + list(fields.values())
+    )
+
+def set_source_state(key:str, **fields):
+    set_source_states({key: fields})
+
+def set_source_states(states:Dict[str,dict]):
+    # несколько ключей — одной транзакцией
+    def tx(conn):
+        with conn:
+            for key, fields in states.items():
+                _set_source_state(conn, key, fields)
+    if states:
+        storage().write(tx)
 
 # ---------- УТИЛИТЫ ----------
 UA = {"User-Agent": "Mozilla/5.0 (compatible; HalyavaBot/1.2)"}
 
 def slug_for_query(q:str) -> Optional[str]:
-    q = q.strip().lower()
-    return STORE_ALIASES.get(q) or (q if q in POPULAR_STORES else None)
+    return STORE_RESOLVER.resolve(q)
 
 def esc(s:str) -> str:
     return html.escape(s or "")
 
+# ---------- ПОИСК МАГАЗИНА В ТЕКСТЕ ----------
+# Алиасы собраны в префиксное дерево и скомпилированы в один regex: текст
+# проходится один раз, а не по разу на каждый алиас. Приоритет детерминирован: выигрывает самое левое
+# вхождение, а среди начинающихся в одной позиции — самое длинное.
+def _trie_regex(words:List[str]) -> str:
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node:Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # жадный необязательный хвост => из алиасов с общим началом берём более длинный
+        return "(?:" + body + ")?" if "" in node else body
+
+    return build(trie)
+
+class StoreMatcher:
+    def __init__(self, aliases:Dict[str, str], squash_spaces:bool=False):
+        table: Dict[str, str] = {}
+        for alias, slug in aliases.items():
+            alias = alias.lower()
+            table.setdefault(alias, slug)
+            if squash_spaces:
+                table.setdefault(alias.replace(" ", ""), slug)
+        self._table = table
+        self._re = re.compile(_trie_regex(sorted(table))) if table else None
+
+    def match(self, text:str) -> Optional[str]:
+        if not text or self._re is None:
+            return None
+        m = self._re.search(text.lower())
+        return self._table[m.group(0)] if m else None
+
+STORE_MATCHER = StoreMatcher(STORE_ALIASES)
+# для хостов промо-страниц: «яндекс маркет» ищем и как «яндексмаркет»
+HOST_MATCHER = StoreMatcher(STORE_ALIASES, squash_spaces=True)
+
+# Нечёткое распознавание магазина: триграммный индекс по алиасам и slug'ам
+# отбирает кандидатов, расстояние Левенштейна подтверждает («wildberies» -> wildberries).
+def _trigrams(s:str) -> set:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _edit_distance(a:str, b:str, limit:int) -> int:
+    # -> расстояние, или limit + 1, если оно точно больше limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+_FUZZY_MIN_LEN = 4  # слова и алиасы короче сравниваются только точно
+
+class StoreResolver:
+    def __init__(self, aliases:Dict[str, str]):
+        names = {a.lower(): s for a, s in aliases.items()}
+        for slug in set(aliases.values()):
+            names.setdefault(slug, slug)
+            names.setdefault(slug.replace("_", " "), slug)
+        self._names = names
+        self._index: Dict[str, List[str]] = {}
+        for name in names:
+            for g in _trigrams(name):
+                self._index.setdefault(g, []).append(name)
+
+    def resolve(self, q:str, fuzzy:bool=True) -> Optional[str]:
+        q = " ".join((q or "").lower().split())
+        if not q:
+            return None
+        if q in self._names:
+            return self._names[q]
+        # короткие слова только точно: иначе предлог «в» находит «вб»
+        if not fuzzy or len(q) < _FUZZY_MIN_LEN:
+            return None
+        grams = _trigrams(q)
+        shared: Dict[str, int] = {}
+        for g in grams:
+            for name in self._index.get(g, ()):
+                shared[name] = shared.get(name, 0) + 1
+        limit = max(1, len(q) // 4)
+        best = None
+        for name, n in sorted(shared.items(), key=lambda kv: -kv[1])[:10]:
+            if n * 3 < len(grams):  # меньше трети общих триграмм — не тот магазин
+                break
+            if len(name) < _FUZZY_MIN_LEN:
+                continue
+            d = _edit_distance(q, name, limit)
+            if d <= limit and (best is None or d < best[0]):
+                best = (d, name)
+        return self._names[best[1]] if best else None
+
+    def split(self, q:str) -> Tuple[Optional[str], str]:
+        # «ozon айфон» -> ("ozon", "айфон"); весь запрос — магазин -> (slug, "")
+        # Точное совпадение в любом месте запроса важнее нечёткого в более раннем слове.
+        slug = self.resolve(q)
+        if slug:
+            return slug, ""
+        words = q.lower().split()
+        for fuzzy in (False, True):
+            for i in range(len(words)):
+                for n in (2, 1):  # сначала пары слов: «яндекс маркет»
+                    slug = self.resolve(" ".join(words[i:i + n]), fuzzy) if i + n <= len(words) else None
+                    if slug:
+                        return slug, " ".join(words[:i] + words[i + n:])
+        return None, q
+
+STORE_RESOLVER = StoreResolver(STORE_ALIASES)
+
+# ---------- HTTP ----------
+# Один пул keep-alive соединений на процесс + лимит параллельности на хост.
+_HTTP: Optional[aiohttp.ClientSession] = None
+_HOST_SEMS: Dict[str, asyncio.Semaphore] = {}
+
+def http() -> aiohttp.ClientSession:
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONCURRENCY, limit_per_host=HTTP_PER_HOST,
+            keepalive_timeout=60, ttl_dns_cache=300
+        )
+        _HTTP = aiohttp.ClientSession(connector=connector, headers=UA)
+    return _HTTP
+
+async def close_http():
+    global _HTTP
+    if _HTTP is not None and not _HTTP.closed:
+        await _HTTP.close()
+    _HTTP = None
+    _HOST_SEMS.clear()
+
+def _host_sem(url:str) -> asyncio.Semaphore:
+    host = urllib.parse.urlsplit(url).hostname or ""
+    sem = _HOST_SEMS.get(host)
+    if sem is None:
+        sem = _HOST_SEMS[host] = asyncio.Semaphore(HTTP_PER_HOST)
+    return sem
+
+async def http_fetch(url:str, *, method:str="GET", params:Optional[dict]=None, headers:Optional[dict]=None,
+                     data:Any=None, auth:Optional[aiohttp.BasicAuth]=None, timeout:float=30) -> Tuple[int, Mapping[str,str], bytes]:
+    # таймаут считаем с момента, когда получили слот хоста, а не с постановки в очередь
+    async with _host_sem(url):
+        async with http().request(
+            method, url, params=params, headers=headers, data=data, auth=auth,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as r:
+            body = await r.read()
+            r.raise_for_status()
+            return r.status, r.headers.copy(), body
+
+async def http_download(url:str, *, timeout:float=60, spool_over:int=PARSE_STREAM_THRESHOLD,
+                        headers:Optional[dict]=None) -> Tuple[int, Mapping[str,str], Optional[bytes], Optional[str]]:
+    # Как http_fetch, но тело больше spool_over байт пишется во временный файл:
+    # -> (status, headers, body, None) или (status, headers, None, путь к файлу)
+    async with _host_sem(url):
+        async with http().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            r.raise_for_status()
+            buf = bytearray()
+            f = None
+            try:
+                async for chunk in r.content.iter_chunked(1 << 16):
+                    if f is not None:
+                        await asyncio.to_thread(f.write, chunk)
+                        continue
+                    buf += chunk
+                    if len(buf) > spool_over:
+                        f = tempfile.NamedTemporaryFile(prefix="halyava-feed-", delete=False)
+                        await asyncio.to_thread(f.write, bytes(buf))
+                        buf = bytearray()
+            except BaseException:
+                if f is not None:
+                    f.close()
+                    os.unlink(f.name)
+                raise
+            if f is not None:
+                f.close()
+                return r.status, r.headers.copy(), None, f.name
+            return r.status, r.headers.copy(), bytes(buf), None
+
+# ---------- РАЗБОР ВНЕ EVENT LOOP ----------
+# feedparser и BeautifulSoup упираются в CPU и держат GIL, поэтому тяжёлые фиды
+# разбираются в пуле процессов. Обратно приходят компактные кортежи — первые поля Deal
+# в том же порядке, — а не деревья разбора; Deal из них собираются уже здесь.
+_PARSE_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+def parse_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _PARSE_POOL
+    if _PARSE_POOL is None:
+        # spawn: форк процесса с живыми потоками (писатель БД, aiohttp) небезопасен
+        _PARSE_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _PARSE_POOL
+
+def shutdown_parse_pool():
+    global _PARSE_POOL
+    if _PARSE_POOL is not None:
+        _PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+    _PARSE_POOL = None
+
+async def run_parser(fn:Callable, *args) -> Any:
+    if PARSE_WORKERS <= 0:
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(parse_pool(), fn, *args)
+
+def deals_from_records(records:List[tuple]) -> List[Deal]:
+    return [Deal(*rec) for rec in records]
+
 # ---------- ИСТОЧНИКИ ----------
+# Сеть — в event loop (aiohttp), тяжёлый разбор — в пуле процессов (run_parser),
+# лёгкий разбор JSON и запись в БД — в потоках, чтобы бот отвечал, пока идёт сбор.
+
 # 1) Admitad Coupons
 _admitad_cached_token: Dict[str, Any] = {"value": ADMITAD_ACCESS_TOKEN.strip(), "exp": 0}
 
-def admitad_get_token() -> Optional[str]:
+async def admitad_get_token() -> Optional[str]:
     if _admitad_cached_token["value"] and _admitad_cached_token["exp"] > time.time():
         return _admitad_cached_token["value"]
     if ADMITAD_ACCESS_TOKEN.strip():
@@ -275,14 +1720,13 @@ def admitad_get_token() -> Optional[str]:
     if not (ADMITAD_CLIENT_ID and ADMITAD_CLIENT_SECRET):
         return None
     try:
-        resp = requests.post(
-            "https://api.admitad.com/token/",
+        _, _, body = await http_fetch(
+            f"{ADMITAD_API_URL}/token/", method="POST",
             data={"grant_type": "client_credentials", "scope": "coupons"},
-            auth=(ADMITAD_CLIENT_ID, ADMITAD_CLIENT_SECRET),
+            auth=aiohttp.BasicAuth(ADMITAD_CLIENT_ID, ADMITAD_CLIENT_SECRET),
             timeout=20
         )
-        resp.raise_for_status()
-        data = resp.json()
+        data = json.loads(body)
         token = data.get("access_token")
         ttl = data.get("expires_in", 3600)
         if token:
@@ -293,199 +1737,1424 @@ def admitad_get_token() -> Optional[str]:
         log.warning("[ADMITAD] token error: %s", e)
     return None
 
-def pull_admitad() -> int:
+# slug -> id кампаний Admitad, встреченных в выдаче: по ним обновляем один магазин
+ADMITAD_CAMPAIGNS: Dict[str, set] = {}
+
+def parse_admitad(body:bytes) -> List[Deal]:
+    js = json.loads(body)
+    results = js.get("results") or []
+    out = []
+    for it in results:
+        campaign = (it.get("campaign") or {}).get("name") or ""
+        campaign_id = (it.get("campaign") or {}).get("id")
+        code = it.get("promocode") or ""
+        title = it.get("short_name") or it.get("code") or campaign
+        desc = it.get("description") or ""
+        start_at = it.get("date_start")
+        end_at = it.get("date_end")
+        link = it.get("tracked_link") or it.get("goto_link") or it.get("link") or ""
+
+        store_slug = STORE_MATCHER.match(campaign)
+        if not store_slug:
+            store_slug = re.sub(r"[^a-z0-9]+", "_", campaign.lower()).strip("_") or "unknown"
+        if campaign_id is not None:
+            ADMITAD_CAMPAIGNS.setdefault(store_slug, set()).add(campaign_id)
+
+        score = 1.0 + (0.5 if code else 0) + (0.2 if end_at else 0)
+        out.append(Deal(store_slug, title, desc, link, code, start_at, end_at, "admitad", score))
+    return out
+
+async def admitad_pages(token:str, campaigns:Optional[List[int]]=None) -> AsyncIterator[Tuple[str, Optional[bytes], Mapping[str,str], Optional[dict]]]:
+    # Постраничный обход (limit/offset) с If-None-Match по сохранённому ETag страницы.
+    # -> (ключ страницы, тело или None при 304, заголовки, прошлое состояние страницы)
+    # Конец выдачи определяет вызывающий код: короткая страница = последняя.
+    url = f"{ADMITAD_API_URL}/coupons/website/{ADMITAD_WEBSITE_ID}/"
+    scope = "admitad" + (":" + ",".join(map(str, campaigns)) if campaigns else "")
+    offset = 0
+    while True:
+        key = f"{scope}:{offset}"
+        state = await asyncio.to_thread(get_source_state, key)
+        params = [("limit", ADMITAD_PAGE_SIZE), ("offset", offset), ("language", "ru"), ("region", "RU"),
+                  ("status", "active"), ("ordering", "-date_start")]
+        params += [("campaign", c) for c in campaigns or ()]
+        headers = {"Authorization": f"Bearer {token}"}
+        if state and state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        with SOURCE_SECONDS.time("admitad", "fetch"):
+            status, resp_headers, body = await http_fetch(url, headers=headers, params=params, timeout=30)
+        yield key, (None if status == 304 else body), resp_headers, state
+        offset += ADMITAD_PAGE_SIZE
+
+async def pull_admitad(campaigns:Optional[List[int]]=None) -> int:
+    # campaigns — только эти кампании (обновление одного магазина), None — вся выдача.
+    # Страницы разбираются и пишутся по мере прихода: в памяти одна страница.
+    # Выдача отсортирована по -date_start, новое приходит в начало; после
+    # ADMITAD_STOP_AFTER_UNCHANGED страниц подряд без новых/изменённых купонов (304,
+    # тот же хэш тела или все купоны уже в БД) хвост не качаем — кроме полного
+    # прохода раз в ADMITAD_FULL_SWEEP_HOURS.
     if not ADMITAD_WEBSITE_ID:
         return 0
-    token = admitad_get_token()
+    token = await admitad_get_token()
     if not token:
         return 0
-    url = f"https://api.admitad.com/coupons/website/{ADMITAD_WEBSITE_ID}/"
-    params = {"limit": 500, "language": "ru", "region": "RU", "status": "active", "ordering": "-date_end"}
-    headers = {"Authorization": f"Bearer {token}"}
-    added = 0
+    sweep_key = "admitad:sweep" + (":" + ",".join(map(str, campaigns)) if campaigns else "")
+    sweep = await asyncio.to_thread(get_source_state, sweep_key)
+    now = int(time.time())
+    full = not sweep or now - (sweep.get("checked_ts") or 0) >= ADMITAD_FULL_SWEEP_HOURS * 3600
+    added = pages = skipped = unchanged_run = 0
+    complete = False
     try:
-        log.info("[SRC][ADMITAD] %s", url)
-        r = requests.get(url, headers=headers, params=params, timeout=30)
-        r.raise_for_status()
-        js = r.json()
-        results = js.get("results") or []
-        out = []
-        for it in results:
-            campaign = (it.get("campaign") or {}).get("name") or ""
-            code = it.get("promocode") or ""
-            title = it.get("short_name") or it.get("code") or campaign
-            desc = it.get("description") or ""
-            start_at = it.get("date_start")
-            end_at = it.get("date_end")
-            link = it.get("tracked_link") or it.get("goto_link") or it.get("link") or ""
-
-            store_slug = None
-            c = campaign.lower()
-            for k, v in STORE_ALIASES.items():
-                if k in c:
-                    store_slug = v
+        log.info("[SRC][ADMITAD] %s pages (full=%s)", "campaigns %s" % campaigns if campaigns else "all", full)
+        async with contextlib.aclosing(admitad_pages(token, campaigns)) as page_iter:
+            async for key, body, headers, state in page_iter:
+                pages += 1
+                body_hash = hashlib.sha1(body).hexdigest() if body is not None else None
+                if body is None or (state and state.get("body_hash") == body_hash):
+                    skipped += 1
+                    unchanged_run += 1
+                    items = (state or {}).get("items") or 0
+                    etag = headers.get("ETag") or (state or {}).get("etag")
+                    await asyncio.to_thread(set_source_state, key, etag=etag, checked_ts=now)
+                    if items < ADMITAD_PAGE_SIZE:
+                        complete = True
+                        break
+                    if not full and unchanged_run >= ADMITAD_STOP_AFTER_UNCHANGED:
+                        break
+                    continue
+                with SOURCE_SECONDS.time("admitad", "parse"):
+                    out = await asyncio.to_thread(parse_admitad, body)
+                with SOURCE_SECONDS.time("admitad", "insert"):
+                    inserted, updated = await asyncio.to_thread(upsert_deals_bulk, out)
+                SOURCE_ITEMS.inc("admitad", "parsed", value=len(out))
+                SOURCE_ITEMS.inc("admitad", "added", value=inserted)
+                added += inserted
+                # состояние страницы — только после успешной записи, иначе при сбое повторим её
+                await asyncio.to_thread(
+                    set_source_state, key, etag=headers.get("ETag"), body_hash=body_hash,
+                    items=len(out), checked_ts=now, changed_ts=now
+                )
+                if len(out) < ADMITAD_PAGE_SIZE:
+                    complete = True
+                    break
+                # страница изменилась только сдвигом: все купоны на ней уже есть и не менялись
+                unchanged_run = 0 if inserted or updated else unchanged_run + 1
+                if not full and unchanged_run >= ADMITAD_STOP_AFTER_UNCHANGED:
                     break
-            if not store_slug:
-                store_slug = re.sub(r"[^a-z0-9]+", "_", campaign.lower()).strip("_") or "unknown"
-
-            score = 1.0 + (0.5 if code else 0) + (0.2 if end_at else 0)
-            out.append(dict(
-                store_slug=store_slug, title=title, description=desc, url=link, coupon_code=code,
-                price_old=None, price_new=None, cashback=None,
-                start_at=start_at, end_at=end_at, source="admitad", score=score
-            ))
-        added += put_deals_bulk(out)
+        if full and complete:
+            await asyncio.to_thread(set_source_state, sweep_key, checked_ts=now)
+        log.info("[SRC][ADMITAD] pages=%s unchanged=%s added=%s", pages, skipped, added)
     except Exception as e:
-        log.error("[ADMITAD] error: %s", e)
+        # наружу: по ошибке планировщик откладывает следующий запуск источника
+        log.error("[ADMITAD] error after %s pages, added=%s: %s", pages, added, e)
+        raise
     return added
 
 # 2) CityAds feed (JSON/XML)
-def pull_cityads() -> int:
+_CITYADS_CODE_RE = re.compile(r"(?:promo|код|code)\s*[:\- ]\s*([A-Z0-9\-]{4,16})", re.IGNORECASE)
+
+def _cityads_json_record(it:dict) -> tuple:
+    store = (it.get("campaign") or it.get("advertiser") or {}).get("name") or it.get("shop") or ""
+    code = it.get("code") or it.get("coupon") or ""
+    title = it.get("title") or it.get("name") or store
+    desc = it.get("description") or ""
+    link = it.get("url") or it.get("link") or ""
+    start_at = it.get("start_date") or it.get("start") or None
+    end_at = it.get("end_date") or it.get("end") or None
+    store_slug = STORE_MATCHER.match(store)
+    if not store_slug:
+        store_slug = re.sub(r"[^a-z0-9]+","_", (store or "").lower()).strip("_") or "unknown"
+    return (store_slug, title, desc, link, code, start_at, end_at, "cityads", 0.9 + (0.4 if code else 0))
+
+def _cityads_json_records(data:Any) -> List[tuple]:
+    items = data.get("coupons") or data.get("items") or data if isinstance(data, dict) else data
+    return [_cityads_json_record(it) for it in items] if isinstance(items, list) else []
+
+def _cityads_rss_record(title:str, link:str, summary:str) -> tuple:
+    title = (title or "").strip()
+    summary = (summary or "").strip()
+    code_match = _CITYADS_CODE_RE.search(summary)
+    code = code_match.group(1) if code_match else ""
+    store_slug = STORE_MATCHER.match(title + " " + summary) or "unknown"
+    return (store_slug, title, summary, link or "", code, None, None, "cityads_rss", 0.7 + (0.3 if code else 0))
+
+def _cityads_feedparser_records(src:Any) -> List[tuple]:
+    # src — тело ответа или путь к файлу; feedparser терпит битый XML
+    import feedparser
+    feed = feedparser.parse(src)
+    return [_cityads_rss_record(e.get("title"), e.get("link"), e.get("summary")) for e in feed.entries]
+
+def parse_cityads(body:bytes, is_json:bool) -> List[tuple]:
+    if is_json:
+        return _cityads_json_records(json.loads(body))
+    return _cityads_feedparser_records(body)
+
+_JSON_WS = re.compile(r"\s*")
+_JSON_AFTER = frozenset(",]} \t\r\n")  # после значения в валидном JSON
+
+class _JsonStream:
+    # Потоковое чтение JSON из файла: значения разбираются raw_decode по буферу,
+    # который дочитывается по мере надобности. В памяти — только текущий элемент.
+    def __init__(self, f, chunk:int=1 << 20):
+        self.f = f
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _more(self) -> bool:
+        # буфер как минимум удваивается: большое значение не разбирается заново на каждый чанк
+        data = self.f.read(max(self.chunk, len(self.buf) - self.pos))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self.pos = _JSON_WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._more():
+                return self.buf[self.pos:self.pos + 1]
+
+    def char(self, expected:str) -> str:
+        c = self.peek()
+        if not c or c not in expected:
+            raise ValueError(f"JSON: expected {expected!r} at {self.pos}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # число на конце буфера могло оборваться ("1" из "1.5") — дочитываем и разбираем заново
+                if self.eof or self.buf[end:end + 1] in _JSON_AFTER:
+                    self.pos = end
+                    return v
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def array(self) -> Iterable[Any]:
+        self.char("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.char(",]") == "]":
+                return
+
+def _cityads_json_file_records(path:str) -> List[tuple]:
+    # Та же выборка, что у _cityads_json_records (список, "coupons" или "items"),
+    # но массив купонов читается поэлементно, без дерева всего документа.
+    with open(path, encoding="utf-8-sig") as f:
+        js = _JsonStream(f)
+        if js.peek() == "[":
+            return [_cityads_json_record(it) for it in js.array()]
+        found: Dict[str, List[tuple]] = {}
+        js.char("{")
+        if js.peek() == "}":
+            return []
+        while True:
+            key = js.value()
+            js.char(":")
+            if key in ("coupons", "items") and js.peek() == "[":
+                found[key] = [_cityads_json_record(it) for it in js.array()]
+            else:
+                found.pop(key, None)
+                js.value()
+            if js.char(",}") == "}":
+                break
+        return found.get("coupons") or found.get("items") or []
+
+def parse_cityads_file(path:str, is_json:bool) -> List[tuple]:
+    # Большой фид, сохранённый на диск, читается потоково: JSON — поэлементно через _JsonStream,
+    # RSS/Atom — iterparse, каждый разобранный item сразу выкидывается из дерева.
+    # Битый XML iterparse не прощает — тогда разбираем файл feedparser'ом, как маленький фид.
+    if is_json:
+        return _cityads_json_file_records(path)
+    out: List[tuple] = []
+    stack: List[ElementTree.Element] = []
+    try:
+        for event, el in ElementTree.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append(el)
+                continue
+            stack.pop()
+            if el.tag.rsplit("}", 1)[-1] not in ("item", "entry"):
+                continue
+            title = link = summary = ""
+            for ch in el:
+                tag = ch.tag.rsplit("}", 1)[-1]
+                if tag == "title":
+                    title = "".join(ch.itertext())
+                elif tag == "link" and not link:
+                    link = ch.get("href") or (ch.text or "").strip()
+                elif tag in ("description", "summary", "content") and not summary:
+                    summary = "".join(ch.itertext())
+            out.append(_cityads_rss_record(title, link, summary))
+            if stack:
+                stack[-1].remove(el)
+    except ElementTree.ParseError as e:
+        log.warning("[CITYADS] malformed XML feed (%s), falling back to feedparser", e)
+        return _cityads_feedparser_records(path)
+    return out
+
+async def pull_cityads() -> int:
     if not CITYADS_COUPONS_URL:
         return 0
+    path = None
     try:
         log.info("[SRC][CITYADS] %s", CITYADS_COUPONS_URL)
-        r = requests.get(CITYADS_COUPONS_URL, timeout=30, headers=UA)
-        r.raise_for_status()
-        added = 0
-        out: List[Dict[str,Any]] = []
-        content_type = r.headers.get("Content-Type","").lower()
-        if "json" in content_type or CITYADS_COUPONS_URL.endswith(".json"):
-            data = r.json()
-            items = data.get("coupons") or data.get("items") or data
-            for it in items if isinstance(items, list) else []:
-                store = (it.get("campaign") or it.get("advertiser") or {}).get("name") or it.get("shop") or ""
-                code = it.get("code") or it.get("coupon") or ""
-                title = it.get("title") or it.get("name") or store
-                desc = it.get("description") or ""
-                link = it.get("url") or it.get("link") or ""
-                start_at = it.get("start_date") or it.get("start") or None
-                end_at = it.get("end_date") or it.get("end") or None
-                store_slug = None
-                s = (store or "").lower()
-                for k, v in STORE_ALIASES.items():
-                    if k in s:
-                        store_slug = v
-                        break
-                if not store_slug:
-                    store_slug = re.sub(r"[^a-z0-9]+","_", s).strip("_") or "unknown"
-                out.append(dict(
-                    store_slug=store_slug, title=title, description=desc, url=link, coupon_code=code,
-                    price_old=None, price_new=None, cashback=None,
-                    start_at=start_at, end_at=end_at, source="cityads", score=0.9 + (0.4 if code else 0)
-                ))
-        else:
-            feed = feedparser.parse(r.text)
-            for e in feed.entries:
-                title = (e.get("title") or "").strip()
-                link = e.get("link") or ""
-                summary = (e.get("summary") or "").strip()
-                code_match = re.search(r"(?:promo|код|code)\s*[:\- ]\s*([A-Z0-9\-]{4,16})", summary, re.IGNORECASE)
-                code = code_match.group(1) if code_match else ""
-                store_slug = "unknown"
-                for k, v in STORE_ALIASES.items():
-                    if k in (title + " " + summary).lower():
-                        store_slug = v
-                        break
-                out.append(dict(
-                    store_slug=store_slug, title=title, description=summary, url=link, coupon_code=code,
-                    price_old=None, price_new=None, cashback=None,
-                    start_at=None, end_at=None, source="cityads_rss", score=0.7 + (0.3 if code else 0)
-                ))
-        added += put_deals_bulk(out)
+        with SOURCE_SECONDS.time("cityads", "fetch"):
+            _, headers, body, path = await http_download(CITYADS_COUPONS_URL, timeout=60, spool_over=PARSE_STREAM_THRESHOLD)
+        is_json = "json" in headers.get("Content-Type","").lower() or CITYADS_COUPONS_URL.endswith(".json")
+        with SOURCE_SECONDS.time("cityads", "parse"):
+            if path:
+                records = await run_parser(parse_cityads_file, path, is_json)
+            else:
+                records = await run_parser(parse_cityads, body, is_json)
+        with SOURCE_SECONDS.time("cityads", "insert"):
+            added = await asyncio.to_thread(put_deals_bulk, deals_from_records(records))
+        SOURCE_ITEMS.inc("cityads", "parsed", value=len(records))
+        SOURCE_ITEMS.inc("cityads", "added", value=added)
         return added
     except Exception as e:
         log.error("[CITYADS] error: %s", e)
-        return 0
+        raise
+    finally:
+        if path:
+            os.unlink(path)
 
 # 3) Официальные промо-страницы
-def pull_official_pages() -> int:
-    if not OFFICIAL_PROMO_PAGES:
+# По каждому URL в source_state (ключ "page:<url>") лежат ETag/Last-Modified, хэш тела
+# и свой интервал обхода. Страница без изменений (304 или тот же хэш) не разбирается,
+# а интервал удваивается до PROMO_MAX_INTERVAL; изменилась — снова PROMO_MIN_INTERVAL.
+# Ошибка тоже удваивает интервал, чтобы не долбить лежащий сайт.
+_PROMO_CODE_RE = re.compile(r"(?:промокод|код)\s*[:\- ]\s*([A-Z0-9\-]{4,16})", re.IGNORECASE)
+_PROMO_SLUGS: Dict[str,str] = {}  # URL -> магазин, считается один раз на URL
+
+def promo_page_slug(url:str) -> str:
+    slug = _PROMO_SLUGS.get(url)
+    if slug is None:
+        slug = _PROMO_SLUGS[url] = HOST_MATCHER.match(urllib.parse.urlsplit(url).hostname or "") or "unknown"
+    return slug
+
+def parse_promo_page(url:str, store_slug:str, body:bytes) -> List[tuple]:
+    from bs4 import BeautifulSoup
+    texts = BeautifulSoup(body, "html.parser").get_text(" ", strip=True)
+    return [
+        (store_slug, "Промокод", "Официальная промо-страница", url, m.group(1), None, None, "official_page", 0.6)
+        for m in _PROMO_CODE_RE.finditer(texts)
+    ]
+
+async def _crawl_page(url:str, state:Optional[dict]) -> Tuple[Optional[List[tuple]], dict]:
+    # -> (записи или None, если страница не изменилась; новое состояние URL)
+    state = state or {}
+    now = int(time.time())
+    backoff = min((state.get("interval_s") or PROMO_MIN_INTERVAL) * 2, PROMO_MAX_INTERVAL)
+    headers = dict(UA)
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    try:
+        log.info("[SRC][PROMO_PAGE] %s", url)
+        with SOURCE_SECONDS.time("pages", "fetch"):
+            status, resp_headers, body = await http_fetch(url, headers=headers, timeout=20)
+        validators = dict(etag=resp_headers.get("ETag") or state.get("etag"),
+                          last_modified=resp_headers.get("Last-Modified") or state.get("last_modified"))
+        body_hash = hashlib.sha1(body).hexdigest() if status != 304 else None
+        if status == 304 or body_hash == state.get("body_hash"):
+            return None, dict(validators, checked_ts=now, interval_s=backoff, next_ts=now + backoff)
+        with SOURCE_SECONDS.time("pages", "parse"):
+            records = await run_parser(parse_promo_page, url, promo_page_slug(url), body)
+    except Exception as e:
+        log.warning("[PROMO_PAGE] %s error: %s", url, e)
+        return None, dict(checked_ts=now, interval_s=backoff, next_ts=now + backoff)
+    return records, dict(validators, body_hash=body_hash, items=len(records), checked_ts=now, changed_ts=now,
+                         interval_s=PROMO_MIN_INTERVAL, next_ts=now + PROMO_MIN_INTERVAL)
+
+async def _crawl_host(urls:List[str], states:Dict[str,dict], out:Dict[str,tuple]):
+    # страницы одного хоста: не больше PROMO_PER_HOST параллельно, с паузой между запросами
+    todo = deque(urls)
+    async def worker():
+        while todo:
+            url = todo.popleft()
+            out[url] = await _crawl_page(url, states.get("page:" + url))
+            if todo and PROMO_HOST_DELAY > 0:
+                await asyncio.sleep(PROMO_HOST_DELAY)
+    await asyncio.gather(*(worker() for _ in range(min(PROMO_PER_HOST, len(urls)))))
+
+async def pull_official_pages(urls:Optional[List[str]]=None) -> int:
+    # urls=None — плановый обход: только страницы, у которых подошёл срок.
+    # Явный список (обновление по запросу) проверяется сразу, но тоже условным GET.
+    urls = OFFICIAL_PROMO_PAGES if urls is None else urls
+    due_only = urls is OFFICIAL_PROMO_PAGES
+    if not urls:
         return 0
-    out: List[Dict[str,Any]] = []
-    for url in OFFICIAL_PROMO_PAGES:
-        try:
-            log.info("[SRC][PROMO_PAGE] %s", url)
-            r = requests.get(url, timeout=20, headers=UA)
-            r.raise_for_status()
-            soup = BeautifulSoup(r.text, "html.parser")
-            texts = soup.get_text(" ", strip=True)
-            for m in re.finditer(r"(?:промокод|код)\s*[:\- ]\s*([A-Z0-9\-]{4,16})", texts, re.IGNORECASE):
-                code = m.group(1)
-                title = "Промокод"
-                desc = "Официальная промо-страница"
-                host = re.sub(r"^https?://", "", url).split("/")[0].lower()
-                store_slug = "unknown"
-                for k, v in STORE_ALIASES.items():
-                    if k in host or k.replace(" ", "") in host:
-                        store_slug = v
-                        break
-                out.append(dict(
-                    store_slug=store_slug, title=title, description=desc, url=url, coupon_code=code,
-                    price_old=None, price_new=None, cashback=None,
-                    start_at=None, end_at=None, source="official_page", score=0.6
-                ))
-        except Exception as e:
-            log.warning("[PROMO_PAGE] %s error: %s", url, e)
-    return put_deals_bulk(out)
+    states = await asyncio.to_thread(get_source_states, ["page:" + u for u in urls])
+    if due_only:
+        # запас в минуту: иначе страница с интервалом ровно в период задачи пропускала бы каждый второй запуск
+        horizon = int(time.time()) + 60
+        urls = [u for u in urls if ((states.get("page:" + u) or {}).get("next_ts") or 0) <= horizon]
+    by_host: Dict[str,List[str]] = {}
+    for u in urls:
+        by_host.setdefault(urllib.parse.urlsplit(u).hostname or "", []).append(u)
+    results: Dict[str,tuple] = {}
+    await asyncio.gather(*(_crawl_host(host_urls, states, results) for host_urls in by_host.values()))
+    records = [r for recs, _ in results.values() if recs for r in recs]
+    added = 0
+    if records:
+        with SOURCE_SECONDS.time("pages", "insert"):
+            added = await asyncio.to_thread(put_deals_bulk, deals_from_records(records))
+    SOURCE_ITEMS.inc("pages", "parsed", value=len(records))
+    SOURCE_ITEMS.inc("pages", "added", value=added)
+    # состояние — только после записи сделок, иначе при сбое страница будет считаться уже разобранной
+    await asyncio.to_thread(set_source_states, {"page:" + u: st for u, (_, st) in results.items()})
+    changed = sum(1 for recs, _ in results.values() if recs is not None)
+    log.info("[SRC][PROMO_PAGE] due=%s changed=%s added=%s", len(urls), changed, added)
+    return added
 
-# Сбор всех источников
-def run_all_sources() -> int:
+# Сбор всех источников — параллельно. Ключи те же, что у плановых задач (SOURCES):
+# /update во время планового запуска источника дождётся его, а не запустит второй.
+async def run_all_sources() -> int:
+    results = await asyncio.gather(
+        REFRESH.do("admitad", pull_admitad), REFRESH.do("cityads", pull_cityads),
+        REFRESH.do("pages", pull_official_pages), return_exceptions=True
+    )
     total = 0
-    total += pull_admitad()
-    total += pull_cityads()
-    total += pull_official_pages()
+    for res in results:
+        if isinstance(res, BaseException):
+            log.error("[SCRAPE] source error: %s", res)
+        else:
+            total += res
     log.info("[SCRAPE] total added: %s", total)
     return total
 
+# ---------- ОБНОВЛЕНИЕ ПО ЗАПРОСУ ----------
+# Один запрос к источнику на ключ, сколько бы пользователей его ни ждали;
+# свежий результат переиспользуется в течение cooldown.
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self._done: Dict[Any, Tuple[float, Any]] = {}
+
+    async def do(self, key:Any, fn:Callable, *args, cooldown:float=0.0) -> Any:
+        if cooldown:
+            done = self._done.get(key)
+            if done and time.monotonic() - done[0] < cooldown:
+                return done[1]
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._inflight[key] = asyncio.ensure_future(fn(*args))
+            fut.add_done_callback(lambda f, key=key: self._finish(key, f))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(fut)
+
+    def will_run(self, key:Any, cooldown:float=0.0) -> bool:
+        # начнёт ли do() новый запрос, а не присоединится к идущему или свежему
+        if key in self._inflight:
+            return False
+        done = self._done.get(key) if cooldown else None
+        return not (done and time.monotonic() - done[0] < cooldown)
+
+    def _finish(self, key:Any, fut:asyncio.Future):
+        self._inflight.pop(key, None)
+        if not fut.cancelled() and fut.exception() is None:
+            self._done[key] = (time.monotonic(), fut.result())
+
+REFRESH = SingleFlight()
+
+def _promo_pages_for(store_slug:str) -> List[str]:
+    return [u for u in OFFICIAL_PROMO_PAGES if promo_page_slug(u) == store_slug]
+
+async def refresh_store(store_slug:str) -> int:
+    # Точечное обновление одного магазина для пустого /search:
+    # Admitad — по известным кампаниям магазина, промо-страницы — только его,
+    # CityAds отдаёт один общий фид, поэтому он общий на всех.
+    jobs = []
+    campaigns = sorted(ADMITAD_CAMPAIGNS.get(store_slug, ()))
+    if campaigns:
+        jobs.append(REFRESH.do(("admitad", store_slug), pull_admitad, campaigns, cooldown=REFRESH_COOLDOWN))
+    else:
+        jobs.append(REFRESH.do("admitad", pull_admitad, cooldown=REFRESH_COOLDOWN))
+    jobs.append(REFRESH.do("cityads", pull_cityads, cooldown=REFRESH_COOLDOWN))
+    pages = _promo_pages_for(store_slug)
+    if pages:
+        jobs.append(REFRESH.do(("pages", store_slug), pull_official_pages, pages, cooldown=REFRESH_COOLDOWN))
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    return sum(r for r in results if isinstance(r, int))
+
+def _refresh_job(key:str) -> Tuple[Any, Callable, tuple]:
+    # ключ запроса ("all" | "store:<slug>") -> (ключ REFRESH, функция, аргументы)
+    if key == "all":
+        return "all", run_all_sources, ()
+    kind, _, slug = key.partition(":")
+    if kind == "store" and slug:
+        return ("store", slug), refresh_store, (slug,)
+    raise ValueError(f"unknown refresh key {key!r}")
+
+class RefreshRequests:
+    """Сбор по запросу (/update, пустой /search) идёт только в процессе-планировщике: у него
+    одни на всех REFRESH, ADMITAD_CAMPAIGNS и состояние источников в source_state, и он один
+    опрашивает источники. Остальные процессы webhook ставят строку "refresh:<ключ>" в
+    source_state (next_ts — когда запрошено), будят планировщик событием "refresh" и ждут
+    "refreshed"; результат — в items той же строки. Идущий или недавний (REFRESH_COOLDOWN)
+    сбор не запрашивается заново. В polling и у самого планировщика — сразу REFRESH.do."""
+    def __init__(self):
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _local() -> bool:
+        return not CACHE_EVENTS.enabled or scheduler is not None
+
+    def _state(self, conn:sqlite3.Connection, key:str) -> Optional[tuple]:
+        return conn.execute("SELECT next_ts, checked_ts, items FROM source_state WHERE key=?",
+                            ("refresh:" + key,)).fetchone()
+
+    def _fresh(self, row:Optional[tuple], now:int) -> Optional[int]:
+        # -> сколько добавил недавний сбор, если повторять его рано
+        if row is not None and row[0] is None and (row[1] or 0) > now - REFRESH_COOLDOWN:
+            return row[2] or 0
+        return None
+
+    async def will_run(self, key:str) -> bool:
+        # начнёт ли run() новый сбор, а не присоединится к идущему или недавнему
+        if self._local():
+            return REFRESH.will_run(_refresh_job(key)[0], REFRESH_COOLDOWN)
+        row = await storage().aread(self._state, key)
+        return not (row is not None and row[0] is not None) and self._fresh(row, int(time.time())) is None
+
+    async def run(self, key:str) -> Optional[int]:
+        # -> добавлено сделок; None — планировщик не успел за REFRESH_WAIT (сбор продолжится)
+        if self._local():
+            sf_key, fn, args = _refresh_job(key)
+            return await REFRESH.do(sf_key, fn, *args, cooldown=REFRESH_COOLDOWN)
+        fut = self._waiters.get(key)
+        if fut is None or fut.done():
+            # до записи запроса: событие "refreshed" не проскочит между записью и ожиданием
+            fut = self._waiters[key] = asyncio.get_running_loop().create_future()
+        ready = await storage().awrite(self._request, key)
+        if ready is not None:
+            return ready
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), REFRESH_WAIT)
+        except asyncio.TimeoutError:
+            log.warning("[REFRESH] %s: no answer from the scheduler in %ss", key, REFRESH_WAIT)
+            return None
+        row = await storage().aread(self._state, key)
+        return (row[2] or 0) if row else 0
+
+    def _request(self, conn:sqlite3.Connection, key:str) -> Optional[int]:
+        now = int(time.time())
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = self._state(conn, key)
+            ready = self._fresh(row, now)
+            if ready is not None:
+                return ready
+            if row is None or row[0] is None:  # уже запрошен — просто ждём тот же сбор
+                _set_source_state(conn, "refresh:" + key, {"next_ts": now})
+                CACHE_EVENTS.publish(conn, "refresh", (key,))
+        return None
+
+    def finished(self, key:str):
+        fut = self._waiters.pop(key, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # --- сторона планировщика ---
+    def start(self):
+        if CACHE_EVENTS.enabled and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._serve())
+
+    async def stop(self):
+        # аренда потеряна: незавершённые запросы остаются в source_state, их доделает новый владелец
+        tasks = [t for t in (self._task, *self._running.values()) if t is not None]
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await t
+        self._task = self._wakeup = None
+        self._running.clear()
+
+    def _pending(self, conn:sqlite3.Connection) -> List[str]:
+        return [r[0][len("refresh:"):] for r in conn.execute(
+            "SELECT key FROM source_state WHERE key LIKE 'refresh:%' AND next_ts IS NOT NULL")]
+
+    def _done(self, conn:sqlite3.Connection, key:str, added:int):
+        with conn:
+            _set_source_state(conn, "refresh:" + key, {"next_ts": None, "checked_ts": int(time.time()), "items": added})
+            CACHE_EVENTS.publish(conn, "refreshed", (key,))
+
+    async def _serve(self):
+        sem = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+        while True:
+            self._wakeup.clear()
+            try:
+                for key in await storage().aread(self._pending):
+                    if key not in self._running:
+                        self._running[key] = asyncio.create_task(self._serve_one(key, sem))
+            except Exception as e:
+                log.warning("[REFRESH] poll error: %s", e)
+            # событие "refresh" будит сразу; раз в LEASE_TTL — на случай пропущенного
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), LEASE_TTL)
+
+    async def _serve_one(self, key:str, sem:asyncio.Semaphore):
+        try:
+            added = 0
+            try:
+                sf_key, fn, args = _refresh_job(key)
+                async with sem:
+                    added = await REFRESH.do(sf_key, fn, *args, cooldown=REFRESH_COOLDOWN)
+            except Exception as e:
+                log.error("[REFRESH] %s: %s", key, e)
+            await storage().awrite(self._done, key, added)
+        finally:
+            self._running.pop(key, None)
+
+REFRESH_REQUESTS = RefreshRequests()
+
 # ---------- ФОРМАТИРОВАНИЕ ----------
-def fmt_deal(d:dict) -> str:
+def fmt_deal(d:Deal) -> str:
     lines = []
-    lines.append(f"🛍 {esc(d.get('store_slug') or 'магазин')} — {esc(d.get('title') or '')}")
-    code = d.get("coupon_code")
-    if code:
-        lines.append(f"Промокод: <code>{esc(code)}</code>")
-    if d.get("price_new"):
-        if d.get("price_old"):
-            lines.append(f"Цена: {d['price_new']} (было {d['price_old']})")
+    lines.append(f"🛍 {esc(d.store_slug or 'магазин')} — {esc(d.title or '')}")
+    if d.coupon_code:
+        lines.append(f"Промокод: <code>{esc(d.coupon_code)}</code>")
+    if d.price_new:
+        if d.price_old:
+            lines.append(f"Цена: {d.price_new} (было {d.price_old})")
         else:
-            lines.append(f"Цена: {d['price_new']}")
-    if d.get("cashback"):
-        lines.append(f"Кэшбэк: {d['cashback']}")
-    if d.get("end_at"):
-        lines.append(f"Действует до: {esc(d['end_at'])}")
-    if d.get("description"):
-        desc = (d["description"] or "")
+            lines.append(f"Цена: {d.price_new}")
+    if d.cashback:
+        lines.append(f"Кэшбэк: {d.cashback}")
+    if d.end_at:
+        lines.append(f"Действует до: {esc(d.end_at)}")
+    if d.description:
+        desc = d.description
         if len(desc) > 160:
             desc = desc[:157] + "…"
         lines.append(esc(desc))
-    if d.get("url"):
-        lines.append(f"🔗 {esc(d['url'])}")
+    if d.url:
+        lines.append(f"🔗 {esc(d.url)}")
     return "\n".join(lines)
 
+class RenderCache:
+    """Блок сделки для выдачи (fmt_deal + проверка HTML, см. tg_block) по hash сделки.
+    Текст сделки в БД меняется только вместе с score или end_ts (см. ON CONFLICT в
+    _UPSERT_DEAL_SQL), поэтому запись сверяется с ними и устаревшая просто не совпадёт:
+    инвалидация не нужна ни здесь, ни в других процессах. Заполняется при вставке,
+    промах (обновлённая сделка, вытеснение, другой процесс) дорисовывается на месте."""
+    def __init__(self, max_items:int):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, Tuple[float, int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, d:Deal) -> str:
+        entry = self._data.get(d.hash)
+        if entry is not None and entry[0] == d.score and entry[1] == d.end_ts:
+            self.hits += 1
+            with self._lock:
+                if d.hash in self._data:
+                    self._data.move_to_end(d.hash)
+            return entry[2]
+        self.misses += 1
+        block = tg_block(fmt_deal(d))
+        if d.hash is not None:
+            self._put([(d.hash, (d.score, d.end_ts, block))])
+        return block
+
+    def fill(self, deals:Iterable[Deal]):
+        self._put([(d.hash, (d.score, d.end_ts, tg_block(fmt_deal(d)))) for d in deals])
+
+    def _put(self, items:List[Tuple[str, Tuple[float, int, str]]]):
+        if not self.max_items:
+            return
+        with self._lock:
+            for key, entry in items[-self.max_items:]:
+                self._data[key] = entry
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_SIZE)
+
+# Выдача магазина листается одним сообщением: кнопка «Дальше» несёт id последней
+# показанной сделки (base36), «В начало» — id первой, магазин берётся по нему из БД.
+# Slug в callback_data не кладём: он из названия кампании и бывает длиннее 64 байт,
+# лимита Telegram; id в base36 — не больше 13 символов.
+PAGE_SIZE = 8
+
+def _b36(n:int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def render_page(rows:List[Deal], first:bool) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # rows — до PAGE_SIZE + 1 сделок: лишняя только говорит, что есть следующая страница
+    shown = rows[:PAGE_SIZE]
+    blocks = [RENDER_CACHE.render(d) for d in shown]
+    msgs = pack_messages(blocks, checked=True)
+    while len(msgs) > 1:  # длинные сделки: на странице столько, сколько влезает в одно сообщение
+        shown = shown[:-1]
+        msgs = pack_messages(blocks[:len(shown)], checked=True)
+    buttons = []
+    if not first:
+        buttons.append(InlineKeyboardButton(text="⏮ В начало", callback_data=f"pgh:{_b36(shown[0].id)}"))
+    if len(rows) > len(shown):
+        buttons.append(InlineKeyboardButton(text="Дальше ▶", callback_data=f"pg:{_b36(shown[-1].id)}"))
+    return msgs[0], InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+# ---------- ОТПРАВКА ----------
+TG_MESSAGE_LIMIT = 4096
+_TG_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+            "tg-spoiler", "span", "blockquote", "tg-emoji"}
+
+class _TgHtmlChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack: List[str] = []
+        self.ok = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in _TG_TAGS:
+            self.ok = False
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.ok = False
+
+def tg_html_ok(text:str) -> bool:
+    # Только теги, которые понимает Telegram, и правильная вложенность
+    p = _TgHtmlChecker()
+    try:
+        p.feed(text)
+        p.close()
+    except Exception:
+        return False
+    return p.ok and not p.stack
+
+def _strip_tags(text:str) -> str:
+    return re.sub(r"<.*?>", "", text)
+
+def _cut_html_text(block:str, limit:int) -> str:
+    # Обрезка по видимому тексту: срез экранированной строки может попасть внутрь &amp;,
+    # и Telegram отклонит сообщение с "can't parse entities"
+    out: List[str] = []
+    size = 0
+    for ch in html.unescape(_strip_tags(block)):
+        e = esc(ch)
+        if size + len(e) > limit - 1:
+            break
+        out.append(e)
+        size += len(e)
+    return "".join(out) + "…"
+
+def tg_block(block:str) -> str:
+    # Невалидный HTML чиним один раз до отправки, а не перепосылкой после ошибки API
+    return block if tg_html_ok(block) else _strip_tags(block)
+
+def pack_messages(blocks:List[str], limit:int=TG_MESSAGE_LIMIT, sep:str="\n\n", checked:bool=False) -> List[str]:
+    # Склеивает блоки fmt_deal в минимум сообщений не длиннее limit.
+    # checked — блоки уже прошли tg_block (RENDER_CACHE.render), повторно HTML не разбираем.
+    out: List[str] = []
+    cur = ""
+    for block in blocks:
+        if not checked:
+            block = tg_block(block)
+        if len(block) > limit:
+            block = _cut_html_text(block, limit)
+        if cur and len(cur) + len(sep) + len(block) <= limit:
+            cur += sep + block
+        else:
+            if cur:
+                out.append(cur)
+            cur = block
+    if cur:
+        out.append(cur)
+    return out
+
+class SendQueue:
+    # Общая очередь исходящих сообщений:
+    #  - глобальный token bucket (rate сообщений/с, burst),
+    #  - не чаще одного сообщения в чат за chat_interval,
+    #  - чаты обслуживаются по кругу, чтобы длинная выдача одного не задерживала других,
+    #  - до inflight запросов к Bot API одновременно, но в один чат — по одному, по порядку
+    #    (иначе пропускная способность упирается в 1/RTT, а не в rate),
+    #  - TelegramRetryAfter ставит на паузу всю очередь на retry_after и повторяет отправку.
+    def __init__(self, rate:float, burst:int, chat_interval:float, inflight:int=1):
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.inflight = max(1, inflight)
+        self.sent = 0
+        self.retries = 0
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._chats: "OrderedDict[int, deque]" = OrderedDict()
+        self._chat_next: Dict[int, float] = {}
+        self._busy: Dict[int, deque] = {}  # чаты с запросом в полёте: новые сообщения копятся здесь
+        self._tasks: set = set()
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def call(self, chat_id:int, make_call:Callable[[], Any]) -> Any:
+        # make_call() -> корутина запроса к Bot API; результат/ошибка вернутся сюда
+        fut = asyncio.get_running_loop().create_future()
+        busy = self._busy.get(chat_id)
+        (busy if busy is not None else self._chats.setdefault(chat_id, deque())).append((make_call, fut))
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await fut
+
+    async def send_text(self, bot:Bot, chat_id:int, text:str, **kwargs) -> Any:
+        return await self.call(chat_id, lambda: bot.send_message(chat_id, text, **kwargs))
+
+    def _take_token(self, now:float) -> float:
+        # -> 0, если токен взят, иначе сколько ждать
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def _next_chat(self, now:float) -> Tuple[Optional[int], float]:
+        wait = float("inf")
+        for chat_id in self._chats:
+            ready_at = self._chat_next.get(chat_id, 0.0)
+            if ready_at <= now:
+                return chat_id, 0.0
+            wait = min(wait, ready_at - now)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if not self._chats:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+                except asyncio.TimeoutError:
+                    if not self._chats and not self._busy:
+                        self._chat_next.clear()
+                        return
+                continue
+            if len(self._busy) >= self.inflight:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if self._paused_until > now:
+                await self._pause(self._paused_until - now)
+                continue
+            chat_id, wait = self._next_chat(now)
+            if chat_id is None:
+                await self._pause(wait)
+                continue
+            wait = self._take_token(now)
+            if wait:
+                await self._pause(wait)
+                continue
+            queue_ = self._busy[chat_id] = self._chats.pop(chat_id)  # в конец круга
+            task = asyncio.create_task(self._send(chat_id, queue_))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _pause(self, wait:float):
+        # до срока, но с пробуждением по call(): новый чат может быть готов раньше,
+        # чем тот, которого ждём (после пробуждения всё пересчитывается заново)
+        self._wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wakeup.wait(), wait)
+
+    async def _send(self, chat_id:int, queue_:deque):
+        make_call, fut = queue_[0]
+        retry = False
+        try:
+            with TELEGRAM_SECONDS.time():
+                result = await make_call()
+        except TelegramRetryAfter as e:
+            retry = True
+            self.retries += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            log.warning("[SEND] flood control, pause %ss", e.retry_after)
+        except Exception as e:
+            queue_.popleft()
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            queue_.popleft()
+            self.sent += 1
+            if not fut.done():
+                fut.set_result(result)
+        if not retry:
+            self._chat_next[chat_id] = time.monotonic() + self.chat_interval
+        del self._busy[chat_id]
+        if queue_:
+            self._chats[chat_id] = queue_
+        self._wakeup.set()
+
+SEND_QUEUE = SendQueue(SEND_RATE, SEND_BURST, SEND_CHAT_INTERVAL, SEND_INFLIGHT)
+
+async def reply(m:Message, text:str, **kwargs) -> Any:
+    # ответы команд — тоже через SEND_QUEUE: лимиты Telegram общие на все сообщения бота,
+    # а /update и пустой /search шлют по нескольку сообщений подряд
+    return await SEND_QUEUE.send_text(m.bot, m.chat.id, text, **kwargs)
+
+# ---------- РАССЫЛКА ПО /watch ----------
+# После сбора enqueue_new_deals одной транзакцией писателя берёт сделки с id выше
+# отметки "push:deals" в source_state (items = последний разосланный id), группирует
+# по магазину, рендерит уведомление один раз и ставит в push_queue всех подписчиков
+# магазина с активной подпиской. PushDispatcher отправляет очередь через SEND_QUEUE,
+# не больше PUSH_INFLIGHT сообщений разом, чтобы ответы на команды не ждали рассылку.
+# Доставка «хотя бы один раз»: строки удаляются пачкой после отправки, при падении
+# посреди пачки её часть уйдёт повторно.
+def render_push(store_slug:str, deals:List[Deal]) -> List[str]:
+    blocks = [RENDER_CACHE.render(d) for d in deals[:PUSH_MAX_DEALS]]
+    blocks[0] = f"🔔 Новое в {esc(store_slug)}:\n\n" + blocks[0]
+    if len(deals) > PUSH_MAX_DEALS:
+        blocks.append(f"…и ещё {len(deals) - PUSH_MAX_DEALS}: /search {esc(store_slug)}")
+    return pack_messages(blocks, checked=True)
+
+def enqueue_new_deals() -> Tuple[int, int]:
+    # -> (новых сделок у отслеживаемых магазинов, поставлено сообщений в очередь)
+    def tx(conn):
+        now = int(time.time())
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            mark = conn.execute("SELECT items FROM source_state WHERE key='push:deals'").fetchone()
+            top = conn.execute("SELECT COALESCE(MAX(id), 0) FROM deals").fetchone()[0]
+            if mark is None or mark[0] is None:
+                # первый запуск: старые сделки не рассылаем
+                _set_source_state(conn, "push:deals", {"items": top, "checked_ts": now})
+                return 0, 0
+            rows = fetch_deals(conn, _DEAL_SELECT + """
+                WHERE id > ? AND end_ts >= ? AND store_slug IN (SELECT store_slug FROM watches)
+                ORDER BY store_slug, score DESC, end_ts ASC
+            """, (mark[0], now))
+            queued = 0
+            until = _now_iso_naive_utc()
+            for slug, group in itertools.groupby(rows, key=lambda d: d.store_slug):
+                for text in render_push(slug, list(group)):
+                    msg_id = conn.execute(
+                        "INSERT INTO push_messages(store_slug, text, created_ts) VALUES(?,?,?)", (slug, text, now)
+                    ).lastrowid
+                    queued += conn.execute("""
+                        INSERT INTO push_queue(msg_id, user_id)
+                        SELECT ?, w.user_id FROM watches w JOIN subscriptions s ON s.user_id = w.user_id
+                        WHERE w.store_slug = ? AND s.until >= ?
+                    """, (msg_id, slug, until)).rowcount
+            _set_source_state(conn, "push:deals", {"items": top, "checked_ts": now})
+            if queued:
+                CACHE_EVENTS.publish(conn, "push")  # рассылку ведёт процесс-планировщик, будим его
+        return len(rows), queued
+    return storage().write(tx)
+
+def _push_batch(conn:sqlite3.Connection, after:Tuple[int, int], limit:int,
+                texts:Dict[int, str]) -> List[Tuple[int, int, int]]:
+    rows = conn.execute(
+        "SELECT msg_id, user_id, attempts FROM push_queue WHERE (msg_id, user_id) > (?, ?) "
+        "ORDER BY msg_id, user_id LIMIT ?", (*after, limit)
+    ).fetchall()
+    missing = {r[0] for r in rows} - texts.keys()
+    if missing:
+        texts.update(conn.execute(
+            "SELECT id, text FROM push_messages WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(missing)),)
+        ).fetchall())
+    return [tuple(r) for r in rows]
+
+def _push_ack(conn:sqlite3.Connection, done:List[Tuple[int, int]], retry:List[Tuple[int, int]],
+              gone_users:List[int]):
+    with conn:
+        conn.executemany("DELETE FROM push_queue WHERE msg_id=? AND user_id=?", done)
+        conn.executemany("UPDATE push_queue SET attempts = attempts + 1 WHERE msg_id=? AND user_id=?", retry)
+        # бот заблокирован / чат удалён — больше этому пользователю не рассылаем
+        conn.executemany("DELETE FROM watches WHERE user_id=?", [(u,) for u in gone_users])
+
+def _push_vacuum(conn:sqlite3.Connection):
+    with conn:
+        conn.execute("DELETE FROM push_messages WHERE id NOT IN (SELECT DISTINCT msg_id FROM push_queue)")
+
+class PushDispatcher:
+    def __init__(self, max_attempts:int=3):
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.dropped = 0
+        self._bot: Optional[Bot] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self, bot:Bot):
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()  # очередь могла остаться с прошлого запуска
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def stop(self, timeout:float=10):
+        # даём дописать текущую пачку и отметить отправленное, иначе она уйдёт повторно
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        self._task = None
+        self._stopping = False
+
+    async def enqueue(self) -> Tuple[int, int]:
+        deals, queued = await asyncio.to_thread(enqueue_new_deals)
+        if queued:
+            log.info("[PUSH] new deals=%s queued=%s", deals, queued)
+            self.wake()
+        return deals, queued
+
+    async def _send(self, sem:asyncio.Semaphore, chat_id:int, text:str) -> Optional[BaseException]:
+        async with sem:
+            try:
+                await SEND_QUEUE.send_text(self._bot, chat_id, text, disable_web_page_preview=True)
+                return None
+            except Exception as e:
+                return e
+
+    async def _run(self):
+        texts: Dict[int, str] = {}
+        sem = asyncio.Semaphore(PUSH_INFLIGHT)
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+            self._wakeup.clear()
+            after = (0, 0)
+            try:
+                while not self._stopping:
+                    batch = await storage().aread(_push_batch, after, PUSH_BATCH, texts)
+                    if not batch:
+                        break
+                    after = batch[-1][:2]
+                    results = await asyncio.gather(*(
+                        self._send(sem, user_id, texts.get(msg_id, "")) for msg_id, user_id, _ in batch
+                    ))
+                    done, retry, gone = [], [], []
+                    for (msg_id, user_id, attempts), err in zip(batch, results):
+                        if err is None:
+                            self.sent += 1
+                            done.append((msg_id, user_id))
+                        elif isinstance(err, TelegramForbiddenError) or attempts + 1 >= self.max_attempts:
+                            self.dropped += 1
+                            done.append((msg_id, user_id))
+                            if isinstance(err, TelegramForbiddenError):
+                                gone.append(user_id)
+                        else:
+                            retry.append((msg_id, user_id))
+                    await storage().awrite(_push_ack, done, retry, gone)
+                if self._stopping:
+                    return
+                await storage().awrite(_push_vacuum)
+                texts.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("[PUSH] error: %s", e)
+                await asyncio.sleep(5)
+                self._wakeup.set()
+
+PUSH = PushDispatcher()
+
+# ---------- НЕСКОЛЬКО ПРОЦЕССОВ ----------
+class CacheEvents:
+    """Сброс кэшей в памяти между процессами через БД. Запись, после которой кэш другого
+    процесса устарел бы (подписка, сделки магазина, очистка, новая рассылка), той же
+    транзакцией добавляет строку в cache_events; каждый процесс дочитывает новые строки
+    раз в CACHE_EVENTS_POLL с. В одном процессе (polling) выключено и ничего не пишет."""
+    def __init__(self):
+        self.enabled = False
+        self.origin = ""
+        self.applied = 0
+        self._last_id = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def publish(self, conn:sqlite3.Connection, kind:str, keys=("",)):
+        # внутри транзакции вызывающего: событие видно ровно тогда, когда видна сама запись
+        if self.enabled:
+            now = int(time.time())
+            conn.executemany("INSERT INTO cache_events(origin, kind, key, ts) VALUES(?,?,?,?)",
+                             ((self.origin, kind, str(k), now) for k in keys))
+
+    def notify(self, kind:str, keys=("",)):
+        if self.enabled:
+            def tx(conn):
+                with conn:
+                    self.publish(conn, kind, keys)
+            storage().write(tx)
+
+    def _fetch(self, conn:sqlite3.Connection) -> List[tuple]:
+        return conn.execute("SELECT id, origin, kind, key FROM cache_events WHERE id > ? ORDER BY id",
+                            (self._last_id,)).fetchall()
+
+    def apply(self, rows:List[tuple]):
+        slugs = set()
+        for event_id, origin, kind, key in rows:
+            self._last_id = event_id
+            if origin == self.origin:
+                continue  # свои изменения процесс уже применил сам
+            self.applied += 1
+            if kind == "sub":
+                _SUB_CACHE.pop(int(key), None)
+            elif kind == "deals":
+                slugs.add(key)
+            elif kind == "reset":
+                DEAL_FILTER.clear()
+                SEARCH_CACHE.clear()
+                RENDER_CACHE.clear()
+            elif kind == "push":
+                PUSH.wake()
+            elif kind == "refresh":
+                REFRESH_REQUESTS.wake()
+            elif kind == "refreshed":
+                REFRESH_REQUESTS.finished(key)
+        if slugs:
+            SEARCH_CACHE.invalidate(slugs)
+
+    def start(self, origin:str):
+        self.enabled = True
+        self.origin = origin
+        self._last_id = storage().read(
+            lambda conn: conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0])
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CACHE_EVENTS_POLL)
+            try:
+                self.apply(await storage().aread(self._fetch))
+            except Exception as e:
+                log.warning("[CACHE_EVENTS] poll error: %s", e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+CACHE_EVENTS = CacheEvents()
+
+class Lease:
+    """Аренда по имени в таблице leases. Держит тот, кто продлевает её чаще, чем раз в ttl;
+    упавший или зависший процесс перестаёт продлевать, и через ttl её забирает другой."""
+    def __init__(self, name:str, owner:str, ttl:int):
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+
+    def _acquire(self, conn:sqlite3.Connection) -> bool:
+        now = int(time.time())
+        with conn:
+            conn.execute("""
+                INSERT INTO leases(name, owner, expires_ts) VALUES(?,?,?)
+                ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_ts=excluded.expires_ts
+                WHERE leases.owner = excluded.owner OR leases.expires_ts < ?
+            """, (self.name, self.owner, now + self.ttl, now))
+            row = conn.execute("SELECT owner FROM leases WHERE name=?", (self.name,)).fetchone()
+            if row[0] == self.owner:
+                # заодно подчищаем события кэшей: все процессы дочитывают их за секунды
+                conn.execute("DELETE FROM cache_events WHERE ts < ?", (now - 600,))
+        return row[0] == self.owner
+
+    def _release(self, conn:sqlite3.Connection):
+        with conn:
+            conn.execute("DELETE FROM leases WHERE name=? AND owner=?", (self.name, self.owner))
+
+    async def hold(self, on_gain:Callable[[], Any], on_loss:Callable[[], Any]):
+        # Пока задача жива — пытаемся взять/продлить аренду каждые ttl/3 с. Если продлить не
+        # удалось (БД занята), лидером остаёмся, только пока аренда заведомо не истекла.
+        leader = False
+        confirmed = 0.0
+        try:
+            while True:
+                try:
+                    ok = await storage().awrite(self._acquire)
+                    if ok:
+                        confirmed = time.monotonic()
+                except Exception as e:
+                    log.warning("[LEASE] %s: %s", self.name, e)
+                    ok = leader and time.monotonic() - confirmed < self.ttl * 2 / 3
+                if ok and not leader:
+                    leader = True
+                    log.info("[LEASE] %s acquired by %s", self.name, self.owner)
+                    try:
+                        await on_gain()
+                    except Exception:
+                        # не выходим из цикла: иначе аренду больше никто не взял бы.
+                        # Отдаём её и пробуем снова на следующем шаге (или другой процесс).
+                        log.exception("[LEASE] %s: start failed, releasing", self.name)
+                        leader = False
+                        with contextlib.suppress(Exception):
+                            await on_loss()
+                        with contextlib.suppress(Exception):
+                            await storage().awrite(self._release)
+                elif not ok and leader:
+                    leader = False
+                    log.warning("[LEASE] %s lost by %s", self.name, self.owner)
+                    await on_loss()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if leader:
+                await on_loss()
+                with contextlib.suppress(Exception):
+                    await storage().awrite(self._release)
+
+# ---------- ДОПУСК К КОМАНДАМ ----------
+class CommandClass:
+    # лимиты одного класса команд: token bucket на пользователя и общий, плюс
+    # одновременных обработок; queue_wait > 0 — лишние ждут место, 0 — сразу отказ
+    def __init__(self, name:str, user_rate:float, user_burst:float, global_rate:float, global_burst:float,
+                 concurrency:int, queue_wait:float):
+        self.name = name
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.concurrency = concurrency
+        self.queue_wait = queue_wait
+        self.global_bucket = [float(global_burst), time.monotonic()]
+        self.active = 0
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def sem(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        return self._sem
+
+    def share(self, parts:int):
+        # bucket'ы делятся между процессами webhook, как лимиты SendQueue: апдейты одного
+        # пользователя ядро раздаёт по всем процессам, и без деления он получал бы лимит ×parts
+        self.user_rate /= parts
+        self.user_burst = max(1, self.user_burst // parts)
+        self.global_rate /= parts
+        self.global_burst = max(1, self.global_burst // parts)
+        self.global_bucket = [float(self.global_burst), time.monotonic()]
+
+class RateLimiter:
+    """Допуск апдейта: оба bucket'а (пользователя и общий) проверяются до списания, чтобы
+    отказ по общему лимиту не съедал токен пользователя. Bucket'ы пользователей — в dict
+    (O(1) на апдейт); раз в compact_every с из него выкидываются полностью восстановившиеся:
+    они ничем не отличаются от отсутствующих, а иначе dict рос бы с числом пользователей.
+    Об отказе пользователь слышит не чаще раза в compact_every с, остальное молча."""
+    def __init__(self, classes:List[CommandClass], compact_every:float=60.0):
+        self.classes = {c.name: c for c in classes}
+        self.compact_every = compact_every
+        self.rejected: Dict[Tuple[str, str], int] = {}
+        self._users: Dict[Tuple[str, int], List[float]] = {}
+        self._warned: Dict[int, float] = {}
+        self._next_compact = time.monotonic() + compact_every
+
+    def _reject(self, cls:str, reason:str, retry_after:float) -> Tuple[bool, float]:
+        self.rejected[(cls, reason)] = self.rejected.get((cls, reason), 0) + 1
+        return False, retry_after
+
+    def take(self, cls_name:str, user_id:int, now:Optional[float]=None) -> Tuple[bool, float]:
+        # -> (допущен, через сколько секунд можно снова); только bucket'ы, без очереди
+        now = time.monotonic() if now is None else now
+        if now >= self._next_compact:
+            self.compact(now)
+        cls = self.classes[cls_name]
+        key = (cls_name, user_id)
+        ub = self._users.get(key)
+        u_tokens = cls.user_burst if ub is None else min(cls.user_burst, ub[0] + (now - ub[1]) * cls.user_rate)
+        gb = cls.global_bucket
+        g_tokens = min(cls.global_burst, gb[0] + (now - gb[1]) * cls.global_rate)
+        if u_tokens < 1:
+            return self._reject(cls_name, "user", (1 - u_tokens) / cls.user_rate)
+        if g_tokens < 1:
+            gb[0], gb[1] = g_tokens, now
+            return self._reject(cls_name, "global", (1 - g_tokens) / cls.global_rate)
+        self._users[key] = [u_tokens - 1, now]
+        gb[0], gb[1] = g_tokens - 1, now
+        return True, 0.0
+
+    async def acquire(self, cls_name:str, user_id:int) -> Tuple[bool, float]:
+        # bucket'ы + место среди одновременных; при успехе обязателен release()
+        ok, retry_after = self.take(cls_name, user_id)
+        if not ok:
+            return ok, retry_after
+        cls = self.classes[cls_name]
+        sem = cls.sem()
+        if sem.locked() and cls.queue_wait <= 0:
+            return self._reject(cls_name, "busy", 1.0)
+        try:
+            await asyncio.wait_for(sem.acquire(), cls.queue_wait or None)
+        except asyncio.TimeoutError:
+            return self._reject(cls_name, "busy", cls.queue_wait)
+        cls.active += 1
+        return True, 0.0
+
+    def release(self, cls_name:str):
+        cls = self.classes[cls_name]
+        cls.active -= 1
+        cls.sem().release()
+
+    def should_warn(self, user_id:int, now:Optional[float]=None) -> bool:
+        now = time.monotonic() if now is None else now
+        last = self._warned.get(user_id)
+        if last is not None and now - last < self.compact_every:
+            return False
+        self._warned[user_id] = now
+        return True
+
+    def compact(self, now:Optional[float]=None) -> int:
+        now = time.monotonic() if now is None else now
+        self._next_compact = now + self.compact_every
+        full = [key for key, (tokens, stamp) in self._users.items()
+                if tokens + (now - stamp) * self.classes[key[0]].user_rate >= self.classes[key[0]].user_burst]
+        for key in full:
+            del self._users[key]
+        self._warned = {uid: t for uid, t in self._warned.items() if now - t < self.compact_every}
+        return len(full)
+
+    def tracked(self) -> int:
+        return len(self._users)
+
+LIMITER = RateLimiter([
+    CommandClass("read", RATE_USER_PER_MIN / 60, RATE_USER_BURST, RATE_GLOBAL_PER_S, RATE_GLOBAL_PER_S * 2,
+                 READ_CONCURRENCY, RATE_QUEUE_WAIT),
+    CommandClass("scrape", 1 / SCRAPE_USER_COOLDOWN, 1, 1 / 60, 3, SCRAPE_CONCURRENCY, 0),
+])
+METRICS.counter("halyava_ratelimit_rejected_total", "Отклонённые апдейты", ("class", "reason"),
+                fn=lambda: dict(LIMITER.rejected))
+METRICS.gauge("halyava_ratelimit_users", "Пользователей с неполным bucket'ом", fn=LIMITER.tracked)
+METRICS.gauge("halyava_ratelimit_active", "Обрабатывается сейчас по классам команд", ("class",),
+              fn=lambda: {(name,): c.active for name, c in LIMITER.classes.items()})
+
+# ---------- MIDDLEWARE ----------
+_MISSING = object()
+
+class SubscriptionMiddleware(BaseMiddleware):
+    # Кладёт в data["sub"] кэшированную подписку и data["sub_ok"] — флаг доступа.
+    # В БД ходим только при первом обращении пользователя, и то вне event loop.
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            sub = _SUB_CACHE.get(user.id, _MISSING)
+            if sub is _MISSING:
+                _SUB_CACHE_STATS["miss"] += 1
+                sub = await asyncio.to_thread(cached_sub, user.id)
+            else:
+                _SUB_CACHE_STATS["hit"] += 1
+            data["sub"] = sub
+            data["sub_ok"] = _sub_ok(sub)
+        return await handler(event, data)
+
+_METRIC_COMMANDS = {"start", "help", "stores", "profile", "buy", "redeem", "update", "watch", "unwatch", "search"}
+
+def _command_label(event:Any) -> str:
+    # метка ограничена известными командами, иначе произвольный текст раздул бы число рядов
+    if isinstance(event, CallbackQuery):
+        return "cb:" + (event.data or "").split(":", 1)[0][:8]
+    text = getattr(event, "text", None) or ""
+    if not text.startswith("/"):
+        return "text"
+    cmd = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+    return cmd if cmd in _METRIC_COMMANDS else "other"
+
+class MetricsMiddleware(BaseMiddleware):
+    # Внешний слой: время от получения апдейта до конца хендлера, включая проверку подписки
+    # и ожидание в очереди отправки ответа.
+    async def __call__(self, handler, event, data):
+        label = _command_label(event)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, label)
+            if not STARTUP.done:
+                STARTUP.mark("first_update")
+
+class RateLimitMiddleware(BaseMiddleware):
+    # До проверки подписки: отклонённый апдейт не стоит ни запроса в БД, ни места в очереди.
+    # /update от администратора — класс «scrape», остальное — «read»: отказ не-админу стоит
+    # как лёгкая команда и не тратит бюджет опроса источников. Пустой магазин в /search
+    # допускается к опросу отдельно, в самом хендлере.
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+        cls = "scrape" if _command_label(event) == "update" and user.id in ADMIN_IDS else "read"
+        ok, retry_after = await LIMITER.acquire(cls, user.id)
+        if not ok:
+            if LIMITER.should_warn(user.id):
+                text = f"Слишком часто. Попробуй через {max(1, math.ceil(retry_after))} с."
+                await (reply(event, text) if isinstance(event, Message) else event.answer(text))
+            elif isinstance(event, CallbackQuery):
+                await event.answer()
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            LIMITER.release(cls)
+
 # ---------- БОТ ----------
 router = Router()
 
 @router.message(Command("start"))
-async def cmd_start(m: Message):
+async def cmd_start(m: Message, sub: Optional[Tuple[str, int]] = None):
     log.info("[START] from=%s @%s", m.from_user.id, m.from_user.username)
-    upsert_user(m.from_user.id, m.from_user.username or "")
-    sub = get_sub(m.from_user.id)
+    await asyncio.to_thread(upsert_user, m.from_user.id, m.from_user.username or "")
     if not sub:
-        till = grant_trial(m.from_user.id, TRIAL_DAYS)
-        await m.answer(
+        till = await asyncio.to_thread(grant_trial, m.from_user.id, TRIAL_DAYS)
+        await reply(m,
             f"Привет! Включил бесплатный триал до {esc(till)}.\n"
             f"Команды: /search <магазин>, /stores, /profile, /buy, /redeem <код>, /help",
             disable_web_page_preview=True
         )
     else:
-        await m.answer("Снова здесь! Попробуй: /search ozon", disable_web_page_preview=True)
+        await reply(m, "Снова здесь! Попробуй: /search ozon", disable_web_page_preview=True)
 
 @router.message(Command("help"))
 async def cmd_help(m: Message):
-    await m.answer(
+    await reply(m,
         "Команды:\n"
-        "• /search <магазин> — найти актуальные промо\n"
+        "• /search <магазин или слова> — найти актуальные промо\n"
+        "• /watch <магазин> — присылать новые промо магазина, /unwatch — перестать\n"
         "• /stores — список магазинов\n"
         "• /profile — статус подписки\n"
         f"• /buy — оформить подписку ({MONTHLY_PRICE_RUB}₽/мес)\n"
@@ -496,18 +3165,19 @@ async def cmd_help(m: Message):
 
 @router.message(Command("stores"))
 async def cmd_stores(m: Message):
-    await m.answer("Популярные магазины:\n" + "\n".join("• " + s for s in POPULAR_STORES))
+    await reply(m, "Популярные магазины:\n" + "\n".join("• " + s for s in POPULAR_STORES))
 
 @router.message(Command("profile"))
-async def cmd_profile(m: Message):
-    sub = get_sub(m.from_user.id)
+async def cmd_profile(m: Message, sub: Optional[Tuple[str, int]] = None):
     if not sub:
-        return await m.answer("Статус: нет подписки. /buy — оформить (249₽/мес).")
-    await m.answer(f"Статус: {esc(sub['status'])} до {esc(sub['until'])}")
+        return await reply(m, "Статус: нет подписки. /buy — оформить (249₽/мес).")
+    status, until = sub
+    until_iso = datetime.datetime.fromtimestamp(until, datetime.timezone.utc).replace(tzinfo=None).isoformat()
+    await reply(m, f"Статус: {esc(status)} до {esc(until_iso)}")
 
 @router.message(Command("buy"))
 async def cmd_buy(m: Message):
-    await m.answer(
+    await reply(m,
         f"Подписка {MONTHLY_PRICE_RUB}₽/мес.\n"
         "На MVP доступна активация через промокод администратора: /redeem КОД.\n"
         "Позже прикрутим оплату.",
@@ -518,63 +3188,259 @@ async def cmd_buy(m: Message):
 async def cmd_redeem(m: Message):
     parts = (m.text or "").split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip():
-        return await m.answer("Формат: /redeem КОД")
+        return await reply(m, "Формат: /redeem КОД")
     # mvp: активируем месяц без проверки кода
-    until = grant_month(m.from_user.id, 1)
-    await m.answer(f"Подписка активна до {esc(until)}. /profile — проверить")
+    until = await asyncio.to_thread(grant_month, m.from_user.id, 1)
+    await reply(m, f"Подписка активна до {esc(until)}. /profile — проверить")
 
 @router.message(Command("update"))
 async def cmd_update(m: Message):
-    await m.answer("Собираю источники…")
-    added = run_all_sources()
-    await m.answer(f"Готово. Добавлено: {added}")
+    if m.from_user.id not in ADMIN_IDS:
+        log.info("[UPDATE] denied for %s", m.from_user.id)
+        return await reply(m, "Команда доступна только администраторам.")
+    await reply(m, "Собираю источники…")
+    added = await REFRESH_REQUESTS.run("all")
+    if added is None:
+        return await reply(m, "Сбор ещё идёт, новые сделки появятся в /search.")
+    await reply(m, f"Готово. Добавлено: {added}")
+    await PUSH.enqueue()
+
+@router.message(Command("watch"))
+async def cmd_watch(m: Message, sub_ok: bool = False):
+    args = (m.text or "").split(maxsplit=1)[1:]
+    if not args:
+        slugs = await asyncio.to_thread(user_watches, m.from_user.id)
+        if not slugs:
+            return await reply(m, "Формат: /watch магазин — пришлю новые промо, как только появятся")
+        return await reply(m, "Слежу за: " + ", ".join(esc(s) for s in slugs) + "\n/unwatch магазин — перестать")
+    if not sub_ok:
+        return await reply(m, "Нужна активная подписка. /buy — оформить (в /start есть триал)")
+    store_slug = slug_for_query(args[0])
+    if not store_slug:
+        return await reply(m, "Не узнал магазин. Посмотри /stores и попробуй ещё раз.")
+    if not await asyncio.to_thread(add_watch, m.from_user.id, store_slug):
+        return await reply(m, f"Можно следить не больше чем за {WATCH_LIMIT} магазинами. /unwatch — убрать лишние")
+    await reply(m, f"Слежу за {esc(store_slug)}: новые промо пришлю сам.")
+
+@router.message(Command("unwatch"))
+async def cmd_unwatch(m: Message):
+    args = (m.text or "").split(maxsplit=1)[1:]
+    store_slug = slug_for_query(args[0]) if args else None
+    if args and not store_slug:
+        return await reply(m, "Не узнал магазин. /watch — список отслеживаемых")
+    removed = await asyncio.to_thread(remove_watch, m.from_user.id, store_slug)
+    if not removed:
+        return await reply(m, "Такого в списке нет. /watch — список отслеживаемых")
+    await reply(m, f"Больше не слежу за {esc(store_slug)}." if store_slug else "Отписал от всех магазинов.")
 
 @router.message(Command("search"))
-async def cmd_search(m: Message):
+async def cmd_search(m: Message, sub_ok: bool = False):
     log.info("[SEARCH] from=%s text=%r", m.from_user.id, m.text)
     args = (m.text or "").split()[1:]
     if not args:
-        return await m.answer("Формат: /search магазин\nПример: /search ozon")
+        return await reply(m, "Формат: /search магазин\nПример: /search ozon")
 
-    if not sub_active(m.from_user.id):
-        return await m.answer("Нужна активная подписка. /buy — оформить (в /start есть триал)")
+    if not sub_ok:
+        return await reply(m, "Нужна активная подписка. /buy — оформить (в /start есть триал)")
 
-    store_slug = slug_for_query(" ".join(args))
-    if not store_slug:
-        return await m.answer("Не узнал магазин. Посмотри /stores и попробуй ещё раз.")
+    # магазин (в том числе с опечаткой), магазин + слова или просто слова: «ozon айфон», «кроссовки»
+    store_slug, words = STORE_RESOLVER.split(" ".join(args))
+    results = await asearch_text(words, store_slug, limit=8) if words else []
+    if not results and not store_slug:
+        return await reply(m, "Ничего не нашёл. Посмотри /stores или попробуй другие слова.")
 
-    results = search_deals(store_slug, limit=8)
+    if results:
+        for text in pack_messages([RENDER_CACHE.render(d) for d in results], checked=True):
+            await SEND_QUEUE.send_text(m.bot, m.chat.id, text, disable_web_page_preview=True)
+        return
+
+    # по словам внутри магазина пусто — показываем магазин целиком, постранично
+    results = await asearch_deals(store_slug, limit=PAGE_SIZE + 1)
     if not results:
-        await m.answer("По этому магазину пока пусто. Запрашиваю источники…")
-        run_all_sources()
-        results = search_deals(store_slug, limit=8)
+        key = "store:" + store_slug
+        if not await REFRESH_REQUESTS.will_run(key):
+            await REFRESH_REQUESTS.run(key)
+        else:
+            ok, retry_after = await LIMITER.acquire("scrape", m.from_user.id)
+            if not ok:
+                return await reply(m, "По этому магазину пока пусто, а опрос источников сейчас недоступен. "
+                                      f"Попробуй через {max(1, math.ceil(retry_after))} с.")
+            try:
+                await reply(m, "По этому магазину пока пусто. Запрашиваю источники…")
+                await REFRESH_REQUESTS.run(key)
+            finally:
+                LIMITER.release("scrape")
+        results = await asearch_deals(store_slug, limit=PAGE_SIZE + 1)
         if not results:
-            return await m.answer("Пока ничего не нашли. Загляни позже или попробуй другой магазин.")
+            return await reply(m, "Пока ничего не нашли. Загляни позже или попробуй другой магазин.")
 
-    for d in results:
+    text, kb = render_page(results, first=True)
+    await SEND_QUEUE.send_text(m.bot, m.chat.id, text, reply_markup=kb, disable_web_page_preview=True)
+
+@router.callback_query(F.data.startswith("pg"))
+async def cb_page(c: CallbackQuery, sub_ok: bool = False):
+    # листание выдачи: то же сообщение редактируется, новые не шлём
+    if not sub_ok:
+        return await c.answer("Нужна активная подписка. /buy — оформить", show_alert=True)
+    if not isinstance(c.message, Message):
+        return await c.answer("Сообщение устарело, повтори /search")
+    kind, _, arg = (c.data or "").partition(":")
+    if kind == "pg0":
+        store_slug = arg  # кнопки, отправленные до pgh: slug прямо в callback data
+    else:
         try:
-            await m.answer(fmt_deal(d), disable_web_page_preview=True)
-        except Exception:
-            await m.answer(re.sub(r"<.*?>", "", fmt_deal(d)), disable_web_page_preview=True)
+            cursor = int(arg, 36)
+        except ValueError:
+            # битые, поддельные или старые callback data: ответить, иначе у клиента висит спиннер
+            return await c.answer("Список обновился, повтори /search")
+        if kind == "pgh":
+            store_slug = await storage().aread(_deal_store, cursor)
+            if store_slug is None:
+                return await c.answer("Список обновился, повтори /search")
+    if kind in ("pg0", "pgh"):
+        first = True
+        results = await asearch_deals(store_slug, limit=PAGE_SIZE + 1)
+    else:
+        results = await asearch_deals_after(cursor, limit=PAGE_SIZE + 1)
+        if not results:
+            return await c.answer("Список обновился, повтори /search" if results is None else "Это всё")
+        first = False
+    if not results:
+        return await c.answer("Пока пусто")
+    text, kb = render_page(results, first)
+    msg = c.message
+    try:
+        await SEND_QUEUE.call(msg.chat.id, lambda: msg.edit_text(text, reply_markup=kb, disable_web_page_preview=True))
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    await c.answer()
 
 # ---------- ПЛАНИРОВЩИК ----------
 scheduler: Optional[AsyncIOScheduler] = None
 
-async def scrape_job():
+class SourceJob:
+    # Плановый сбор одного источника — отдельная задача планировщика со своим интервалом:
+    #  - ошибка: следующий запуск через interval * 2^ошибок подряд (до max_interval);
+    #  - последние WINDOW успешных запусков все принесли новые сделки — интервал ×0.75
+    #    (не меньше min_interval), все пустые — ×1.5 (не больше max_interval);
+    #    после подстройки окно копится заново, чтобы интервал не скакал на каждом запуске.
+    WINDOW = 3
+
+    def __init__(self, name:str, pull:Callable[[], Any], interval:float, min_interval:float,
+                 max_interval:float, jitter:float=SOURCE_JITTER, enabled:bool=True):
+        self.name = name
+        self.pull = pull
+        self.interval = float(interval)
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max(max_interval, interval))
+        self.jitter = jitter
+        self.enabled = enabled
+        self.failures = 0
+        self.runs = 0
+        self.added = 0
+        self.recent: deque = deque(maxlen=self.WINDOW)
+        self.scheduled: Optional[float] = None  # интервал, с которым задача сейчас стоит в планировщике
+
+    @property
+    def job_id(self) -> str:
+        return "source:" + self.name
+
+    @property
+    def delay(self) -> float:
+        return min(self.max_interval, self.interval * 2 ** self.failures)
+
+    def record(self, added:Optional[int]) -> float:
+        # added=None — запуск упал; возвращает задержку до следующего запуска
+        self.runs += 1
+        if added is None:
+            self.failures += 1
+            return self.delay
+        self.failures = 0
+        self.added += added
+        self.recent.append(added)
+        if len(self.recent) == self.WINDOW:
+            if all(self.recent):
+                self.interval = max(self.min_interval, self.interval * 0.75)
+                self.recent.clear()
+            elif not any(self.recent):
+                self.interval = min(self.max_interval, self.interval * 1.5)
+                self.recent.clear()
+        return self.delay
+
+    def trigger_args(self, delay:float) -> Dict[str,Any]:
+        return dict(trigger="interval", seconds=delay, jitter=delay * self.jitter)
+
+    @property
+    def state_key(self) -> str:
+        return "sched:" + self.name
+
+    def restore(self, state:Optional[dict], now:float) -> float:
+        # состояние из source_state -> unix-время первого запуска после старта
+        if state and state.get("interval_s"):
+            self.interval = min(self.max_interval, max(self.min_interval, float(state["interval_s"])))
+        next_ts = (state or {}).get("next_ts") or 0
+        return max(now + SCRAPE_START_DELAY, next_ts)
+
+SOURCES: Dict[str, SourceJob] = {
+    src.name: src for src in (
+        SourceJob("admitad", pull_admitad, ADMITAD_INTERVAL, ADMITAD_INTERVAL / 4, SOURCE_MAX_INTERVAL,
+                  enabled=bool(ADMITAD_WEBSITE_ID)),
+        SourceJob("cityads", pull_cityads, CITYADS_INTERVAL, CITYADS_INTERVAL / 4, SOURCE_MAX_INTERVAL,
+                  enabled=bool(CITYADS_COUPONS_URL)),
+        # у каждой страницы ещё и свой срок (PROMO_*_INTERVAL): задача лишь проверяет, кому пора
+        SourceJob("pages", pull_official_pages, PROMO_PAGES_INTERVAL, PROMO_PAGES_INTERVAL / 4,
+                  min(SOURCE_MAX_INTERVAL, PROMO_MIN_INTERVAL), enabled=bool(OFFICIAL_PROMO_PAGES)),
+    )
+}
+
+async def run_source(name:str):
+    # ключ REFRESH общий с /update и обновлением по /search: одновременный запрос не дублируется
+    src = SOURCES[name]
     try:
-        added = run_all_sources()
-        log.info("[SCRAPER] added: %s", added)
+        added = await REFRESH.do(name, src.pull)
     except Exception as e:
-        log.error("[SCRAPER] error: %s", e)
+        log.error("[SCHED][%s] error: %s", name, e)
+        added = None
+    SOURCE_RUNS.inc(name, "ok" if added is not None else "error")
+    delay = src.record(added)
+    if delay != src.scheduled and scheduler is not None and scheduler.get_job(src.job_id):
+        scheduler.reschedule_job(src.job_id, **src.trigger_args(delay))
+        src.scheduled = delay
+    now = int(time.time())
+    await asyncio.to_thread(set_source_state, src.state_key, checked_ts=now, interval_s=int(src.interval),
+                            next_ts=now + int(delay))
+    log.info("[SCHED][%s] added=%s failures=%s next_in=%ss", name, added, src.failures, int(delay))
+    if added:
+        await PUSH.enqueue()
+
+def schedule_sources(sched:AsyncIOScheduler, states:Optional[Dict[str, dict]]=None) -> List[str]:
+    # max_instances=1 + coalesce: пропущенные запуски (долгий сбор, сон машины) схлопываются
+    # в один, и два запуска одного источника не идут внахлёст. states — source_state по
+    # state_key: интервал и срок запуска, сохранённые прошлым процессом.
+    ids = []
+    now = time.time()
+    for src in SOURCES.values():
+        if not src.enabled:
+            continue
+        first = src.restore((states or {}).get(src.state_key), now)
+        src.scheduled = src.delay
+        sched.add_job(run_source, args=[src.name], id=src.job_id, max_instances=1, coalesce=True,
+                      misfire_grace_time=max(1, int(src.min_interval)), replace_existing=True,
+                      next_run_time=datetime.datetime.fromtimestamp(first, datetime.timezone.utc),
+                      **src.trigger_args(src.delay))
+        ids.append(f"{src.job_id}@+{first - now:.0f}s")
+    return ids
 
 async def cleanup_job():
     try:
-        cleanup_old(60)
-        log.info("[CLEANUP] done")
+        stats = await asyncio.to_thread(cleanup_old, 60)
+        log.info("[CLEANUP] removed=%(removed)s batches=%(batches)s lock_held=%(lock_held_s)ss "
+                 "reclaimed=%(reclaimed_bytes)s bytes", stats)
     except Exception as e:
         log.error("[CLEANUP] error: %s", e)
 
-async def main():
+def _check_token():
     if not BOT_TOKEN:
         raise RuntimeError("Set BOT_TOKEN env var")
     if not _valid_token(BOT_TOKEN):
@@ -585,23 +3451,185 @@ async def main():
             "например 8284074356:AAE… (без кавычек/пробелов). Сейчас: " + masked
         )
 
-    init_db()
+def make_bot() -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+    return Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+def make_dispatcher() -> Dispatcher:
+    # router подключается к одному диспетчеру: по диспетчеру на процесс
     dp = Dispatcher()
+    dp.message.outer_middleware(MetricsMiddleware())
+    dp.callback_query.outer_middleware(MetricsMiddleware())
+    dp.message.outer_middleware(RateLimitMiddleware())
+    dp.callback_query.outer_middleware(RateLimitMiddleware())
+    dp.message.outer_middleware(SubscriptionMiddleware())
+    dp.callback_query.outer_middleware(SubscriptionMiddleware())
     dp.include_router(router)
+    return dp
 
+async def start_background(bot:Bot):
+    # планировщик сбора и рассылка: в polling — сразу, в webhook — у владельца аренды
     global scheduler
+    states = await asyncio.to_thread(get_source_states, [src.state_key for src in SOURCES.values()])
     scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-    scheduler.add_job(scrape_job, "interval", minutes=30, id="scrape")
-    scheduler.add_job(cleanup_job, "interval", hours=12, id="cleanup")
+    log.info("[SCHED] sources: %s", schedule_sources(scheduler, states))
+    scheduler.add_job(cleanup_job, "interval", hours=12, id="cleanup", max_instances=1, coalesce=True)
     scheduler.start()
+    PUSH.start(bot)
+    REFRESH_REQUESTS.start()
+
+async def stop_background():
+    global scheduler
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        scheduler = None
+    await REFRESH_REQUESTS.stop()
+    await PUSH.stop()
+
+async def register_webhook(bot:Bot):
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                          allowed_updates=["message", "callback_query"])
+    STARTUP.mark("set_webhook")
+
+async def serve_webhook(index:int=0, register:bool=False):
+    # Один процесс-обработчик webhook. Все слушают один порт (SO_REUSEPORT, ядро раздаёт
+    # соединения Telegram между ними); общее состояние — только в SQLite.
+    # register — регистрирует webhook сам, когда уже принимает апдейты (единственный процесс).
+    global SEND_QUEUE, METRICS_PORT
+    origin = f"{os.getpid()}:{index}"
+    if WEB_WORKERS > 1:
+        # лимиты Telegram общие на бота: делим их между процессами
+        SEND_QUEUE = SendQueue(SEND_RATE / WEB_WORKERS, max(1, SEND_BURST // WEB_WORKERS), SEND_CHAT_INTERVAL,
+                               SEND_INFLIGHT)
+        if METRICS_PORT:
+            METRICS_PORT += index
+        for cls in LIMITER.classes.values():
+            cls.share(WEB_WORKERS)
+    # и с одним процессом: при перезапуске старый и новый какое-то время работают вместе
+    CACHE_EVENTS.start(origin)
+    STARTUP.mark("db")
+    if SUB_CACHE_WARM:
+        log.info("[SUBS] cache warmed: %s", await asyncio.to_thread(warm_sub_cache))
+        STARTUP.mark("warm")
+
+    bot = make_bot()
+    dp = make_dispatcher()
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=True).start()
+    STARTUP.mark("ready")
 
-    loop = asyncio.get_event_loop()
-    loop.call_later(10, lambda: asyncio.create_task(scrape_job()))
+    lag = LoopLagMonitor(METRICS_LAG_INTERVAL)
+    lag.start()
+    lease = Lease("scheduler", origin, LEASE_TTL)
+    leader = asyncio.create_task(lease.hold(lambda: start_background(bot), stop_background))
+    metrics_runner = None
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    log.info("[WEB] worker %s pid=%s on %s:%s%s", index, os.getpid(), WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        metrics_runner = await start_metrics_server()
+        if register:
+            await register_webhook(bot)
+        await stop.wait()
+    finally:
+        leader.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await leader
+        await runner.cleanup()  # дождётся апдейтов в обработке и закроет сессию бота
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await lag.stop()
+        await CACHE_EVENTS.stop()
+        await close_http()
+        shutdown_parse_pool()
+        close_storage()
+
+def _web_worker(index:int):
+    # точка входа дочернего процесса (spawn): Ctrl+C приходит всей группе, родитель сам пошлёт SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_webhook(index))
+
+async def run_webhook():
+    # Родитель: миграции БД один раз, WEB_WORKERS процессов и их перезапуск, регистрация
+    # webhook — пока воркеры импортируют модули (в одном процессе — после старта сервера)
+    await asyncio.to_thread(init_db)
+    if WEB_WORKERS <= 1:
+        return await serve_webhook(0, register=True)
+    close_storage()  # дочерним процессам — свои соединения
+    ctx = multiprocessing.get_context("spawn")
+    workers: Dict[int, multiprocessing.Process] = {}
+    def spawn(i:int):
+        p = workers[i] = ctx.Process(target=_web_worker, args=(i,), name=f"web-{i}", daemon=False)
+        p.start()
+    for i in range(WEB_WORKERS):
+        spawn(i)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    log.info("[WEB] %s workers on :%s", WEB_WORKERS, WEBHOOK_PORT)
+    try:
+        bot = make_bot()
+        try:
+            await register_webhook(bot)
+        finally:
+            await bot.session.close()
+        while not stop.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=1.0)
+            for i, p in list(workers.items()):
+                if not stop.is_set() and not p.is_alive():
+                    log.error("[WEB] worker %s exited with %s, restarting", i, p.exitcode)
+                    spawn(i)
+    finally:
+        for p in workers.values():
+            if p.is_alive():
+                p.terminate()  # SIGTERM: воркер доделает текущие апдейты
+        for p in workers.values():
+            await asyncio.to_thread(p.join, 30)
+            if p.is_alive():
+                p.kill()
+
+async def main():
+    _check_token()
+    if WEBHOOK_URL:
+        return await run_webhook()
+
+    init_db()
+    if SUB_CACHE_WARM:
+        log.info("[SUBS] cache warmed: %s", warm_sub_cache())
+        STARTUP.mark("warm")
+
+    bot = make_bot()
+    dp = make_dispatcher()
+    lag = LoopLagMonitor(METRICS_LAG_INTERVAL)
+    metrics_runner = None
 
     log.info("Start polling")
-    await dp.start_polling(bot)
+    try:
+        await start_background(bot)
+        lag.start()
+        metrics_runner = await start_metrics_server()
+        await bot.delete_webhook()  # после webhook-режима getUpdates иначе вернёт Conflict
+        STARTUP.mark("ready")
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await lag.stop()
+        await stop_background()
+        await close_http()
+        shutdown_parse_pool()
+        close_storage()
+
+STARTUP.mark("module")
 
 if __name__ == "__main__":
     asyncio.run(main())